@@ -1,19 +1,127 @@
 import streamlit as st
-from openai import OpenAI
 import json
+import atexit
+import base64
+import bisect
+import copy
+import functools
+import gzip
+import hashlib
+import hmac
+import io
+import logging
+import math
 import os
-from datetime import datetime
-from typing import List, Dict, Optional
+import random
+import re
+import secrets
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List, Dict, Optional, Tuple, Union
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:  # The SDK itself is imported on first use; it is most of a cold start
+    from openai import OpenAI
+
+try:
+    import tiktoken
+except ImportError:  # Token counts fall back to a character-based estimate
+    tiktoken = None
+
+try:
+    import zstandard
+except ImportError:  # The "zstd" storage format falls back to gzip
+    zstandard = None
+
 # Load environment variables from .env file
 load_dotenv()
 
 # App version
 APP_VERSION = "1.0.0"
 
-# OpenAI Base URL
-OPENAI_BASE_URL = "https://openai.dplit.com/v1/"
+# OpenAI Base URL; point it at a local stand-in such as mock_openai.py for load tests
+OPENAI_BASE_URL = os.getenv("PIXEL_OPENAI_BASE_URL", "https://openai.dplit.com/v1/")
+
+# HTTP settings shared by all pooled OpenAI clients
+OPENAI_TIMEOUT = float(os.getenv("PIXEL_OPENAI_TIMEOUT", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("PIXEL_OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("PIXEL_OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("PIXEL_OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("PIXEL_OPENAI_KEEPALIVE_EXPIRY", "30"))
+
+# Seconds a pooled client may go unused before it is dropped from the registry
+CLIENT_IDLE_TTL = float(os.getenv("PIXEL_CLIENT_IDLE_TTL", "900"))
+
+# Retries with exponential backoff and jitter for 408/409/429/5xx, timeouts and connection errors
+RETRY_ATTEMPTS = int(os.getenv("PIXEL_RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("PIXEL_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("PIXEL_RETRY_MAX_DELAY", "8"))
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# Fire a duplicate request when the first one is slower than this latency percentile (0 = off)
+HEDGE_PERCENTILE = float(os.getenv("PIXEL_HEDGE_PERCENTILE", "0"))
+HEDGE_MIN_SAMPLES = int(os.getenv("PIXEL_HEDGE_MIN_SAMPLES", "20"))
+
+# Fail fast after this many consecutive upstream failures, for CIRCUIT_RESET_TIMEOUT seconds
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("PIXEL_CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("PIXEL_CIRCUIT_RESET_TIMEOUT", "30"))
+
+# Opt-in cache of temperature-0 replies; the disk tier is enabled by setting a directory
+RESPONSE_CACHE = os.getenv("PIXEL_RESPONSE_CACHE", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_SIZE = int(os.getenv("PIXEL_RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_DIR = os.getenv("PIXEL_RESPONSE_CACHE_DIR", "")
+RESPONSE_CACHE_TTL = float(os.getenv("PIXEL_RESPONSE_CACHE_TTL", str(24 * 60 * 60)))
+RESPONSE_CACHE_DISK_BYTES = int(os.getenv("PIXEL_RESPONSE_CACHE_DISK_BYTES", str(256 * 1024 * 1024)))
+
+# Seconds between sweeps of expired entries out of the disk tier
+RESPONSE_CACHE_SWEEP_INTERVAL = 15 * 60
+
+# Maximum tokens requested for each assistant reply
+MAX_COMPLETION_TOKENS = 3000
+
+# Prompt token budget per request (system prompt + history); older turns are dropped first
+CONTEXT_TOKEN_BUDGET = int(os.getenv("PIXEL_CONTEXT_TOKEN_BUDGET", "6000"))
+
+# Context window sizes, used to cap the budget for smaller models
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo-preview": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000
+}
+
+# Fold turns that no longer fit the budget into a running summary
+ROLLING_SUMMARIES = os.getenv("PIXEL_ROLLING_SUMMARIES", "true").lower() not in ("0", "false", "no")
+SUMMARY_MAX_TOKENS = 400
+
+# Render assistant replies token by token as they arrive
+STREAM_RESPONSES = os.getenv("PIXEL_STREAM_RESPONSES", "true").lower() not in ("0", "false", "no")
+
+# Replies are generated on a bounded worker pool shared by all sessions;
+# the pending reply is redrawn every GENERATION_POLL_INTERVAL seconds
+LLM_MAX_WORKERS = int(os.getenv("PIXEL_LLM_MAX_WORKERS", "16"))
+GENERATION_POLL_INTERVAL = 0.2
+
+# Per-turn spans and token histograms: "off" (default), "prometheus" (rewrites PIXEL_METRICS_FILE
+# in the text exposition format) or "json" (one log line on stdout), every PIXEL_METRICS_INTERVAL seconds
+METRICS_EXPORT = os.getenv("PIXEL_METRICS", "off").lower()
+METRICS_ENABLED = METRICS_EXPORT in ("prometheus", "json")
+METRICS_FILE = os.getenv("PIXEL_METRICS_FILE", "metrics.prom")
+METRICS_INTERVAL = float(os.getenv("PIXEL_METRICS_INTERVAL", "15"))
+
+# Histogram bucket bounds for span durations (seconds) and token counts
+SPAN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 131072)
 
 # Page configuration
 st.set_page_config(
@@ -24,134 +132,2277 @@ st.set_page_config(
     menu_items=None
 )
 
-# Basic UI Styling
-st.markdown("""
-    <style>
-    footer {visibility: hidden;}
-    
-    /* Sidebar styling */
-    [data-testid="stSidebar"] {
-        background: #fff5f9 !important;
-    }
-    
-    [data-testid="stSidebar"] .stButton > button {
-        background: #ff9ec7 !important;
-        color: white !important;
-        border: none !important;
-        border-radius: 8px !important;
-    }
-    
-    /* Chat messages */
-    [data-testid="stChatMessageUser"] > div > div {
-        background: #ff9ec7 !important;
-        color: white !important;
-        border-radius: 16px 16px 4px 16px !important;
-    }
-    
-    [data-testid="stChatMessageAssistant"] > div {
-        background: white !important;
-        border: 1px solid #ffe0e6 !important;
-        border-radius: 16px 16px 16px 4px !important;
-    }
-    
-    /* Header */
-    .main-header {
-        font-size: 3rem;
-        font-weight: 700;
-        text-align: center;
-        color: #e91e63;
-        margin: 1rem 0 0.5rem 0;
-    }
-    
-    .header-subtitle {
-        font-size: 1rem;
-        color: #64748b;
-        text-align: center;
-        margin-bottom: 2rem;
-    }
-    
-    /* Empty state */
-    .empty-state {
-        display: flex;
-        flex-direction: column;
-        align-items: center;
-        text-align: center;
-        padding: 4rem 2rem;
-    }
-    
-    .empty-state-icon {
-        font-size: 4rem;
-        margin-bottom: 1rem;
-    }
-    
-    .empty-state h2 {
-        font-size: 1.5rem;
-        font-weight: 600;
-        color: #1e293b;
-        margin-bottom: 0.5rem;
-    }
-    
-    .empty-state p {
-        color: #64748b;
-        max-width: 450px;
-    }
-    
-    /* Chat input */
-    .stChatInput > div > div > input {
-        border-radius: 20px !important;
-        border: 2px solid #ffe0e6 !important;
-    }
-    
-    .stChatInput > div > div > input:focus {
-        border-color: #ff9ec7 !important;
-    }
-    </style>
-""", unsafe_allow_html=True)
+# Theme stylesheet, served from static/ (see .streamlit/config.toml); the version busts browser caches
+THEME_STYLESHEET = f"app/static/pixel.css?v={APP_VERSION}"
 
 # File paths for data storage
 CONVERSATIONS_FILE = "conversations.json"
+CONVERSATIONS_INDEX_FILE = "conversations.index.json"
+CONVERSATIONS_JOURNAL_FILE = "conversations.journal.jsonl"
+CONVERSATIONS_DB_FILE = "conversations.db"
 PREFERENCES_FILE = "preferences.json"
 
-def load_conversations() -> List[Dict]:
-    """Load conversation history from JSON file"""
-    if os.path.exists(CONVERSATIONS_FILE):
+# Conversation storage engine: "json" (default) or "sqlite"
+STORAGE_BACKEND = os.getenv("PIXEL_STORAGE_BACKEND", "json").lower()
+
+# Seconds to coalesce preference changes before writing PREFERENCES_FILE
+PREFERENCES_FLUSH_DELAY = float(os.getenv("PIXEL_PREFERENCES_FLUSH_DELAY", "0.5"))
+
+# Journal size (bytes) after which it is folded back into CONVERSATIONS_FILE
+JOURNAL_COMPACT_BYTES = int(os.getenv("PIXEL_JOURNAL_COMPACT_BYTES", str(4 * 1024 * 1024)))
+
+# How CONVERSATIONS_FILE is written: "compact" JSON (default), "pretty" JSON, or "gzip"/"zstd"
+# compressed JSON lines; any of them is read back regardless of the current setting
+STORAGE_FORMATS = ("compact", "pretty", "gzip", "zstd")
+STORAGE_FORMAT = os.getenv("PIXEL_STORAGE_FORMAT", "compact").lower()
+
+# Uncompressed bytes per compressed block; opening a conversation decompresses only its block
+COMPRESSION_BLOCK_BYTES = 64 * 1024
+
+# Move conversations untouched for this many days into compressed archive segments (0 = never)
+ARCHIVE_AFTER_DAYS = float(os.getenv("PIXEL_ARCHIVE_AFTER_DAYS", "0"))
+CONVERSATIONS_ARCHIVE_DIR = "conversations.archive"
+
+# Message bytes of conversation bodies kept in the cache shared by all sessions
+CONVERSATION_CACHE_BYTES = int(os.getenv("PIXEL_CONVERSATION_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# Give every visitor their own conversations and preferences ("user"), or share one history ("off")
+STORAGE_SHARDING = os.getenv("PIXEL_STORAGE_SHARDING", "off").lower() == "user"
+
+# Root directory of the per-user shards, and the shard map inside it
+SHARDS_DIR = os.getenv("PIXEL_SHARDS_DIR", "users")
+SHARD_MAP_FILE = "shards.jsonl"
+
+# Shards kept open at once; with sharding each one caches an equal part of CONVERSATION_CACHE_BYTES
+MAX_OPEN_SHARDS = int(os.getenv("PIXEL_MAX_OPEN_SHARDS", "128"))
+
+# Query parameter holding an anonymous visitor's key, so a bookmarked URL finds the same history
+USER_KEY_PARAM = "user"
+
+# Messages drawn in the chat pane at a time; older ones are paged in on request
+CHAT_WINDOW_SIZE = int(os.getenv("PIXEL_CHAT_WINDOW_SIZE", "50"))
+
+# Conversation cards shown per sidebar page
+CONVERSATIONS_PAGE_SIZE = int(os.getenv("PIXEL_CONVERSATIONS_PAGE_SIZE", "10"))
+
+# Conversations (or bytes of them) an import writes to storage at a time
+IMPORT_BATCH_SIZE = int(os.getenv("PIXEL_IMPORT_BATCH_SIZE", "200"))
+IMPORT_BATCH_BYTES = 8 * 1024 * 1024
+
+# Path of serve.py's streaming export route; serve.py sets it, plain `streamlit run app.py` has none
+EXPORT_ROUTE = os.getenv("PIXEL_EXPORT_ROUTE", "")
+
+# Seconds an export download link stays valid
+EXPORT_LINK_TTL = 300
+
+# Show this session's approximate memory footprint in the sidebar
+SHOW_MEMORY_USAGE = os.getenv("PIXEL_SHOW_MEMORY_USAGE", "false").lower() in ("1", "true", "yes")
+
+# Histogram families: name -> (help text, bucket bounds)
+METRIC_FAMILIES = {
+    "pixel_span_seconds": ("Time spent in each phase of a chat turn", SPAN_BUCKETS),
+    "pixel_tokens": ("Prompt and completion tokens per API request", TOKEN_BUCKETS)
+}
+
+class Histogram:
+    """Observation counts per bucket (the last one is +Inf), with their sum"""
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """Histograms shared by all sessions, exported periodically.
+
+    Each histogram is identified by its family and a sorted tuple of label
+    pairs. Process-wide components register their ``stats()`` counters,
+    which are exported as gauges alongside. A background thread exports
+    them every ``interval`` seconds, in the Prometheus text format to
+    ``path`` or as a JSON line on stdout.
+    """
+
+    def __init__(self, export_format: str, path: str, interval: float):
+        self.export_format = export_format
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.stats = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="metrics-export", daemon=True)
+        self.thread.start()
+
+    def observe(self, family: str, value: float, labels: Tuple[Tuple[str, str], ...]):
+        """Add one observation to the histogram of ``family`` with these labels"""
+        key = (family, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(METRIC_FAMILIES[family][1])
+            histogram.observe(value)
+
+    def register_stats(self, name: str, description: str, stats: Callable[[], Dict]):
+        """Export the counters returned by ``stats`` as gauges named ``pixel_<name>_<counter>``"""
+        with self.lock:
+            self.stats[name] = (description, stats)
+
+    def collect_stats(self) -> Dict[str, Tuple[str, Dict]]:
+        """Current counters of every registered component, by name"""
+        with self.lock:
+            registered = sorted(self.stats.items())
+        return {name: (description, stats()) for name, (description, stats) in registered}
+
+    def snapshot(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], Tuple[float, ...], List[int], float, int]]:
+        """Copy of every histogram, sorted by family and labels"""
+        with self.lock:
+            return sorted(
+                (family, labels, h.bounds, list(h.counts), h.sum, h.count)
+                for (family, labels), h in self.histograms.items()
+            )
+
+    def to_prometheus(self) -> str:
+        """All histograms in the Prometheus text exposition format"""
+        lines = []
+        current_family = None
+        for family, labels, bounds, counts, total, count in self.snapshot():
+            if family != current_family:
+                current_family = family
+                lines.append(f"# HELP {family} {METRIC_FAMILIES[family][0]}")
+                lines.append(f"# TYPE {family} histogram")
+            label_text = ",".join(
+                '{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                for name, value in labels
+            )
+            prefix = label_text + "," if label_text else ""
+            cumulative = 0
+            for bound, bucket_count in zip(list(bounds) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f'{family}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f"{family}_sum{{{label_text}}} {total}")
+            lines.append(f"{family}_count{{{label_text}}} {count}")
+        for name, (description, stats) in self.collect_stats().items():
+            for counter, value in stats.items():
+                gauge = f"pixel_{name}_{counter}"
+                lines.append(f"# HELP {gauge} {description}: {counter}")
+                lines.append(f"# TYPE {gauge} gauge")
+                lines.append(f"{gauge} {value}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> Dict:
+        """All histograms as a JSON-serializable dict"""
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "metrics": [
+                {
+                    "name": family,
+                    "labels": dict(labels),
+                    "buckets": dict(zip([str(bound) for bound in bounds] + ["+Inf"], counts)),
+                    "sum": total,
+                    "count": count
+                }
+                for family, labels, bounds, counts, total, count in self.snapshot()
+            ],
+            "stats": {name: stats for name, (description, stats) in self.collect_stats().items()}
+        }
+
+    def export(self):
+        """Write the current histograms out once"""
         try:
-            with open(CONVERSATIONS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
+            if self.export_format == "prometheus":
+                tmp_path = create_temp_file(self.path)
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(self.to_prometheus())
+                os.replace(tmp_path, self.path)
+            elif self.histograms or self.stats:
+                print(json.dumps(self.to_json()), flush=True)
+        except OSError:
+            pass
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+@st.cache_resource
+def get_metrics() -> MetricsRegistry:
+    """Return the process-wide metrics registry (only used when metrics are enabled)"""
+    registry = MetricsRegistry(METRICS_EXPORT, METRICS_FILE, METRICS_INTERVAL)
+    # Export whatever was recorded since the last interval on shutdown
+    atexit.register(registry.export)
+    return registry
+
+class Span:
+    """Times a block and records it in pixel_span_seconds"""
+
+    __slots__ = ("labels", "started")
+
+    def __init__(self, labels: Tuple[Tuple[str, str], ...]):
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        get_metrics().observe("pixel_span_seconds", time.perf_counter() - self.started, self.labels)
+
+class NullSpan:
+    """Stands in for Span when metrics are disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_SPAN = NullSpan()
+
+def metric_labels(span_name: Optional[str], labels: Dict) -> Tuple[Tuple[str, str], ...]:
+    """Histogram key labels: the span name first, then the rest sorted"""
+    pairs = tuple(sorted(
+        (name, str(value).lower() if isinstance(value, bool) else str(value))
+        for name, value in labels.items()
+    ))
+    return (("span", span_name),) + pairs if span_name else pairs
+
+def span(name: str, **labels) -> Union[Span, NullSpan]:
+    """Context manager timing one phase of a turn (free when metrics are disabled)"""
+    if not METRICS_ENABLED:
+        return NULL_SPAN
+    return Span(metric_labels(name, labels))
+
+def timed(name: str, **labels) -> Callable:
+    """Decorator form of ``span``; leaves the function untouched when metrics are disabled"""
+    def decorate(func: Callable) -> Callable:
+        if not METRICS_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def observe_span(name: str, seconds: float, **labels):
+    """Record a duration measured by the caller, e.g. time to first token"""
+    if METRICS_ENABLED:
+        get_metrics().observe("pixel_span_seconds", seconds, metric_labels(name, labels))
+
+def record_token_usage(usage, model: str, personality: str):
+    """Record the prompt and completion tokens reported in ``response.usage``"""
+    if not METRICS_ENABLED or usage is None:
+        return
+    metrics = get_metrics()
+    for kind, count in (("prompt", usage.prompt_tokens), ("completion", usage.completion_tokens)):
+        if count is not None:
+            metrics.observe("pixel_tokens", count, metric_labels(None, {"kind": kind, "model": model, "personality": personality}))
+
+def get_compression(data: bytes) -> Optional[str]:
+    """"gzip" or "zstd" if ``data`` starts with that format's magic number"""
+    if data.startswith(b"\x1f\x8b"):
+        return "gzip"
+    if data.startswith(b"\x28\xb5\x2f\xfd"):
+        return "zstd"
+    return None
+
+def get_block_codec(storage_format: str) -> Optional[str]:
+    """Compression used for ``storage_format``; zstd falls back to gzip when zstandard is missing"""
+    if storage_format == "zstd" and zstandard is not None:
+        return "zstd"
+    if storage_format in ("gzip", "zstd"):
+        return "gzip"
+    return None
+
+def compress_block(data: bytes, codec: str) -> bytes:
+    """Compress one block as a self-contained gzip member or zstd frame"""
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+def decompress_data(data: bytes) -> bytes:
+    """Decompress one or more concatenated gzip members or zstd frames"""
+    codec = get_compression(data)
+    if codec == "gzip":
+        return gzip.decompress(data)
+    if codec == "zstd":
+        if zstandard is None:
+            raise IOError("zstd-compressed history needs the zstandard package")
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True)
+        chunks = []
+        while True:
+            chunk = reader.read(1 << 20)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+    return data
+
+def read_conversations_snapshot(path: str) -> List[Dict]:
+    """Read a full conversation list from a snapshot or archive segment in any storage format"""
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            if get_compression(data):
+                # Compressed files hold one conversation per line
+                return [json.loads(line) for line in decompress_data(data).decode("utf-8").splitlines() if line]
+            return json.loads(data.decode("utf-8"))
+        except (json.JSONDecodeError, UnicodeDecodeError, EOFError, IOError, zlib.error):
             return []
     return []
 
-def save_conversations(conversations: List[Dict]):
-    """Save conversation history to JSON file"""
-    with open(CONVERSATIONS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(conversations, f, indent=2, ensure_ascii=False)
+def write_conversations_snapshot(path: str, conversations: List[Dict], storage_format: str = "compact") -> Dict[str, List[int]]:
+    """Write a conversation list in ``storage_format`` and fsync it.
+
+    Returns where every conversation is stored, so a single conversation can
+    later be read without parsing the rest: its byte offset and length for
+    JSON, or for compressed formats the offset and length of its block plus
+    its offset and length inside the decompressed block.
+    """
+    codec = get_block_codec(storage_format)
+    if codec:
+        return write_compressed_conversations(path, conversations, codec)
+    spans = {}
+    indent, separators = (2, None) if storage_format == "pretty" else (None, (",", ":"))
+    with open(path, 'wb') as f:
+        f.write(b"[\n")
+        offset = 2
+        for i, conv in enumerate(conversations):
+            if i:
+                f.write(b",\n")
+                offset += 2
+            data = json.dumps(conv, indent=indent, separators=separators, ensure_ascii=False).encode("utf-8")
+            spans[conv.get("id")] = [offset, len(data)]
+            f.write(data)
+            offset += len(data)
+        f.write(b"\n]\n")
+        f.flush()
+        os.fsync(f.fileno())
+    return spans
+
+def write_compressed_conversations(path: str, conversations: List[Dict], codec: str) -> Dict[str, List[int]]:
+    """Write conversations as compressed JSON lines, COMPRESSION_BLOCK_BYTES per block"""
+    spans = {}
+    block = bytearray()
+    members = []
+    with open(path, 'wb') as f:
+        def flush_block():
+            data = compress_block(bytes(block), codec)
+            offset = f.tell()
+            f.write(data)
+            for conv_id, start, length in members:
+                spans[conv_id] = [offset, len(data), start, length]
+            block.clear()
+            members.clear()
+
+        for conv in conversations:
+            line = json.dumps(conv, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+            members.append((conv.get("id"), len(block), len(line)))
+            block.extend(line + b"\n")
+            if len(block) >= COMPRESSION_BLOCK_BYTES:
+                flush_block()
+        if block:
+            flush_block()
+        f.flush()
+        os.fsync(f.fileno())
+    return spans
+
+def read_conversation_span(path: str, span: List[int]) -> Dict:
+    """Read one conversation from a file written by write_conversations_snapshot()"""
+    with open(path, 'rb') as f:
+        f.seek(span[0])
+        data = f.read(span[1])
+    if len(span) == 4:
+        data = decompress_data(data)[span[2]:span[2] + span[3]]
+    return json.loads(data.decode("utf-8"))
+
+class ConversationFileReader:
+    """Reads conversations by span like read_conversation_span(), for many reads in a row.
+
+    A few files are kept open, and the last decompressed block is kept, so
+    a run of conversations stored in the same block decompresses it once.
+    Files are keyed by path and a version (e.g. the snapshot's signature),
+    so a replaced file is reopened rather than read at stale offsets.
+    """
+
+    # Files kept open at once
+    MAX_OPEN_FILES = 8
+
+    def __init__(self):
+        self.files = OrderedDict()
+        self.block_key = None
+        self.block = b""
+
+    def read(self, path: str, span: List[int], version=None) -> Dict:
+        key = (path, repr(version))
+        f = self.files.get(key)
+        if f is None:
+            f = open(path, 'rb')
+            self.files[key] = f
+            if len(self.files) > self.MAX_OPEN_FILES:
+                self.files.popitem(last=False)[1].close()
+        self.files.move_to_end(key)
+        if len(span) == 4:
+            if self.block_key != (key, span[0]):
+                f.seek(span[0])
+                self.block = decompress_data(f.read(span[1]))
+                self.block_key = (key, span[0])
+            data = self.block[span[2]:span[2] + span[3]]
+        else:
+            f.seek(span[0])
+            data = f.read(span[1])
+        return json.loads(data.decode("utf-8"))
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+        self.block_key = None
+        self.block = b""
+
+def get_file_signature(path: str) -> Optional[List[int]]:
+    """Size and modification time identifying one version of a file"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def create_temp_file(path: str) -> str:
+    """Create an empty temp file next to ``path``, unique across threads and processes, for an atomic replace"""
+    fd, tmp_path = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    os.close(fd)
+    # mkstemp makes the file private to its owner; keep the usual permissions once it replaces ``path``
+    os.chmod(tmp_path, 0o644)
+    return tmp_path
+
+def write_json_atomic(path: str, data, indent: Optional[int] = 2):
+    """Atomically write a JSON file (temp file + rename) so readers never see a partial file"""
+    tmp_path = create_temp_file(path)
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=indent, separators=None if indent else (",", ":"), ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def format_conversation_title(content: str) -> str:
+    """Conversation title from its first user message"""
+    title = content.strip()[:40]
+    if len(content.strip()) > 40:
+        title += "..."
+    return title
+
+def extend_conversation_metadata(metadata: Dict, new_messages: List[Dict], timestamp: str) -> Dict:
+    """Metadata after appending ``new_messages`` to a conversation"""
+    metadata = dict(metadata)
+    for message in new_messages:
+        role = message.get("role")
+        content = message.get("content") or ""
+        metadata["message_count"] += 1
+        metadata["bytes"] += len(content.encode("utf-8"))
+        if role == "user":
+            metadata["user_count"] += 1
+            if not metadata["title"]:
+                metadata["title"] = format_conversation_title(content)
+        elif role == "assistant":
+            metadata["assistant_count"] += 1
+    metadata["updated"] = timestamp
+    return metadata
+
+def build_conversation_metadata(messages: List[Dict], timestamp: str) -> Dict:
+    """Title, message counts, size and last update time of a conversation"""
+    metadata = {
+        "title": "",
+        "message_count": 0,
+        "user_count": 0,
+        "assistant_count": 0,
+        "bytes": 0,
+        "updated": timestamp
+    }
+    return extend_conversation_metadata(metadata, messages, timestamp)
+
+def update_conversation_metadata(metadata: Optional[Dict], messages: List[Dict], start: int, timestamp: str) -> Dict:
+    """Metadata after the messages from ``start`` onwards were written.
+
+    Appends (the common case) only look at the new messages; anything else
+    recomputes from the full message list.
+    """
+    if metadata is not None and metadata.get("message_count") == start:
+        return extend_conversation_metadata(metadata, messages[start:], timestamp)
+    return build_conversation_metadata(messages, timestamp)
+
+def tokenize_search_text(text: str) -> List[str]:
+    """Lower-cased words of a message or search query"""
+    return re.findall(r"\w+", text.lower())
+
+class ConversationSearchIndex:
+    """In-memory inverted index over message text, ranked with BM25.
+
+    Each conversation is one document. Appended messages are added to the
+    postings as they are saved; a conversation whose earlier messages
+    changed is re-indexed from scratch.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        # term -> {conversation id: term frequency}
+        self.postings = {}
+        # conversation id -> distinct terms / number of words / number of messages indexed
+        self.terms = {}
+        self.lengths = {}
+        self.indexed = {}
+        self.total_length = 0
+
+    def update(self, conversation_id: str, messages: List[Dict], start: int):
+        """Index a conversation whose messages from ``start`` onwards were written"""
+        if self.indexed.get(conversation_id, 0) != start:
+            self.remove(conversation_id)
+            start = 0
+        new_terms = Counter(tokenize_search_text("\n".join(m.get("content") or "" for m in messages[start:])))
+        self.terms.setdefault(conversation_id, set()).update(new_terms)
+        for term, count in new_terms.items():
+            postings = self.postings.setdefault(term, {})
+            postings[conversation_id] = postings.get(conversation_id, 0) + count
+        length = sum(new_terms.values())
+        self.lengths[conversation_id] = self.lengths.get(conversation_id, 0) + length
+        self.total_length += length
+        self.indexed[conversation_id] = len(messages)
+
+    def remove(self, conversation_id: str):
+        """Drop a conversation from the index"""
+        for term in self.terms.pop(conversation_id, {}):
+            postings = self.postings[term]
+            del postings[conversation_id]
+            if not postings:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(conversation_id, 0)
+        self.indexed.pop(conversation_id, None)
+
+    def search(self, query: str, limit: int) -> List[str]:
+        """Ids of conversations containing every query word, best match first"""
+        terms = set(tokenize_search_text(query))
+        if not terms or not self.terms:
+            return []
+        postings = [self.postings.get(term, {}) for term in terms]
+        postings.sort(key=len)
+        matches = [conv_id for conv_id in postings[0] if all(conv_id in p for p in postings[1:])]
+        
+        doc_count = len(self.terms)
+        average_length = self.total_length / doc_count or 1.0
+        scores = {}
+        for conv_id in matches:
+            length = self.lengths[conv_id]
+            score = 0.0
+            for p in postings:
+                idf = math.log(1 + (doc_count - len(p) + 0.5) / (len(p) + 0.5))
+                tf = p[conv_id]
+                score += idf * tf * (self.K1 + 1) / (tf + self.K1 * (1 - self.B + self.B * length / average_length))
+            scores[conv_id] = score
+        return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+def apply_journal_record(conversations: Dict[str, Dict], record: Dict):
+    """Apply one journal record to an id -> conversation mapping.
+
+    Upserts replace the message tail from ``start`` onwards, so replaying a
+    record that is already reflected in the snapshot is harmless.
+    """
+    conv_id = record.get("id")
+    if record.get("op") == "delete":
+        conversations.pop(conv_id, None)
+    elif record.get("op") == "upsert":
+        conv = conversations.get(conv_id)
+        if conv is None:
+            conv = {"id": conv_id, "timestamp": record.get("timestamp"), "messages": []}
+            conversations[conv_id] = conv
+        start = record.get("start", 0)
+        conv["messages"] = conv.get("messages", [])[:start] + record.get("messages", [])
+        conv["timestamp"] = record.get("timestamp", conv.get("timestamp"))
+        conv["metadata"] = update_conversation_metadata(conv.get("metadata"), conv["messages"], start, conv["timestamp"])
+    elif record.get("op") == "put":
+        # A whole conversation replacing any earlier one, as written by an import
+        conversations[conv_id] = dict(record.get("conversation") or {}, id=conv_id)
+    elif record.get("op") == "summary":
+        conv = conversations.get(conv_id)
+        if conv is not None:
+            conv["summary"] = record.get("summary")
+
+def read_journal_records(path: str, offset: int = 0) -> Iterator[Tuple[Dict, int]]:
+    """Yield every complete record after ``offset`` in a journal file, with the offset just past it"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # Torn write from a crash mid-append, or an append still in progress
+                break
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                # Torn write from a crash mid-append - nothing after it was acknowledged
+                break
+            offset += len(line)
+            yield record, offset
+
+def read_journal_conversation(location: List, files: Optional[Dict[str, io.BufferedReader]] = None) -> Dict:
+    """The conversation put by the journal record at ``location`` (path, offset, length).
+
+    ``files`` maps journal paths to files already open on them, which are
+    read instead of opening the path again.
+    """
+    path, offset, length = location
+    f = files.get(path) if files else None
+    if f is not None:
+        f.seek(offset)
+        data = f.read(length)
+    else:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+    record = json.loads(data.decode("utf-8"))
+    conversations = {}
+    apply_journal_record(conversations, record)
+    return conversations[record.get("id")]
+
+class JsonConversationStore:
+    """Conversation storage as a JSON snapshot plus an append-only journal.
+
+    Each saved turn appends one JSONL record, so the per-turn cost does not
+    depend on how much history is stored. Once the journal grows past
+    ``compact_bytes`` it is rotated and folded into the snapshot on a
+    background thread.
+
+    Next to the snapshot, a small index file holds every conversation's
+    header (id, timestamp, metadata) and its byte span in the snapshot.
+    Listing conversations reads only the index; opening one reads only its
+    span, plus any changes made since in the journal.
+
+    Writes made by another process are picked up on the next access: a new
+    snapshot (size or mtime changed) triggers a full reload, while records
+    appended to the journal past the last offset read are replayed on top.
+    ``generation`` counts these outside changes.
+
+    Full-text search uses a ConversationSearchIndex built on the first
+    search and then kept current by every applied journal record. The
+    build reads the history without holding the lock, so saves go on
+    meanwhile; the conversations they change are noted and re-indexed when
+    the new index is swapped in.
+
+    With ``archive_after_days`` set, compaction moves conversations not
+    updated for that long out of the snapshot into compressed, immutable
+    segment files in ``archive_dir``, listed in its catalog. They are still
+    listed and open like any other conversation; one that changes again
+    moves back into the snapshot at the next compaction. A conversation
+    found in both the snapshot and the catalog (after a crash between the
+    two writes) is taken from the snapshot.
+
+    Imports append whole conversations to the journal in batches. Until the
+    next compaction only their place in the journal is kept in memory, not
+    their messages, and compaction streams the snapshot through one
+    conversation at a time, so an import of any size doesn't pile up in
+    memory.
+    """
+
+    # Seconds between checks for conversations that are due for archiving
+    ARCHIVE_CHECK_INTERVAL = 3600
+
+    def __init__(self, snapshot_file: str, index_file: str, journal_file: str, compact_bytes: int,
+                 storage_format: str = "compact", archive_dir: Optional[str] = None, archive_after_days: float = 0):
+        self.snapshot_file = snapshot_file
+        self.index_file = index_file
+        self.journal_file = journal_file
+        self.rotated_journal_file = f"{journal_file}.compacting"
+        self.compact_bytes = compact_bytes
+        self.storage_format = storage_format
+        self.archive_dir = archive_dir
+        self.catalog_file = os.path.join(archive_dir, "catalog.json") if archive_dir else None
+        self.archive_after_days = archive_after_days
+        self.next_archive_check = 0.0
+        self.lock = threading.Lock()
+        self.compacting = False
+        # Loaded on first use: id -> header, id -> snapshot span, id -> body changed since the snapshot
+        # (or the journal location of an imported one), id -> catalog entry of an archived conversation
+        self.headers = None
+        self.spans = {}
+        self.touched = {}
+        self.archive = {}
+        # What has been read so far, to notice writes from other processes
+        self.snapshot_signature = None
+        self.journal_offset = 0
+        self.generation = 0
+        self.search_index = None
+        # Ids changed while a search index is being built, or None; one build runs at a time
+        self.search_pending = None
+        self.search_build_lock = threading.Lock()
+
+    @staticmethod
+    def header_of(conv: Dict) -> Dict:
+        """The part of a conversation that is listed without opening it"""
+        metadata = conv.get("metadata") or build_conversation_metadata(conv.get("messages", []), conv.get("timestamp", ""))
+        return {"id": conv.get("id"), "timestamp": conv.get("timestamp"), "metadata": metadata}
+
+    def prepare_snapshot(self, conversations: Iterable[Dict]) -> Tuple[str, Dict]:
+        """Write a new snapshot to a temp file and build its index, consuming ``conversations`` once"""
+        tmp_path = create_temp_file(self.snapshot_file)
+        headers = []
+
+        def listed():
+            for conv in conversations:
+                headers.append(self.header_of(conv))
+                yield conv
 
-def load_preferences() -> Dict:
-    """Load user preferences from JSON file"""
-    if os.path.exists(PREFERENCES_FILE):
         try:
-            with open(PREFERENCES_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            spans = write_conversations_snapshot(tmp_path, listed(), self.storage_format)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        index = {
+            "snapshot": get_file_signature(tmp_path),
+            "conversations": [dict(header, span=spans[header["id"]]) for header in headers]
+        }
+        return tmp_path, index
+
+    def install_snapshot(self, tmp_path: str, index: Dict):
+        """Move a prepared snapshot into place, then its index.
+
+        A crash between the two leaves an index whose signature no longer
+        matches the snapshot; it is rebuilt on the next load.
+        """
+        os.replace(tmp_path, self.snapshot_file)
+        write_json_atomic(self.index_file, index, indent=2 if self.storage_format == "pretty" else None)
+
+    def read_catalog(self) -> Dict[str, Dict]:
+        """Archived conversations: id -> header plus segment file and span"""
+        if not self.catalog_file or not os.path.exists(self.catalog_file):
+            return {}
+        try:
+            with open(self.catalog_file, 'r', encoding='utf-8') as f:
+                return {entry["id"]: entry for entry in json.load(f)}
         except (json.JSONDecodeError, IOError):
             return {}
-    return {}
+
+    def is_archivable(self, header: Dict, cutoff: str) -> bool:
+        """Whether a conversation was last updated before ``cutoff`` (an ISO timestamp)"""
+        return ((header.get("metadata") or {}).get("updated") or header.get("timestamp") or "") < cutoff
+
+    def archive_cutoff(self) -> Optional[str]:
+        """Conversations last updated before this timestamp belong in the archive"""
+        if not self.archive_dir or self.archive_after_days <= 0:
+            return None
+        return (datetime.now() - timedelta(days=self.archive_after_days)).isoformat()
+
+    def archive_due(self) -> bool:
+        """Whether the snapshot holds conversations old enough to archive (call with the lock held)"""
+        cutoff = self.archive_cutoff()
+        if cutoff is None or time.monotonic() < self.next_archive_check:
+            return False
+        self.next_archive_check = time.monotonic() + self.ARCHIVE_CHECK_INTERVAL
+        return any(self.is_archivable(self.headers[conv_id], cutoff) for conv_id in self.spans if conv_id in self.headers)
+
+    def write_catalog(self, archive: Dict[str, Dict]):
+        """Atomically replace the archive catalog"""
+        if self.catalog_file and (archive or os.path.exists(self.catalog_file)):
+            os.makedirs(self.archive_dir, exist_ok=True)
+            write_json_atomic(self.catalog_file, list(archive.values()), indent=None)
+
+    def write_tiers(self, conversations: Callable[[], Iterable[Dict]], archive: Dict[str, Dict]) -> Tuple[str, Dict]:
+        """Move conversations due for archiving into a new segment, then prepare the snapshot of the rest.
+
+        ``conversations`` returns a fresh iterable on each call; it is
+        streamed through once for the segment and once for the snapshot, so
+        only one conversation at a time needs to be in memory. ``archive``
+        holds the catalog entries to keep and receives the new ones. Before
+        the snapshot is prepared, the new entries are added to the catalog
+        on disk; entries that were dropped stay listed until the caller
+        writes the final catalog once the new snapshot is installed, so a
+        crash in between never loses a conversation. Returns what
+        install_snapshot() needs.
+        """
+        cutoff = self.archive_cutoff()
+        archived = {}
+        if cutoff is not None:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            # Segments are always compressed, with zstd if that is the configured format
+            codec = get_block_codec(self.storage_format) or "gzip"
+            extension = "zst" if codec == "zstd" else "gz"
+            segment = f"segment-{datetime.now().strftime('%Y%m%d%H%M%S')}-{secrets.token_hex(4)}.jsonl.{extension}"
+            segment_path = os.path.join(self.archive_dir, segment)
+
+            def due():
+                for conv in conversations():
+                    header = self.header_of(conv)
+                    if self.is_archivable(header, cutoff):
+                        archived[header["id"]] = header
+                        yield conv
+
+            spans = write_conversations_snapshot(segment_path, due(), codec)
+            if archived:
+                for conv_id, header in archived.items():
+                    archive[conv_id] = dict(header, segment=segment, span=spans[conv_id])
+                self.write_catalog(dict(self.read_catalog(), **archive))
+            else:
+                os.remove(segment_path)
+        return self.prepare_snapshot(conv for conv in conversations() if conv.get("id") not in archived)
+
+    def remove_unused_segments(self):
+        """Delete segment files no catalog entry points to any more"""
+        if not self.archive_dir or not os.path.isdir(self.archive_dir):
+            return
+        used = {entry["segment"] for entry in self.archive.values()}
+        for name in os.listdir(self.archive_dir):
+            path = os.path.join(self.archive_dir, name)
+            # Leave recent files alone: another process may be about to list them in the catalog
+            if name.startswith("segment-") and name not in used and time.time() - os.path.getmtime(path) > 3600:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def read_archived(self, entry: Dict) -> Dict:
+        """Body of an archived conversation"""
+        return read_conversation_span(os.path.join(self.archive_dir, entry["segment"]), entry["span"])
+
+    def read_all_bodies(self, archive: Dict[str, Dict]) -> Dict[str, Dict]:
+        """Every stored body (snapshot and the ``archive`` catalog entries, without journal changes), by id"""
+        bodies = {}
+        for segment in sorted({entry["segment"] for entry in archive.values()}):
+            for conv in read_conversations_snapshot(os.path.join(self.archive_dir, segment)):
+                entry = archive.get(conv.get("id"))
+                if entry is not None and entry["segment"] == segment:
+                    bodies[conv.get("id")] = conv
+        for conv in read_conversations_snapshot(self.snapshot_file):
+            bodies[conv.get("id")] = conv
+        return bodies
+
+    def load_state(self):
+        """Read the index (rebuilding it if stale) and replay the journals"""
+        index = None
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    index = json.load(f)
+            except (json.JSONDecodeError, IOError):
+                index = None
+        if index is None or index.get("snapshot") != get_file_signature(self.snapshot_file):
+            # Missing, stale or pre-index snapshot: parse it once and rewrite it with spans
+            conversations = read_conversations_snapshot(self.snapshot_file)
+            index = {"conversations": []}
+            if conversations:
+                tmp_path, index = self.prepare_snapshot(conversations)
+                self.install_snapshot(tmp_path, index)
+        
+        self.headers = OrderedDict()
+        self.spans = {}
+        self.touched = {}
+        self.search_index = None
+        self.search_pending = None
+        hot_ids = {entry["id"] for entry in index["conversations"]}
+        # The snapshot wins over a stale catalog entry
+        self.archive = {conv_id: entry for conv_id, entry in self.read_catalog().items() if conv_id not in hot_ids}
+        for entry in list(self.archive.values()) + index["conversations"]:
+            self.headers[entry["id"]] = {"id": entry["id"], "timestamp": entry["timestamp"], "metadata": entry["metadata"]}
+        for entry in index["conversations"]:
+            self.spans[entry["id"]] = entry["span"]
+        start = 0
+        for record, end in read_journal_records(self.rotated_journal_file):
+            self.apply(record, [self.rotated_journal_file, start, end - start])
+            start = end
+        self.journal_offset = 0
+        self.replay_journal()
+        self.snapshot_signature = get_file_signature(self.snapshot_file)
+
+    def replay_journal(self):
+        """Apply the live journal records past ``journal_offset`` (call with the lock held)"""
+        for record, offset in read_journal_records(self.journal_file, self.journal_offset):
+            self.apply(record, [self.journal_file, self.journal_offset, offset - self.journal_offset])
+            self.journal_offset = offset
+
+    def ensure_loaded(self):
+        """Load the state on first use and catch up with writes from other processes"""
+        if self.headers is None:
+            self.load_state()
+            if self.archive_due() and not self.compacting:
+                self.compacting = True
+                threading.Thread(target=self.compact, name="conversation-compaction", daemon=True).start()
+            return
+        journal_size = (get_file_signature(self.journal_file) or [0])[0]
+        if get_file_signature(self.snapshot_file) != self.snapshot_signature or journal_size < self.journal_offset:
+            self.load_state()
+            self.generation += 1
+        elif journal_size > self.journal_offset:
+            offset = self.journal_offset
+            self.replay_journal()
+            # A torn tail alone is not a change
+            if self.journal_offset != offset:
+                self.generation += 1
+
+    def check_external_changes(self) -> int:
+        """Pick up writes from other processes; returns ``generation``"""
+        with self.lock:
+            self.ensure_loaded()
+            return self.generation
+
+    def touched_body(self, conversation_id: str) -> Optional[Dict]:
+        """Body changed since the snapshot, read back from the journal if only its location is kept"""
+        body = self.touched.get(conversation_id)
+        if isinstance(body, list):
+            return read_journal_conversation(body)
+        return body
+
+    def body(self, conversation_id: str, reader: Optional[ConversationFileReader] = None) -> Optional[Dict]:
+        """Current full record of a conversation (call with the lock held)"""
+        if conversation_id in self.touched:
+            return self.touched_body(conversation_id)
+        if conversation_id in self.spans:
+            if reader is not None:
+                return reader.read(self.snapshot_file, self.spans[conversation_id], self.snapshot_signature)
+            return read_conversation_span(self.snapshot_file, self.spans[conversation_id])
+        if conversation_id in self.archive:
+            entry = self.archive[conversation_id]
+            if reader is not None:
+                return reader.read(os.path.join(self.archive_dir, entry["segment"]), entry["span"])
+            return self.read_archived(entry)
+        return None
+
+    def apply(self, record: Dict, location: Optional[List] = None):
+        """Apply a journal record to the in-memory index (call with the lock held).
+
+        ``location`` is where the record is in the journal (path, offset,
+        length); conversations put whole are then kept only as that location.
+        """
+        conv_id = record.get("id")
+        if record.get("op") == "delete":
+            self.headers.pop(conv_id, None)
+            self.spans.pop(conv_id, None)
+            self.touched.pop(conv_id, None)
+            if self.search_index is not None:
+                self.search_index.remove(conv_id)
+            if self.search_pending is not None:
+                self.search_pending.add(conv_id)
+            return
+        conv = self.body(conv_id) if conv_id in self.headers and record.get("op") != "put" else None
+        if conv is None and record.get("op") not in ("upsert", "put"):
+            return
+        conversations = {conv_id: conv} if conv is not None else {}
+        apply_journal_record(conversations, record)
+        self.touched[conv_id] = location if record.get("op") == "put" and location else conversations[conv_id]
+        if record.get("op") in ("upsert", "put"):
+            self.headers[conv_id] = self.header_of(conversations[conv_id])
+            if self.search_index is not None:
+                self.search_index.update(conv_id, conversations[conv_id].get("messages", []), record.get("start", 0))
+            if self.search_pending is not None:
+                self.search_pending.add(conv_id)
+
+    def list_headers(self) -> List[Dict]:
+        """Headers of every conversation in creation order, without messages"""
+        with self.lock:
+            self.ensure_loaded()
+            return [dict(header) for header in self.headers.values()]
+
+    def search(self, query: str, limit: int) -> List[str]:
+        """Ids of conversations matching ``query``, best match first"""
+        with self.lock:
+            self.ensure_loaded()
+            if self.search_index is not None:
+                return self.search_index.search(query, limit)
+        with self.search_build_lock:
+            return self.build_search_index().search(query, limit)
+
+    def build_search_index(self) -> ConversationSearchIndex:
+        """Build the search index in one pass over the history, mostly without holding the lock.
+
+        What is stored is listed under the lock (opening the journals its
+        locations point into, which a compaction may rename) and read
+        outside it. Saves applied meanwhile are collected in
+        ``search_pending`` and re-indexed from their current bodies when the
+        index is swapped in. A reload (which clears ``search_pending``) or a
+        file replaced while it was read means starting over; if that keeps
+        happening the index is built under the lock instead. After that,
+        writes update it incrementally. Call with ``search_build_lock`` held.
+        """
+        for attempt in range(3):
+            with self.lock:
+                self.ensure_loaded()
+                if self.search_index is not None:
+                    return self.search_index
+                pending = self.search_pending = set()
+                conv_ids = list(self.headers)
+                touched = dict(self.touched)
+                archive = dict(self.archive)
+                journals = {path: open(path, 'rb') for path in {body[0] for body in touched.values() if isinstance(body, list)}}
+            try:
+                index = self.index_bodies(conv_ids, touched, archive, journals)
+            except (OSError, ValueError):
+                continue
+            finally:
+                for f in journals.values():
+                    f.close()
+            with self.lock:
+                if self.search_pending is not pending:
+                    continue
+                self.search_pending = None
+                for conv_id in pending:
+                    conv = self.body(conv_id) if conv_id in self.headers else None
+                    if conv is None:
+                        index.remove(conv_id)
+                    else:
+                        index.update(conv_id, conv.get("messages", []), 0)
+                self.search_index = index
+                return index
+        with self.lock:
+            self.ensure_loaded()
+            if self.search_index is None:
+                self.search_pending = None
+                self.search_index = self.index_bodies(list(self.headers), self.touched, self.archive)
+            return self.search_index
+
+    def index_bodies(self, conv_ids: List[str], touched: Dict, archive: Dict[str, Dict],
+                     journals: Optional[Dict[str, io.BufferedReader]] = None) -> ConversationSearchIndex:
+        """A search index of the given conversations, read from ``touched`` or else the snapshot and ``archive``"""
+        index = ConversationSearchIndex()
+        snapshot = self.read_all_bodies(archive)
+        for conv_id in conv_ids:
+            body = touched.get(conv_id)
+            conv = (read_journal_conversation(body, journals) if isinstance(body, list) else body) or snapshot.get(conv_id)
+            if conv is not None:
+                index.update(conv_id, conv.get("messages", []), 0)
+        return index
+
+    def load_all(self) -> List[Dict]:
+        """Load every conversation, including messages, in creation order"""
+        with self.lock:
+            self.ensure_loaded()
+            snapshot = self.read_all_bodies(self.archive)
+            conversations = []
+            for conv_id, header in self.headers.items():
+                conv = self.touched_body(conv_id) or snapshot.get(conv_id)
+                conv = dict(conv, messages=list(conv.get("messages", [])), metadata=header["metadata"])
+                conversations.append(conv)
+        return conversations
+
+    def get(self, conversation_id: str) -> Optional[Dict]:
+        """Load one conversation by id"""
+        with self.lock:
+            self.ensure_loaded()
+            if conversation_id not in self.headers:
+                return None
+            conv = self.body(conversation_id)
+            return dict(conv, messages=list(conv.get("messages", [])), metadata=self.headers[conversation_id]["metadata"])
+
+    def save_all(self, conversations: List[Dict]):
+        """Replace the stored history with ``conversations``"""
+        with self.lock:
+            archive = {}
+            by_id = {conv.get("id"): conv for conv in conversations}
+            tmp_path, index = self.write_tiers(by_id.values, archive)
+            self.install_snapshot(tmp_path, index)
+            self.write_catalog(archive)
+            for path in (self.rotated_journal_file, self.journal_file):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.load_state()
+            self.remove_unused_segments()
+
+    def append(self, record: Dict):
+        """Durably append one record to the journal"""
+        self.append_records([record])
+
+    def append_records(self, records: List[Dict]):
+        """Durably append records to the journal with a single write and fsync"""
+        lines = [(json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8") for record in records]
+        with self.lock:
+            self.ensure_loaded()
+            data = b"".join(lines)
+            with open(self.journal_file, 'ab') as f:
+                if f.tell() > self.journal_offset:
+                    # Cut off a record torn by a crash, or the new ones would be unreadable after it
+                    f.truncate(self.journal_offset)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                journal_size = f.tell()
+            offset = journal_size - len(data)
+            for record, line in zip(records, lines):
+                self.apply(record, [self.journal_file, offset, len(line)])
+                offset += len(line)
+            self.journal_offset = journal_size
+            should_compact = (journal_size >= self.compact_bytes or self.archive_due()) and not self.compacting
+            if should_compact:
+                self.compacting = True
+        if should_compact:
+            threading.Thread(target=self.compact, name="conversation-compaction", daemon=True).start()
+
+    def upsert_messages(self, conversation_id: str, timestamp: str, start: int, messages: List[Dict]):
+        """Record the messages of a conversation from index ``start`` onwards"""
+        self.append({
+            "op": "upsert",
+            "id": conversation_id,
+            "timestamp": timestamp,
+            "start": start,
+            "messages": messages
+        })
+
+    def set_summary(self, conversation_id: str, summary: Dict):
+        """Record a new running summary for a conversation"""
+        self.append({"op": "summary", "id": conversation_id, "summary": summary})
+
+    def delete(self, conversation_id: str):
+        """Record the deletion of a conversation"""
+        self.append({"op": "delete", "id": conversation_id})
+
+    def import_conversations(self, conversations: List[Dict]):
+        """Store whole conversations, replacing any with the same id, in one journal write"""
+        self.append_records([{"op": "put", "id": conv["id"], "conversation": conv} for conv in conversations])
+
+    def iter_bodies(self, conversation_ids: Iterable[str]) -> Iterator[Dict]:
+        """Stream the conversations with the given ids one at a time, skipping deleted ones.
+
+        The lock is only held while each one is read, so chats keep saving
+        during a long export.
+        """
+        reader = ConversationFileReader()
+        try:
+            for conv_id in conversation_ids:
+                with self.lock:
+                    self.ensure_loaded()
+                    if conv_id not in self.headers:
+                        continue
+                    conv = self.body(conv_id, reader)
+                    conv = dict(conv, metadata=self.headers[conv_id]["metadata"])
+                yield conv
+        finally:
+            reader.close()
+
+    def compact(self):
+        """Fold the journal into the snapshot and archive conversations that are due.
+
+        The live journal is renamed aside so appends continue while the new
+        snapshot is built. A crash at any point leaves either the old snapshot
+        plus the rotated journal, or the new snapshot plus a rotated journal
+        whose replay is a no-op.
+
+        Only the conversations the journal changed are held in memory (and
+        of those put whole by an import, only their journal location); the
+        rest are copied from the old snapshot one at a time.
+        """
+        reader = ConversationFileReader()
+        try:
+            with self.lock:
+                self.compacting = True
+                self.ensure_loaded()
+                # A leftover rotated journal from an interrupted compaction is folded first
+                if not os.path.exists(self.rotated_journal_file):
+                    if not os.path.exists(self.journal_file) and self.archive_cutoff() is None:
+                        return
+                    if os.path.exists(self.journal_file):
+                        os.replace(self.journal_file, self.rotated_journal_file)
+                        # Everything read so far now lives in the rotated journal
+                        self.journal_offset = 0
+                        for conv_id, body in self.touched.items():
+                            if isinstance(body, list) and body[0] == self.journal_file:
+                                self.touched[conv_id] = [self.rotated_journal_file] + body[1:]
+                archive = dict(self.archive)
+                spans = dict(self.spans)
+                signature = self.snapshot_signature
+
+            def stored(conv_id: str, entry: Optional[Dict]) -> Optional[Dict]:
+                if conv_id in spans:
+                    return reader.read(self.snapshot_file, spans[conv_id], signature)
+                if entry is not None:
+                    return reader.read(os.path.join(self.archive_dir, entry["segment"]), entry["span"])
+                return None
+
+            def resolve(body) -> Optional[Dict]:
+                return read_journal_conversation(body) if isinstance(body, list) else body
+
+            # id -> folded body, journal location of a put, or None once deleted
+            changed = {}
+            start = 0
+            for record, end in read_journal_records(self.rotated_journal_file):
+                conv_id = record.get("id")
+                # Archived conversations that changed or were deleted leave the archive
+                entry = archive.pop(conv_id, None)
+                if record.get("op") == "put":
+                    changed[conv_id] = [self.rotated_journal_file, start, end - start]
+                else:
+                    conv = resolve(changed[conv_id]) if conv_id in changed else stored(conv_id, entry)
+                    conversations = {conv_id: conv} if conv is not None else {}
+                    apply_journal_record(conversations, record)
+                    changed[conv_id] = conversations.get(conv_id)
+                start = end
+
+            def folded() -> Iterator[Dict]:
+                for conv_id, span in spans.items():
+                    conv = resolve(changed[conv_id]) if conv_id in changed else reader.read(self.snapshot_file, span, signature)
+                    if conv is not None:
+                        yield conv
+                for conv_id, body in changed.items():
+                    if conv_id not in spans and body is not None:
+                        yield resolve(body)
+
+            tmp_path, index = self.write_tiers(folded, archive)
+            with self.lock:
+                self.install_snapshot(tmp_path, index)
+                self.write_catalog(archive)
+                if os.path.exists(self.rotated_journal_file):
+                    os.remove(self.rotated_journal_file)
+                # Spans changed; reload them and replay what was appended meanwhile.
+                # The conversations themselves didn't, so the search index (or one being built) stays valid.
+                search_index, search_pending = self.search_index, self.search_pending
+                self.load_state()
+                self.search_index, self.search_pending = search_index, search_pending
+                self.remove_unused_segments()
+        except OSError:
+            # Leave the files as they are; the next compaction picks them up again
+            pass
+        finally:
+            reader.close()
+            self.compacting = False
+
+class SqliteConversationStore:
+    """Conversation storage in a SQLite database running in WAL mode.
+
+    Conversations and messages live in separate tables keyed by conversation
+    id, so reading, updating or deleting one conversation never touches the
+    rest of the history. WAL lets every session read while one writes.
+
+    Every write transaction bumps a version number in the meta table;
+    ``generation`` counts versions written by other processes.
+
+    Message text is also indexed in an FTS5 table, maintained in the same
+    transactions as the messages. Its rowid packs the conversation's rowid
+    and the message position, so a conversation's entries form one rowid
+    range that can be replaced or deleted without a scan.
+    """
+
+    # Messages per conversation addressable in the FTS rowid
+    FTS_ROWID_STRIDE = 1 << 20
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            timestamp TEXT NOT NULL,
+            summary TEXT,
+            metadata TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations (timestamp);
+        CREATE TABLE IF NOT EXISTS messages (
+            conversation_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            PRIMARY KEY (conversation_id, position)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    # Connections kept open between uses; more are opened while others are busy
+    MAX_IDLE_CONNECTIONS = 4
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.pool_lock = threading.Lock()
+        self.idle = []
+        self.closed = False
+        self.generation = 0
+        with self.connection() as conn:
+            conn.executescript(self.SCHEMA)
+            # Databases created before rolling summaries lack the summary column
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(conversations)")]
+            if "summary" not in columns:
+                conn.execute("ALTER TABLE conversations ADD COLUMN summary TEXT")
+            # ... and the metadata index, which is backfilled once
+            if "metadata" not in columns:
+                conn.execute("ALTER TABLE conversations ADD COLUMN metadata TEXT")
+                for conv_id, timestamp in conn.execute("SELECT id, timestamp FROM conversations").fetchall():
+                    metadata = build_conversation_metadata(self.read_messages(conn, conv_id), timestamp)
+                    conn.execute(
+                        "UPDATE conversations SET metadata = ? WHERE id = ?",
+                        (json.dumps(metadata, ensure_ascii=False), conv_id)
+                    )
+            self.fts = self.create_search_table(conn)
+            self.version = self.read_version(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Borrow an idle connection, or open one, for the duration of a ``with`` block.
+
+        Streamlit runs every rerun on a new thread, so connections are pooled
+        rather than kept per thread; a connection is only used by one thread
+        at a time.
+        """
+        with self.pool_lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            # Autocommit mode; write transactions are opened explicitly below
+            conn = sqlite3.connect(self.db_file, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            with self.pool_lock:
+                if not self.closed and len(self.idle) < self.MAX_IDLE_CONNECTIONS:
+                    self.idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def close(self):
+        """Close the idle connections; ones in use are closed when they are handed back"""
+        with self.pool_lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def create_search_table(self, conn: sqlite3.Connection) -> bool:
+        """Create and backfill the FTS5 index once; False if SQLite lacks FTS5"""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is None:
+                conn.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(content)")
+                conn.execute(
+                    "INSERT INTO messages_fts (rowid, content) "
+                    "SELECT c.rowid * ? + m.position, m.content FROM messages m JOIN conversations c ON c.id = m.conversation_id",
+                    (self.FTS_ROWID_STRIDE,)
+                )
+            conn.execute("COMMIT")
+        except sqlite3.OperationalError:
+            # Built without FTS5; search falls back to LIKE
+            conn.execute("ROLLBACK")
+            return False
+        return True
+
+    def index_messages(self, conn: sqlite3.Connection, conversation_id: str, start: int, messages: List[Dict]):
+        """Replace the FTS entries of a conversation from ``start`` onwards (call inside the write transaction)"""
+        if not self.fts:
+            return
+        row = conn.execute("SELECT rowid FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        if row is None:
+            return
+        base = row[0] * self.FTS_ROWID_STRIDE
+        conn.execute(
+            "DELETE FROM messages_fts WHERE rowid >= ? AND rowid < ?",
+            (base + start, base + self.FTS_ROWID_STRIDE)
+        )
+        conn.executemany(
+            "INSERT INTO messages_fts (rowid, content) VALUES (?, ?)",
+            [(base + start + i, m.get("content", "")) for i, m in enumerate(messages)]
+        )
+
+    def read_version(self, conn: sqlite3.Connection) -> int:
+        """Version number of the stored history"""
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def bump_version(self, conn: sqlite3.Connection):
+        """Record a write (call inside the write transaction)"""
+        version = self.read_version(conn) + 1
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (str(version),))
+        with self.lock:
+            if version != self.version + 1:
+                # Someone else wrote since we last looked
+                self.generation += 1
+            self.version = version
+
+    def check_external_changes(self) -> int:
+        """Notice writes from other processes; returns ``generation``"""
+        with self.connection() as conn:
+            version = self.read_version(conn)
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.generation += 1
+            return self.generation
+
+    def read_messages(self, conn: sqlite3.Connection, conversation_id: str) -> List[Dict]:
+        """Read the ordered messages of one conversation"""
+        rows = conn.execute(
+            "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY position",
+            (conversation_id,)
+        )
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def write_conversation(self, conn: sqlite3.Connection, conv: Dict):
+        """Insert one full conversation record"""
+        summary = conv.get("summary")
+        metadata = conv.get("metadata") or build_conversation_metadata(conv.get("messages", []), conv.get("timestamp", ""))
+        conn.execute(
+            "INSERT OR IGNORE INTO conversations (id, timestamp, summary, metadata) VALUES (?, ?, ?, ?)",
+            (
+                conv.get("id"),
+                conv.get("timestamp", ""),
+                json.dumps(summary, ensure_ascii=False) if summary else None,
+                json.dumps(metadata, ensure_ascii=False)
+            )
+        )
+        self.write_messages(conn, conv.get("id"), 0, conv.get("messages", []))
+        self.index_messages(conn, conv.get("id"), 0, conv.get("messages", []))
+
+    def write_messages(self, conn: sqlite3.Connection, conversation_id: str, start: int, messages: List[Dict]):
+        """Insert messages of one conversation starting at ``start``"""
+        conn.executemany(
+            "INSERT INTO messages (conversation_id, position, role, content) VALUES (?, ?, ?, ?)",
+            [(conversation_id, start + i, m.get("role", ""), m.get("content", "")) for i, m in enumerate(messages)]
+        )
+
+    def load_all(self) -> List[Dict]:
+        """Load every conversation in creation order"""
+        with self.connection() as conn:
+            conversations = {}
+            conn.execute("BEGIN")
+            try:
+                rows = conn.execute("SELECT id, timestamp, summary, metadata FROM conversations ORDER BY rowid")
+                for conv_id, timestamp, summary, metadata in rows:
+                    conversations[conv_id] = {"id": conv_id, "timestamp": timestamp, "messages": [], "metadata": json.loads(metadata)}
+                    if summary:
+                        conversations[conv_id]["summary"] = json.loads(summary)
+                rows = conn.execute("SELECT conversation_id, role, content FROM messages ORDER BY conversation_id, position")
+                for conv_id, role, content in rows:
+                    if conv_id in conversations:
+                        conversations[conv_id]["messages"].append({"role": role, "content": content})
+            finally:
+                conn.execute("COMMIT")
+            return list(conversations.values())
+
+    def list_headers(self) -> List[Dict]:
+        """Headers of every conversation in creation order, without messages"""
+        with self.connection() as conn:
+            rows = conn.execute("SELECT id, timestamp, metadata FROM conversations ORDER BY rowid")
+            return [{"id": conv_id, "timestamp": timestamp, "metadata": json.loads(metadata)} for conv_id, timestamp, metadata in rows]
+
+    def get(self, conversation_id: str) -> Optional[Dict]:
+        """Load one conversation by id"""
+        with self.connection() as conn:
+            row = conn.execute("SELECT timestamp, summary, metadata FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+            if row is None:
+                return None
+            conv = {
+                "id": conversation_id,
+                "timestamp": row[0],
+                "messages": self.read_messages(conn, conversation_id),
+                "metadata": json.loads(row[2])
+            }
+            if row[1]:
+                conv["summary"] = json.loads(row[1])
+            return conv
+
+    def search(self, query: str, limit: int) -> List[str]:
+        """Ids of conversations containing every query word, best match first"""
+        with self.connection() as conn:
+            # Per word, the best-ranked message of each conversation; conversations must contain all words
+            scores = None
+            for term in set(tokenize_search_text(query)):
+                if self.fts:
+                    rows = conn.execute("SELECT rowid, rank FROM messages_fts WHERE messages_fts MATCH ?", (f'"{term}"',))
+                else:
+                    rows = conn.execute(
+                        "SELECT c.rowid * ?, 0 FROM messages m JOIN conversations c ON c.id = m.conversation_id WHERE m.content LIKE ?",
+                        (self.FTS_ROWID_STRIDE, f"%{term}%")
+                    )
+                best = {}
+                for rowid, rank in rows:
+                    conv_rowid = rowid // self.FTS_ROWID_STRIDE
+                    if conv_rowid not in best or rank < best[conv_rowid]:
+                        best[conv_rowid] = rank
+                scores = best if scores is None else {r: scores[r] + rank for r, rank in best.items() if r in scores}
+                if not scores:
+                    return []
+            if not scores:
+                return []
+            # bm25 ranks are negative, lower is better; ties go to the newest conversation
+            conv_rowids = sorted(scores, key=lambda r: (scores[r], -r))[:limit]
+            ids = dict(conn.execute(
+                f"SELECT rowid, id FROM conversations WHERE rowid IN ({', '.join('?' * len(conv_rowids))})",
+                conv_rowids
+            ))
+            return [ids[rowid] for rowid in conv_rowids if rowid in ids]
+
+    def save_all(self, conversations: List[Dict]):
+        """Replace the stored history with ``conversations``"""
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM messages")
+                conn.execute("DELETE FROM conversations")
+                if self.fts:
+                    conn.execute("DELETE FROM messages_fts")
+                for conv in conversations:
+                    self.write_conversation(conn, conv)
+                self.bump_version(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def upsert_messages(self, conversation_id: str, timestamp: str, start: int, messages: List[Dict]):
+        """Store the messages of a conversation from index ``start`` onwards"""
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT metadata FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+                metadata = json.loads(row[0]) if row and row[0] else None
+                if metadata is not None and metadata.get("message_count") == start:
+                    metadata = extend_conversation_metadata(metadata, messages, timestamp)
+                else:
+                    metadata = None
+            
+                conn.execute(
+                    "DELETE FROM messages WHERE conversation_id = ? AND position >= ?",
+                    (conversation_id, start)
+                )
+                self.write_messages(conn, conversation_id, start, messages)
+                if metadata is None:
+                    # Not a plain append; recount from the stored messages
+                    metadata = build_conversation_metadata(self.read_messages(conn, conversation_id), timestamp)
+            
+                conn.execute(
+                    "INSERT INTO conversations (id, timestamp, metadata) VALUES (?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET timestamp = excluded.timestamp, metadata = excluded.metadata",
+                    (conversation_id, timestamp, json.dumps(metadata, ensure_ascii=False))
+                )
+                self.index_messages(conn, conversation_id, start, messages)
+                self.bump_version(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def set_summary(self, conversation_id: str, summary: Dict):
+        """Store a new running summary for a conversation"""
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "UPDATE conversations SET summary = ? WHERE id = ?",
+                    (json.dumps(summary, ensure_ascii=False), conversation_id)
+                )
+                self.bump_version(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, conversation_id: str):
+        """Delete a conversation and its messages"""
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.index_messages(conn, conversation_id, 0, [])
+                conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+                conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+                self.bump_version(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def import_conversations(self, conversations: List[Dict]):
+        """Store whole conversations, replacing any with the same id, in one transaction"""
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for conv in conversations:
+                    summary = conv.get("summary")
+                    self.index_messages(conn, conv["id"], 0, [])
+                    conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conv["id"],))
+                    conn.execute(
+                        "INSERT INTO conversations (id, timestamp, summary, metadata) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(id) DO UPDATE SET timestamp = excluded.timestamp, summary = excluded.summary, "
+                        "metadata = excluded.metadata",
+                        (
+                            conv["id"],
+                            conv.get("timestamp", ""),
+                            json.dumps(summary, ensure_ascii=False) if summary else None,
+                            json.dumps(conv["metadata"], ensure_ascii=False)
+                        )
+                    )
+                    self.write_messages(conn, conv["id"], 0, conv.get("messages", []))
+                    self.index_messages(conn, conv["id"], 0, conv.get("messages", []))
+                self.bump_version(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def iter_bodies(self, conversation_ids: Iterable[str]) -> Iterator[Dict]:
+        """Stream the conversations with the given ids one at a time, skipping deleted ones"""
+        for conv_id in conversation_ids:
+            conv = self.get(conv_id)
+            if conv is not None:
+                yield conv
+
+    def migrate_from_json(self, json_store: JsonConversationStore):
+        """One-shot import of the JSON history into an empty database"""
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone() is None:
+                    has_rows = conn.execute("SELECT 1 FROM conversations LIMIT 1").fetchone() is not None
+                    if not has_rows:
+                        for conv in json_store.load_all():
+                            self.write_conversation(conn, conv)
+                        self.bump_version(conn)
+                    conn.execute(
+                        "INSERT INTO meta (key, value) VALUES ('json_migrated', ?)",
+                        (datetime.now().isoformat(),)
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+ConversationStore = Union[JsonConversationStore, SqliteConversationStore]
+
+class ShardMap:
+    """Maps each user key to the directory holding that user's files.
+
+    Keys are stored as SHA-256 digests, so account emails and URL keys never
+    reach the disk. A new user gets ``<root>/<two hex digits>/<digest>``. The
+    map is an append-only journal: the last line for a digest wins, so an
+    entry can be overridden by appending a line (e.g. ``"."`` to hand a user
+    the unsharded history), and processes only read the lines added since
+    their last look.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.path = os.path.join(root, SHARD_MAP_FILE)
+        self.lock = threading.Lock()
+        self.shards = {}
+        self.offset = 0
+        self.refresh()
+
+    def refresh(self):
+        """Read entries appended since the last refresh (call with the lock held, or from __init__)"""
+        if not os.path.exists(self.path):
+            return
+        for record, end in read_journal_records(self.path, self.offset):
+            self.shards[record["key"]] = record["directory"]
+            self.offset = end
+
+    def directory(self, user_key: str) -> str:
+        """Directory of ``user_key``'s files, assigning and creating one for a new user"""
+        digest = hashlib.sha256(user_key.encode("utf-8")).hexdigest()
+        with self.lock:
+            if digest not in self.shards:
+                # Another process may have assigned it already
+                self.refresh()
+            directory = self.shards.get(digest)
+            if directory is None:
+                directory = os.path.join(self.root, digest[:2], digest)
+                os.makedirs(self.root, exist_ok=True)
+                record = {"key": digest, "directory": directory, "created": datetime.now().isoformat()}
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.shards[digest] = directory
+            os.makedirs(directory, exist_ok=True)
+            return directory
+
+    def stats(self) -> Dict:
+        """Number of known users"""
+        with self.lock:
+            return {"users": len(self.shards)}
+
+@st.cache_resource
+def get_shard_map() -> ShardMap:
+    """Return the process-wide shard map"""
+    shard_map = ShardMap(SHARDS_DIR)
+    if METRICS_ENABLED:
+        get_metrics().register_stats("shard_map", "Shard map", shard_map.stats)
+    return shard_map
+
+def get_user_key() -> str:
+    """Identify the visitor: the signed-in account if there is one, else a random key kept in the URL"""
+    try:
+        user = st.user
+        if user.get("is_logged_in"):
+            account = user.get("email") or user.get("sub")
+            if account:
+                return f"account:{account}"
+    except Exception:
+        # Authentication isn't configured
+        pass
+    key = st.query_params.get(USER_KEY_PARAM, "")
+    if not re.fullmatch(r"[0-9a-f]{32}", key):
+        key = secrets.token_hex(16)
+        st.query_params[USER_KEY_PARAM] = key
+    return f"anonymous:{key}"
+
+def get_storage_directory() -> str:
+    """Directory of this session's conversation and preference files"""
+    if not STORAGE_SHARDING:
+        return "."
+    if "storage_directory" not in st.session_state:
+        # Resolved once per session; the shard map is only touched on a user's first visit
+        st.session_state.storage_directory = get_shard_map().directory(get_user_key())
+    return st.session_state.storage_directory
+
+def create_conversation_store(directory: str = ".") -> ConversationStore:
+    """Open the conversation store of one shard (use get_conversation_store() to share it)"""
+    json_store = JsonConversationStore(
+        os.path.join(directory, CONVERSATIONS_FILE),
+        os.path.join(directory, CONVERSATIONS_INDEX_FILE),
+        os.path.join(directory, CONVERSATIONS_JOURNAL_FILE),
+        JOURNAL_COMPACT_BYTES,
+        STORAGE_FORMAT,
+        os.path.join(directory, CONVERSATIONS_ARCHIVE_DIR),
+        ARCHIVE_AFTER_DAYS
+    )
+    if STORAGE_BACKEND == "sqlite":
+        sqlite_store = SqliteConversationStore(os.path.join(directory, CONVERSATIONS_DB_FILE))
+        sqlite_store.migrate_from_json(json_store)
+        return sqlite_store
+    return json_store
+
+class ConversationCache:
+    """Conversation headers and bodies shared by every session in the process.
+
+    Cached headers and bodies are never modified in place: a save, summary
+    or delete swaps in new dicts instead (copy-on-write), so sessions can
+    hold on to what they were handed without copying it and only keep their
+    own working conversation. Bodies are evicted least recently used once
+    their message bytes exceed ``max_bytes``. Whenever the store reports a
+    write from another process, everything is reloaded.
+
+    Headers are also kept sorted by (timestamp, id) for the sidebar, which
+    pages through them with a cursor (the key just past the page) rather
+    than an offset, so a page costs the same however many conversations
+    there are and stays stable while others are added or removed.
+    """
+
+    # Order keys looked up at a time by iterate()
+    ITERATE_BATCH = 256
+
+    def __init__(self, store: ConversationStore, max_bytes: int):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.headers = None
+        self.order = []
+        self.bodies = OrderedDict()
+        self.body_bytes = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def validate(self):
+        """Load headers on first use, or reload after outside writes (call with the lock held)"""
+        generation = self.store.check_external_changes()
+        if self.headers is None or generation != self.generation:
+            self.headers = OrderedDict((header["id"], header) for header in self.store.list_headers())
+            self.order = sorted(self.order_key(header) for header in self.headers.values())
+            self.bodies = OrderedDict()
+            self.body_bytes = 0
+            self.generation = generation
+
+    @staticmethod
+    def order_key(header: Dict) -> Tuple[str, str]:
+        """Sort key of a header in the timestamp-ordered index"""
+        return (header.get("timestamp") or "", header["id"])
+
+    def set_header(self, header: Dict):
+        """Add or replace a header and its index entry (call with the lock held)"""
+        previous = self.headers.get(header["id"])
+        if previous is not None:
+            self.unindex(previous)
+        self.headers[header["id"]] = header
+        bisect.insort(self.order, self.order_key(header))
+
+    def unindex(self, header: Dict):
+        """Remove a header's entry from the timestamp-ordered index (call with the lock held)"""
+        key = self.order_key(header)
+        i = bisect.bisect_left(self.order, key)
+        if i < len(self.order) and self.order[i] == key:
+            del self.order[i]
+
+    def remember(self, conversation: Dict):
+        """Put a body in the LRU, evicting the oldest ones (call with the lock held)"""
+        conv_id = conversation["id"]
+        previous = self.bodies.pop(conv_id, None)
+        if previous is not None:
+            self.body_bytes -= previous["metadata"]["bytes"]
+        size = conversation["metadata"]["bytes"]
+        if size > self.max_bytes:
+            return
+        self.bodies[conv_id] = conversation
+        self.body_bytes += size
+        while self.body_bytes > self.max_bytes:
+            _, evicted = self.bodies.popitem(last=False)
+            self.body_bytes -= evicted["metadata"]["bytes"]
+
+    def page(self, cursor: Optional[Tuple[str, str]], limit: int) -> Dict:
+        """One page of headers, most recently updated first.
+
+        ``cursor`` is the order key just above the page (None for the newest
+        page). Returns the headers, their position, the total count and the
+        cursors of the older and newer pages (``has_older``/``has_newer``
+        tell whether those exist; the newest page's cursor is None).
+        """
+        with self.lock:
+            self.validate()
+            total = len(self.order)
+            end = bisect.bisect_left(self.order, tuple(cursor)) if cursor else total
+            start = max(0, end - limit)
+            newer_end = min(total, end + limit)
+            return {
+                "headers": [self.headers[conv_id] for _, conv_id in reversed(self.order[start:end])],
+                "first": total - end + 1,
+                "last": total - start,
+                "total": total,
+                "has_older": start > 0,
+                "older": self.order[start] if start > 0 else None,
+                "has_newer": end < total,
+                "newer": self.order[newer_end] if newer_end < total else None
+            }
+
+    def get_header(self, conversation_id: str) -> Optional[Dict]:
+        """Header of one conversation (read-only)"""
+        with self.lock:
+            self.validate()
+            return self.headers.get(conversation_id)
+
+    def get(self, conversation_id: str) -> Optional[Dict]:
+        """Body of one conversation (read-only), from the cache or storage"""
+        with self.lock:
+            self.validate()
+            conv = self.bodies.get(conversation_id)
+            if conv is not None:
+                self.bodies.move_to_end(conversation_id)
+                self.hits += 1
+                return conv
+            self.misses += 1
+            if conversation_id not in self.headers:
+                return None
+            conv = self.store.get(conversation_id)
+            if conv is not None:
+                self.remember(conv)
+            return conv
+
+    def search(self, query: str, limit: int) -> List[Dict]:
+        """Headers of the conversations best matching ``query``.
+
+        The store is searched without holding the cache lock: building the
+        search index on a first search reads the whole history, and other
+        sessions shouldn't wait for that.
+        """
+        with self.lock:
+            self.validate()
+        conv_ids = self.store.search(query, limit)
+        with self.lock:
+            self.validate()
+            return [self.headers[conv_id] for conv_id in conv_ids if conv_id in self.headers]
+
+    def upsert(self, conversation: Dict, start: int) -> bool:
+        """Persist ``conversation`` from message ``start`` onwards and cache it.
+
+        The caller hands over ``conversation`` and must not modify it (or
+        its message list) afterwards. Returns False without writing anything
+        if the stored conversation doesn't have exactly ``start`` messages,
+        i.e. another session saved it since the caller's last save; appending
+        there would splice two transcripts together.
+        """
+        with self.lock:
+            self.validate()
+            stored = self.headers.get(conversation["id"])
+            if (stored["metadata"]["message_count"] if stored else 0) != start:
+                return False
+            self.store.upsert_messages(
+                conversation["id"],
+                conversation["timestamp"],
+                start,
+                conversation["messages"][start:]
+            )
+            self.set_header({
+                "id": conversation["id"],
+                "timestamp": conversation["timestamp"],
+                "metadata": conversation["metadata"]
+            })
+            self.remember(conversation)
+            return True
+
+    def set_summary(self, conversation_id: str, summary: Dict):
+        """Persist a running summary and swap it into the cached body"""
+        with self.lock:
+            self.store.set_summary(conversation_id, summary)
+            conv = self.bodies.get(conversation_id)
+            if conv is not None:
+                self.bodies[conversation_id] = dict(conv, summary=summary)
+
+    def delete(self, conversation_id: str):
+        """Delete a conversation from storage and the cache"""
+        with self.lock:
+            self.store.delete(conversation_id)
+            header = self.headers.pop(conversation_id, None) if self.headers is not None else None
+            if header is not None:
+                self.unindex(header)
+            conv = self.bodies.pop(conversation_id, None)
+            if conv is not None:
+                self.body_bytes -= conv["metadata"]["bytes"]
+
+    def save_all(self, conversations: List[Dict]):
+        """Replace the stored history and drop everything cached"""
+        with self.lock:
+            self.store.save_all(conversations)
+            self.headers = None
+
+    def import_conversations(self, conversations: List[Dict]):
+        """Persist a batch of whole conversations (with metadata) in one storage write.
+
+        Their headers are indexed, but their bodies aren't cached: an import
+        would only push out the conversations sessions have open.
+        """
+        with self.lock:
+            self.validate()
+            self.store.import_conversations(conversations)
+            for conv in conversations:
+                self.set_header({"id": conv["id"], "timestamp": conv["timestamp"], "metadata": conv["metadata"]})
+                previous = self.bodies.pop(conv["id"], None)
+                if previous is not None:
+                    self.body_bytes -= previous["metadata"]["bytes"]
+
+    def iterate(self, after: Optional[Tuple[str, str]] = None, ids: Optional[Iterable[str]] = None,
+                since: str = "", until: str = "") -> Iterator[Dict]:
+        """Stream conversations in (timestamp, id) order, oldest first, from just past the order key ``after``.
+
+        ``since`` and ``until`` are ISO dates or timestamps bounding the
+        last update, both inclusive (``until`` matches by prefix, so a date
+        covers that whole day). Bodies are read from storage one at a time
+        without entering the LRU, and the position is looked up again for
+        every batch of keys, so conversations saved meanwhile are included
+        and memory stays flat however long the history is. A conversation
+        saved again after its key was read is skipped here and comes up
+        again at its new position.
+        """
+        wanted = set(ids) if ids is not None else None
+        current = [max(tuple(after) if after else ("", ""), (since, ""))]
+
+        def matching_ids() -> Iterator[str]:
+            while True:
+                with self.lock:
+                    self.validate()
+                    i = bisect.bisect_right(self.order, current[0])
+                    batch = self.order[i:i + self.ITERATE_BATCH]
+                if not batch:
+                    return
+                for key in batch:
+                    if until and key[0][:len(until)] > until:
+                        return
+                    current[0] = key
+                    if wanted is None or key[1] in wanted:
+                        yield key[1]
+
+        for conv in self.store.iter_bodies(matching_ids()):
+            if conv.get("timestamp") == current[0][0]:
+                yield conv
+
+    def stats(self) -> Dict:
+        """Cache size and hit counts"""
+        with self.lock:
+            return {
+                "headers": len(self.headers or {}),
+                "bodies": len(self.bodies),
+                "body_bytes": self.body_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+def close_conversation_cache(cache: ConversationCache):
+    """Release what an evicted shard's store holds open"""
+    if isinstance(cache.store, SqliteConversationStore):
+        cache.store.close()
+
+@st.cache_resource(max_entries=MAX_OPEN_SHARDS, on_release=close_conversation_cache)
+def get_conversation_cache(directory: str = ".") -> ConversationCache:
+    """Return the conversation cache of one shard, shared by all its sessions.
+
+    The cache owns the shard's store, so both are evicted together and a
+    shard never has two stores writing the same files.
+    """
+    max_bytes = CONVERSATION_CACHE_BYTES // MAX_OPEN_SHARDS if STORAGE_SHARDING else CONVERSATION_CACHE_BYTES
+    return ConversationCache(create_conversation_store(directory), max_bytes)
+
+def get_conversation_store(directory: str = ".") -> ConversationStore:
+    """Return the conversation store of one shard, shared by all its sessions"""
+    return get_conversation_cache(directory).store
+
+def get_session_conversation_cache() -> ConversationCache:
+    """The conversation cache of this session's shard"""
+    return get_conversation_cache(get_storage_directory())
+
+def load_conversations() -> List[Dict]:
+    """Load conversation history from the JSON snapshot and journal"""
+    return get_conversation_store(get_storage_directory()).load_all()
+
+def save_conversations(conversations: List[Dict]):
+    """Save the full conversation history, replacing the snapshot and journal"""
+    get_session_conversation_cache().save_all(conversations)
+
+def list_conversation_page(cursor: Optional[Tuple[str, str]], limit: int = CONVERSATIONS_PAGE_SIZE) -> Dict:
+    """One page of conversation headers (id, timestamp, metadata), most recently updated first"""
+    return get_session_conversation_cache().page(cursor, limit)
+
+def search_conversations(query: str, limit: int = CONVERSATIONS_PAGE_SIZE) -> List[Dict]:
+    """Headers of the conversations whose messages best match ``query``"""
+    return get_session_conversation_cache().search(query, limit)
+
+def fetch_conversation(conversation_id: str) -> Optional[Dict]:
+    """Fetch a single conversation (shared and read-only)"""
+    return get_session_conversation_cache().get(conversation_id)
+
+def delete_conversation(conversation_id: str):
+    """Delete a conversation from storage"""
+    get_session_conversation_cache().delete(conversation_id)
+
+def is_in_date_range(timestamp: str, since: str = "", until: str = "") -> bool:
+    """Whether an ISO timestamp is within ``since``/``until``, both inclusive; ``until`` matches by prefix"""
+    return (not since or timestamp >= since) and (not until or timestamp[:len(until)] <= until)
+
+def prepare_imported_conversation(record) -> Dict:
+    """A conversation parsed from an export line, checked, with its metadata recomputed"""
+    if not isinstance(record, dict) or not record.get("id") or not isinstance(record.get("messages"), list):
+        raise ValueError("not a conversation (needs an id and a list of messages)")
+    if not all(isinstance(m, dict) for m in record["messages"]):
+        raise ValueError(f"conversation {record['id']} has a message that is not an object")
+    messages = [{"role": str(m.get("role", "")), "content": str(m.get("content") or "")} for m in record["messages"]]
+    timestamp = str(record.get("timestamp") or datetime.now().isoformat())
+    conversation = {
+        "id": str(record["id"]),
+        "timestamp": timestamp,
+        "messages": messages,
+        "metadata": build_conversation_metadata(messages, timestamp)
+    }
+    if record.get("summary"):
+        conversation["summary"] = record["summary"]
+    return conversation
+
+def export_conversation_lines(cache: ConversationCache, after: Optional[Tuple[str, str]] = None,
+                              ids: Optional[Iterable[str]] = None, since: str = "", until: str = "") -> Iterator[bytes]:
+    """NDJSON export, one conversation per line in ConversationCache.iterate() order.
+
+    Conversations are read one at a time, so memory doesn't grow with the
+    history. An interrupted export resumes with ``after`` set to the order
+    key (timestamp, id) of the last line written.
+    """
+    for conv in cache.iterate(after, ids, since, until):
+        yield (json.dumps(conv, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+def import_conversation_lines(target: Union[ConversationCache, ConversationStore], lines: Iterable[bytes],
+                              offset: int = 0, ids: Optional[Iterable[str]] = None, since: str = "", until: str = "",
+                              batch_size: int = IMPORT_BATCH_SIZE) -> Iterator[Dict]:
+    """Import NDJSON conversations in batches, yielding progress after each batch is stored.
+
+    ``lines`` are the lines of an export from byte ``offset`` on. Batches go
+    to ``target``'s import_conversations(): a ConversationCache, so sessions
+    list the conversations at once, or a bare store, which doesn't keep
+    their headers in memory. A conversation with an id already stored
+    replaces it. Progress reports
+    count the conversations imported and skipped by the filters, and give
+    the offset just past the last stored line, from which an interrupted
+    import resumes. A line that isn't a conversation raises ValueError
+    naming its offset, once everything before it is stored.
+    """
+    wanted = set(ids) if ids is not None else None
+    progress = {"imported": 0, "skipped": 0, "offset": offset}
+    batch = []
+    batch_bytes = 0
+    for line in lines:
+        if line.strip():
+            try:
+                conv = prepare_imported_conversation(json.loads(line))
+            except (ValueError, UnicodeDecodeError) as e:
+                if batch:
+                    target.import_conversations(batch)
+                    progress["imported"] += len(batch)
+                raise ValueError(f"line at byte {offset}: {e}") from e
+            if (wanted is None or conv["id"] in wanted) and is_in_date_range(conv["timestamp"], since, until):
+                batch.append(conv)
+                batch_bytes += len(line)
+            else:
+                progress["skipped"] += 1
+        offset += len(line)
+        if len(batch) >= batch_size or batch_bytes >= IMPORT_BATCH_BYTES:
+            target.import_conversations(batch)
+            progress["imported"] += len(batch)
+            progress["offset"] = offset
+            batch = []
+            batch_bytes = 0
+            yield dict(progress)
+    if batch:
+        target.import_conversations(batch)
+        progress["imported"] += len(batch)
+    progress["offset"] = offset
+    yield dict(progress)
+
+@st.cache_resource
+def get_export_key() -> bytes:
+    """Return the process-wide key that signs export links"""
+    return secrets.token_bytes(32)
+
+def sign_export_request(request: Dict) -> str:
+    """Token for serve.py's export route carrying ``request``, valid for EXPORT_LINK_TTL seconds"""
+    payload = base64.urlsafe_b64encode(json.dumps(dict(request, expires=time.time() + EXPORT_LINK_TTL)).encode("utf-8"))
+    payload = payload.decode("ascii").rstrip("=")
+    signature = hmac.new(get_export_key(), payload.encode("ascii"), hashlib.sha256).hexdigest()
+    return f"{payload}.{signature}"
+
+def verify_export_request(token: str) -> Optional[Dict]:
+    """The request signed into an export token, or None if it was tampered with or has expired"""
+    payload, _, signature = token.rpartition(".")
+    expected = hmac.new(get_export_key(), payload.encode("ascii", "replace"), hashlib.sha256).hexdigest()
+    if not payload or not hmac.compare_digest(signature.encode("utf-8"), expected.encode("ascii")):
+        return None
+    request = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    return request if request.get("expires", 0) >= time.time() else None
+
+def estimate_object_size(obj, seen: Optional[set] = None) -> int:
+    """Approximate memory held by ``obj`` and the containers it references"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_object_size(k, seen) + estimate_object_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(estimate_object_size(item, seen) for item in obj)
+    return size
+
+def get_session_memory_usage() -> int:
+    """Approximate bytes held by this session's state, excluding shared objects"""
+    seen = set()
+    total = 0
+    for key in list(st.session_state.keys()):
+        if key in ("client", "generation"):
+            # Pooled client and in-flight job are not per-session history
+            continue
+        total += estimate_object_size(st.session_state[key], seen)
+    return total
+
+class PreferencesStore:
+    """In-memory copy of the preferences file with coalesced, atomic writes.
+
+    Saving only marks the preferences dirty when a value actually changed;
+    changes within ``flush_delay`` seconds are written together by one
+    background timer.
+    """
+
+    def __init__(self, path: str, flush_delay: float):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.lock = threading.Lock()
+        self.timer = None
+        self.pending = None
+        self.preferences = self.read()
+
+    def read(self) -> Dict:
+        """Read preferences from disk"""
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, IOError):
+                return {}
+        return {}
+
+    def load(self) -> Dict:
+        """Return a copy of the current preferences"""
+        with self.lock:
+            return copy.deepcopy(self.preferences)
+
+    def save(self, preferences: Dict) -> bool:
+        """Schedule a write if ``preferences`` differ from the stored ones"""
+        with self.lock:
+            if preferences == self.preferences:
+                return False
+            self.preferences = copy.deepcopy(preferences)
+            self.pending = self.preferences
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        return True
+
+    def flush(self):
+        """Write pending changes to disk now"""
+        with self.lock:
+            pending, self.pending = self.pending, None
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if pending is not None:
+                write_json_atomic(self.path, pending)
+
+@st.cache_resource(max_entries=MAX_OPEN_SHARDS)
+def get_preferences_store(directory: str = ".") -> PreferencesStore:
+    """Return the preferences store of one shard"""
+    store = PreferencesStore(os.path.join(directory, PREFERENCES_FILE), PREFERENCES_FLUSH_DELAY)
+    # Don't lose changes still waiting for the timer on shutdown
+    atexit.register(store.flush)
+    return store
+
+def load_preferences() -> Dict:
+    """Load user preferences"""
+    return get_preferences_store(get_storage_directory()).load()
 
 def save_preferences(preferences: Dict):
-    """Save user preferences to JSON file"""
-    with open(PREFERENCES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(preferences, f, indent=2, ensure_ascii=False)
+    """Save user preferences (written to disk only if something changed)"""
+    get_preferences_store(get_storage_directory()).save(preferences)
+
+def update_preference(key: str, value):
+    """Set one preference and save it if the value changed"""
+    if st.session_state.preferences.get(key) != value:
+        st.session_state.preferences[key] = value
+        save_preferences(st.session_state.preferences)
 
 def initialize_session_state():
     """Initialize session state variables"""
     if "messages" not in st.session_state:
         st.session_state.messages = []
-    if "conversations" not in st.session_state:
-        st.session_state.conversations = load_conversations()
     if "preferences" not in st.session_state:
         st.session_state.preferences = load_preferences()
     if "current_conversation_id" not in st.session_state:
         st.session_state.current_conversation_id = None
+    if "persisted_message_count" not in st.session_state:
+        # Messages of the current conversation this session has loaded or saved
+        st.session_state.persisted_message_count = 0
+    if "generation" not in st.session_state:
+        # Reply currently being generated on the LLM worker pool
+        st.session_state.generation = None
+    if "conversation_summaries" not in st.session_state:
+        # Written by background summary threads, keyed by conversation id
+        st.session_state.conversation_summaries = {}
+    if "chat_window_offset" not in st.session_state:
+        # Number of newest messages scrolled past in the chat pane; 0 shows the latest
+        st.session_state.chat_window_offset = 0
+    if "conversation_page_cursor" not in st.session_state:
+        # Order key just above the sidebar page being shown; None is the newest page
+        st.session_state.conversation_page_cursor = None
     if "client" not in st.session_state:
         # For testing: only use stored preferences, not env variables
         # env_api_key = os.getenv("OPENAI_API_KEY")  # Disabled for testing
@@ -162,17 +2413,360 @@ def initialize_session_state():
         else:
             st.session_state.client = None
 
-def get_openai_client(api_key: str, base_url: Optional[str] = None) -> Optional[OpenAI]:
-    """Create and return OpenAI client"""
+class OpenAIClientPool:
+    """Process-wide registry of OpenAI clients keyed by (api key, base URL).
+
+    Sessions using the same key and endpoint share one client and therefore
+    one HTTP connection pool, so requests reuse warm keep-alive connections
+    instead of paying a new TLS handshake per session. Clients unused for
+    ``idle_ttl`` seconds are dropped from the registry; sessions still holding
+    one keep working and its connections are released once they let go.
+    """
+
+    def __init__(self, idle_ttl: float):
+        self.idle_ttl = idle_ttl
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(api_key: str, base_url: str) -> str:
+        """Registry key; the API key itself is never stored as a key"""
+        return hashlib.sha256(f"{api_key}\0{base_url}".encode("utf-8")).hexdigest()
+
+    def create(self, api_key: str, base_url: str) -> "OpenAI":
+        """Build a client with the configured connection pool and timeouts"""
+        import httpx
+        from openai import OpenAI
+        timeout = httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+        http_client = httpx.Client(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+            )
+        )
+        # Retries are handled by create_chat_completion() instead of the SDK
+        return OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0, http_client=http_client)
+
+    def get(self, api_key: str, base_url: str) -> "OpenAI":
+        """Return the shared client for this key and endpoint, creating it on first use"""
+        key = self.key(api_key, base_url)
+        now = time.monotonic()
+        with self.lock:
+            self.evict_idle(now)
+            entry = self.clients.get(key)
+            if entry is not None:
+                self.hits += 1
+                entry["last_used"] = now
+                return entry["client"]
+            self.misses += 1
+            client = self.create(api_key, base_url)
+            self.clients[key] = {"client": client, "last_used": now}
+            return client
+
+    def evict_idle(self, now: float):
+        """Drop clients that have not been handed out for ``idle_ttl`` seconds"""
+        for key in [k for k, entry in self.clients.items() if now - entry["last_used"] > self.idle_ttl]:
+            del self.clients[key]
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        """Pool counters for monitoring"""
+        with self.lock:
+            return {
+                "clients": len(self.clients),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+@st.cache_resource
+def get_client_pool() -> OpenAIClientPool:
+    """Return the process-wide OpenAI client pool"""
+    pool = OpenAIClientPool(CLIENT_IDLE_TTL)
+    if METRICS_ENABLED:
+        get_metrics().register_stats("client_pool", "OpenAI client pool", pool.stats)
+    return pool
+
+class LazyOpenAIClient:
+    """A session's handle on a pooled OpenAI client, which is only fetched on first use.
+
+    Until a session sends its first request it only needs to know that a key
+    is configured, so the first page renders without importing the SDK or
+    building a connection pool. Attribute access is forwarded to the client.
+    """
+
+    def __init__(self, pool: OpenAIClientPool, api_key: str, base_url: str):
+        self.pool = pool
+        self.api_key = api_key
+        self.url = base_url
+        self.client = None
+
+    def resolve(self) -> "OpenAI":
+        """The pooled client, fetched from the pool on the first call"""
+        if self.client is None:
+            self.client = self.pool.get(self.api_key, self.url)
+        return self.client
+
+    def __getattr__(self, name: str):
+        # Only reached for attributes the handle doesn't have; leave copy/pickle hooks alone
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.resolve(), name)
+
+def get_openai_client(api_key: str, base_url: Optional[str] = None) -> Optional[LazyOpenAIClient]:
+    """Return a handle on the pooled OpenAI client for this API key"""
     if not api_key:
         return None
+    # Use custom base URL if provided, otherwise use default
+    return LazyOpenAIClient(get_client_pool(), api_key, base_url or OPENAI_BASE_URL)
+
+class UpstreamUnavailableError(Exception):
+    """Raised without calling the API while the circuit breaker is open"""
+
+class RequestCancelledError(Exception):
+    """Raised when a request is cancelled before its response arrives"""
+
+class CircuitBreaker:
+    """Stops calling an endpoint after repeated failures.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    calls fail fast. Once ``reset_timeout`` has passed a single trial call is
+    let through; its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self) -> bool:
+        """Whether a call may be made now"""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def release_trial(self):
+        """End a trial call whose outcome says nothing about the endpoint's health"""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+class LatencyTracker:
+    """Sliding window of recent call latencies"""
+
+    def __init__(self, window: int = 200):
+        self.samples = []
+        self.window = window
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+            if len(self.samples) > self.window:
+                del self.samples[0]
+
+    def percentile(self, percentile: float, min_samples: int) -> Optional[float]:
+        """Latency at the given percentile, or None until enough samples exist"""
+        with self.lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+class UpstreamGuard:
+    """Per-endpoint circuit breakers and per-request-kind latency trackers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.breakers = {}
+        self.trackers = {}
+        self.hedge_pool = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS * 2, thread_name_prefix="llm-hedge")
+        # Cancellable requests wait for their response here, so cancelling frees the caller at once
+        self.request_pool = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS * 2, thread_name_prefix="llm-request")
+
+    def breaker(self, base_url: str) -> CircuitBreaker:
+        with self.lock:
+            if base_url not in self.breakers:
+                self.breakers[base_url] = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+            return self.breakers[base_url]
+
+    def tracker(self, key: Tuple) -> LatencyTracker:
+        with self.lock:
+            if key not in self.trackers:
+                self.trackers[key] = LatencyTracker()
+            return self.trackers[key]
+
+    def stats(self) -> Dict:
+        """Number of circuits in each state, for monitoring"""
+        with self.lock:
+            breakers = list(self.breakers.values())
+        counts = {"closed": 0, "open": 0, "half-open": 0}
+        for breaker in breakers:
+            counts[breaker.state] += 1
+        return {
+            "circuits_closed": counts["closed"],
+            "circuits_open": counts["open"],
+            "circuits_half_open": counts["half-open"]
+        }
+
+@st.cache_resource
+def get_upstream_guard() -> UpstreamGuard:
+    """Return the process-wide circuit breakers and latency trackers"""
+    guard = UpstreamGuard()
+    if METRICS_ENABLED:
+        get_metrics().register_stats("upstream", "Upstream circuit breakers", guard.stats)
+    return guard
+
+def is_retryable_error(error: Exception) -> bool:
+    """Whether a failed call is worth retrying"""
+    import openai
+    if isinstance(error, openai.APIConnectionError):
+        # Includes timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait, from Retry-After(-Ms) headers"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
     try:
-        # Use custom base URL if provided, otherwise use default
-        url = base_url or OPENAI_BASE_URL
-        return OpenAI(api_key=api_key, base_url=url)
-    except Exception:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        retry_after = headers.get("retry-after")
+        if not retry_after:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            # HTTP-date form
+            retry_at = parsedate_to_datetime(retry_after)
+            return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
         return None
 
+def get_retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Delay before the next attempt, or None if the server wants us to wait too long"""
+    retry_after = get_retry_after(error)
+    if retry_after is not None:
+        return retry_after if retry_after <= RETRY_MAX_DELAY else None
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+def close_quietly(result):
+    """Close a losing hedged stream"""
+    close = getattr(result, "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+def hedged_call(operation: Callable, tracker: LatencyTracker, hedge_pool: ThreadPoolExecutor):
+    """Run ``operation``, firing one duplicate if it is slower than the hedge percentile"""
+    threshold = tracker.percentile(HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES) if HEDGE_PERCENTILE else None
+    if threshold is None:
+        return operation()
+    
+    primary = hedge_pool.submit(operation)
+    done, _ = wait([primary], timeout=threshold)
+    if done:
+        return primary.result()
+    
+    secondary = hedge_pool.submit(operation)
+    pending = {primary, secondary}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                # Whichever answers second is discarded
+                for other in pending:
+                    other.add_done_callback(lambda f: close_quietly(f.result()) if f.exception() is None else None)
+                return future.result()
+            error = future.exception()
+    raise error
+
+def create_chat_completion(client: "OpenAI", cancel_token: Optional["CancelToken"] = None, **kwargs):
+    """Call ``client.chat.completions.create`` with retries, hedging and a circuit breaker.
+
+    For streaming requests this covers the call up to the response headers;
+    a stream that breaks off midway is not retried. Cancelling ``cancel_token``
+    before the headers arrive raises RequestCancelledError right away.
+    """
+    guard = get_upstream_guard()
+    base_url = str(client.base_url)
+    breaker = guard.breaker(base_url)
+    tracker = guard.tracker((base_url, kwargs.get("model"), bool(kwargs.get("stream"))))
+    
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise UpstreamUnavailableError("The AI service is temporarily unavailable. Please try again in a moment.")
+        started = time.monotonic()
+        try:
+            operation = lambda: hedged_call(lambda: client.chat.completions.create(**kwargs), tracker, guard.hedge_pool)
+            result = cancel_token.wait(guard.request_pool.submit(operation)) if cancel_token is not None else operation()
+        except RequestCancelledError:
+            breaker.release_trial()
+            raise
+        except Exception as e:
+            if not is_retryable_error(e):
+                # Client errors (bad key, bad request) say nothing about upstream health
+                breaker.release_trial()
+                raise
+            breaker.record_failure()
+            delay = get_retry_delay(e, attempt)
+            if attempt >= RETRY_ATTEMPTS or delay is None:
+                raise
+            attempt += 1
+            if cancel_token is not None:
+                if cancel_token.event.wait(delay):
+                    raise
+            else:
+                time.sleep(delay)
+            continue
+        tracker.record(time.monotonic() - started)
+        breaker.record_success()
+        return result
+
 def get_personality_prompt(personality: str) -> str:
     """Get personality prompt based on selected personality"""
     personalities = {
@@ -227,71 +2821,1163 @@ You can still be characteristically dramatic about it, but make it clear Swair i
     }
     return personalities.get(personality, personalities["Pixel"])
 
-def get_openai_response(messages: List[Dict], model: str, temperature: float, client: Optional[OpenAI], personality: str = "Pixel") -> str:
-    """Get response from OpenAI API with selected personality"""
+class TokenCounter:
+    """Counts message tokens per model with a bounded cache of past counts.
+
+    Uses tiktoken when the encoding for a model is available locally and
+    otherwise estimates roughly four characters per token.
+    """
+
+    # Per-message framing overhead of the chat format
+    TOKENS_PER_MESSAGE = 4
+
+    def __init__(self, max_entries: int = 20000):
+        self.max_entries = max_entries
+        self.encodings = {}
+        self.counts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def encoding_for(self, model: str):
+        """Return the tiktoken encoding for a model, or None to estimate"""
+        if model not in self.encodings:
+            encoding = None
+            if tiktoken is not None:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    try:
+                        encoding = tiktoken.get_encoding("cl100k_base")
+                    except Exception:
+                        encoding = None
+                except Exception:
+                    # Encoding files could not be loaded (e.g. offline)
+                    encoding = None
+            self.encodings[model] = encoding
+        return self.encodings[model]
+
+    def count_text(self, text: str, model: str) -> int:
+        """Count the tokens of a piece of text"""
+        encoding = self.encoding_for(model)
+        encoding_name = encoding.name if encoding is not None else "estimate"
+        key = (encoding_name, text)
+        with self.lock:
+            count = self.counts.get(key)
+            if count is not None:
+                self.counts.move_to_end(key)
+                return count
+        if encoding is not None:
+            count = len(encoding.encode(text, disallowed_special=()))
+        else:
+            count = (len(text) + 3) // 4
+        with self.lock:
+            self.counts[key] = count
+            if len(self.counts) > self.max_entries:
+                self.counts.popitem(last=False)
+        return count
+
+    def count_message(self, message: Dict, model: str) -> int:
+        """Count the tokens a chat message adds to a request"""
+        return self.TOKENS_PER_MESSAGE + self.count_text(message.get("content") or "", model)
+
+    def truncate_text(self, text: str, max_tokens: int, model: str) -> str:
+        """Cut a piece of text down to at most ``max_tokens`` tokens"""
+        encoding = self.encoding_for(model)
+        if encoding is None:
+            return text[:max(max_tokens, 0) * 4]
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max(max_tokens, 0)])
+
+@st.cache_resource
+def get_token_counter() -> TokenCounter:
+    """Return the process-wide token counter"""
+    return TokenCounter()
+
+def get_context_token_budget(model: str) -> int:
+    """Prompt token budget for a model, leaving room for the reply"""
+    window = MODEL_CONTEXT_WINDOWS.get(model)
+    if window is None:
+        return CONTEXT_TOKEN_BUDGET
+    return min(CONTEXT_TOKEN_BUDGET, window - MAX_COMPLETION_TOKENS)
+
+def build_context_window(messages: List[Dict], model: str, personality: str = "Pixel", budget: Optional[int] = None, summary: Optional[Dict] = None) -> Tuple[List[Dict], int]:
+    """Assemble the system prompt and the most recent messages that fit the token budget.
+
+    Returns the request messages and how many older messages were not sent
+    verbatim. Messages already folded into ``summary`` are represented by the
+    summary text. The latest message is always kept, even if it alone
+    exceeds the budget.
+    """
+    counter = get_token_counter()
+    if budget is None:
+        budget = get_context_token_budget(model)
+    
+    system_messages = [{
+        "role": "system",
+        "content": get_personality_prompt(personality)
+    }]
+    covered = 0
+    if summary and summary.get("text"):
+        covered = min(summary.get("covered", 0), max(len(messages) - 1, 0))
+        system_messages.append({
+            "role": "system",
+            "content": f"Summary of the earlier conversation:\n{summary['text']}"
+        })
+    remaining = budget - sum(counter.count_message(m, model) for m in system_messages)
+    
+    # Walk backwards from the newest message until the budget runs out
+    kept = 0
+    for message in reversed(messages[covered:]):
+        cost = counter.count_message(message, model)
+        if kept > 0 and cost > remaining:
+            break
+        remaining -= cost
+        kept += 1
+    
+    recent = messages[len(messages) - kept:] if kept else []
+    return system_messages + recent, len(messages) - kept
+
+def build_request_messages(messages: List[Dict], personality: str = "Pixel", model: Optional[str] = None) -> List[Dict]:
+    """Prepend the personality system prompt to the conversation messages.
+
+    Messages that already start with a system prompt are sent as given;
+    otherwise older turns are trimmed to the model's context budget.
+    """
+    # Check if first message is already a system message
+    if messages and messages[0].get("role") == "system":
+        return messages
+    if model is None:
+        return [{"role": "system", "content": get_personality_prompt(personality)}] + messages
+    formatted_messages, _ = build_context_window(messages, model, personality)
+    return formatted_messages
+
+class ResponseCache:
+    """Cache of deterministic (temperature 0) completions.
+
+    A bounded in-memory LRU sits in front of an optional directory of JSON
+    files whose entries expire after ``ttl`` seconds. The directory is swept
+    in the background at startup, periodically and whenever it grows past
+    ``max_disk_bytes``: expired files are removed, then the oldest ones
+    until it is back under the cap.
+    """
+
+    def __init__(self, max_entries: int, cache_dir: str = "", ttl: float = 0, max_disk_bytes: int = 0):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_bytes = 0
+        self.swept_at = 0.0
+        self.sweeping = False
+        self.disk_evictions = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.start_sweep()
+
+    @staticmethod
+    def key(formatted_messages: List[Dict], model: str, temperature: float) -> str:
+        """Stable hash of a request; the messages include the personality prompt"""
+        payload = json.dumps(
+            {"model": model, "temperature": temperature, "messages": formatted_messages},
+            sort_keys=True,
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def disk_path(self, key: str) -> str:
+        """File holding the disk-tier entry for a key"""
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def remember(self, key: str, response: str):
+        """Insert into the memory tier, evicting the least recently used entry"""
+        self.entries[key] = response
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        """Look a response up in memory, then on disk"""
+        with self.lock:
+            response = self.entries.get(key)
+            if response is not None:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return response
+        if self.cache_dir:
+            try:
+                with open(self.disk_path(key), 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+                if time.time() - entry.get("created", 0) <= self.ttl:
+                    with self.lock:
+                        self.remember(key, entry["response"])
+                        self.disk_hits += 1
+                    return entry["response"]
+                os.remove(self.disk_path(key))
+            except (json.JSONDecodeError, KeyError, IOError, OSError):
+                pass
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, response: str):
+        """Store a response in both tiers"""
+        with self.lock:
+            self.remember(key, response)
+        if self.cache_dir:
+            try:
+                path = self.disk_path(key)
+                write_json_atomic(path, {"created": time.time(), "response": response})
+                size = os.path.getsize(path)
+            except OSError:
+                return
+            with self.lock:
+                self.disk_bytes += size
+                due = self.disk_bytes > self.max_disk_bytes > 0 or time.time() - self.swept_at >= RESPONSE_CACHE_SWEEP_INTERVAL
+            if due:
+                self.start_sweep()
+
+    def start_sweep(self):
+        """Sweep the disk tier on a background thread unless a sweep is already running"""
+        with self.lock:
+            if self.sweeping:
+                return
+            self.sweeping = True
+            self.swept_at = time.time()
+        threading.Thread(target=self.sweep, name="response-cache-sweep", daemon=True).start()
+
+    def sweep(self):
+        """Remove expired disk entries, then the oldest ones until the tier is under its byte cap.
+
+        Trims to three quarters of the cap so the next sweep isn't due on the
+        next write.
+        """
+        try:
+            files = []
+            removed = 0
+            now = time.time()
+            with os.scandir(self.cache_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".json"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                        # Files are written once, so their mtime is their creation time
+                        if now - stat.st_mtime > self.ttl:
+                            os.remove(entry.path)
+                            removed += 1
+                        else:
+                            files.append((stat.st_mtime, stat.st_size, entry.path))
+                    except OSError:
+                        pass
+            total = sum(size for _, size, _ in files)
+            if self.max_disk_bytes and total > self.max_disk_bytes:
+                files.sort()
+                for _, size, path in files:
+                    if total <= self.max_disk_bytes * 3 // 4:
+                        break
+                    try:
+                        os.remove(path)
+                        removed += 1
+                        total -= size
+                    except OSError:
+                        pass
+            with self.lock:
+                self.disk_bytes = total
+                self.disk_evictions += removed
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.sweeping = False
+
+    def stats(self) -> Dict:
+        """Hit and miss counters for monitoring"""
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "disk_bytes": self.disk_bytes,
+                "disk_evictions": self.disk_evictions
+            }
+
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    """Return the process-wide response cache"""
+    cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_DIR, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DISK_BYTES)
+    if METRICS_ENABLED:
+        get_metrics().register_stats("response_cache", "Response cache", cache.stats)
+    return cache
+
+def response_cache_key(formatted_messages: List[Dict], model: str, temperature: float) -> Optional[str]:
+    """Cache key for a request, or None if its reply must not be cached"""
+    if not RESPONSE_CACHE or temperature != 0:
+        return None
+    return ResponseCache.key(formatted_messages, model, temperature)
+
+class CancelToken:
+    """Cancellation flag that also closes the HTTP stream attached to it"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.signal = Future()
+        self.lock = threading.Lock()
+        self.closeable = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def attach(self, closeable):
+        """Register the in-flight stream; closes it right away if already cancelled"""
+        with self.lock:
+            self.closeable = closeable
+        if self.cancelled:
+            self.close()
+
+    def cancel(self):
+        """Cancel and abort the in-flight request"""
+        with self.lock:
+            if not self.signal.done():
+                self.signal.set_result(None)
+        self.event.set()
+        self.close()
+
+    def wait(self, future: Future):
+        """Result of ``future``, or RequestCancelledError as soon as the token is cancelled.
+
+        A response that arrives after cancelling is closed, so the abandoned
+        request gives its connection back.
+        """
+        done, _ = wait([future, self.signal], return_when=FIRST_COMPLETED)
+        if future in done:
+            return future.result()
+        future.add_done_callback(lambda f: close_quietly(f.result()) if f.exception() is None else None)
+        raise RequestCancelledError("Request cancelled")
+
+    def close(self):
+        with self.lock:
+            closeable, self.closeable = self.closeable, None
+        if closeable is not None:
+            try:
+                closeable.close()
+            except Exception:
+                pass
+
+def stream_openai_response(messages: List[Dict], model: str, temperature: float, client: Optional["OpenAI"], personality: str = "Pixel", cancel_token: Optional[CancelToken] = None) -> Iterator[str]:
+    """Stream a response from OpenAI API, yielding text deltas as they arrive.
+
+    Failures are yielded as an ``"Error: ..."`` chunk, on a new paragraph if
+    part of the reply has already been streamed. Cancelling ``cancel_token``
+    closes the HTTP stream and ends the iteration quietly.
+    """
     if not client:
-        return "Error: OpenAI client not initialized. Please check your API key."
+        yield "Error: OpenAI client not initialized. Please check your API key."
+        return
+    streamed_any = False
+    deltas = []
+    usage = None
     try:
-        # Create system message with selected personality
-        system_message = {
-            "role": "system",
-            "content": get_personality_prompt(personality)
-        }
-        
-        # Prepend system message to the conversation if not already present
-        formatted_messages = [system_message]
+        with span("context_assembly", stage="request"):
+            formatted_messages = build_request_messages(messages, personality, model)
         
-        # Check if first message is already a system message
-        if messages and messages[0].get("role") == "system":
-            formatted_messages = messages
-        else:
-            formatted_messages.extend(messages)
+        # Deterministic requests can be answered from the cache in one chunk
+        cache_key = response_cache_key(formatted_messages, model, temperature)
+        if cache_key:
+            cached = get_response_cache().get(cache_key)
+            if cached is not None:
+                yield cached
+                return
         
-        response = client.chat.completions.create(
+        started = time.perf_counter()
+        stream = create_chat_completion(
+            client,
+            cancel_token,
             model=model,
             messages=formatted_messages,
             temperature=temperature,
-            max_tokens=3000  # Safe limit leaving room for input tokens
+            max_tokens=MAX_COMPLETION_TOKENS,  # Safe limit leaving room for input tokens
+            stream=True,
+            # Token counts only arrive in a final chunk, and only if asked for
+            **({"stream_options": {"include_usage": True}} if METRICS_ENABLED else {})
         )
-        return response.choices[0].message.content
+        if cancel_token:
+            cancel_token.attach(stream)
+        for chunk in stream:
+            if cancel_token and cancel_token.cancelled:
+                return
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if not streamed_any:
+                    observe_span("api_ttft", time.perf_counter() - started, model=model, stream=True)
+                streamed_any = True
+                deltas.append(delta)
+                yield delta
+        if METRICS_ENABLED:
+            observe_span("api_call", time.perf_counter() - started, model=model, stream=True)
+            record_token_usage(usage, model, personality)
+        if cache_key and deltas:
+            get_response_cache().put(cache_key, "".join(deltas))
     except Exception as e:
-        return f"Error: {str(e)}"
+        if cancel_token and cancel_token.cancelled:
+            return
+        yield f"\n\nError: {str(e)}" if streamed_any else f"Error: {str(e)}"
+
+class GenerationJob:
+    """One assistant reply being generated on the LLM worker pool.
+
+    The script thread polls ``text`` while the worker appends deltas, so a
+    rerun in the middle of a request picks the same job up again instead of
+    losing or repeating it.
+    """
+
+    def __init__(self, request_messages: List[Dict], model: str, temperature: float, client: "OpenAI", personality: str, dropped_count: int, summary: Optional[Dict]):
+        self.request_messages = request_messages
+        self.model = model
+        self.temperature = temperature
+        self.client = client
+        self.personality = personality
+        self.dropped_count = dropped_count
+        self.summary = summary
+        self.parts = []
+        self.done = threading.Event()
+        self.cancel_token = CancelToken()
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token.cancelled
+
+    def run(self):
+        """Generate the reply; runs on a worker thread"""
+        try:
+            for delta in stream_openai_response(
+                self.request_messages,
+                self.model,
+                self.temperature,
+                self.client,
+                self.personality,
+                cancel_token=self.cancel_token
+            ):
+                self.parts.append(delta)
+        finally:
+            self.done.set()
+
+    def cancel(self):
+        """Stop generating and abort the in-flight HTTP request"""
+        self.cancel_token.cancel()
+
+@st.cache_resource
+def get_llm_executor() -> ThreadPoolExecutor:
+    """Return the process-wide worker pool for LLM requests"""
+    return ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS, thread_name_prefix="llm")
 
+SUMMARY_PROMPT = """You maintain a running summary of a chat between a user and an AI assistant.
+Merge the new messages into the existing summary. Keep names, facts, preferences, decisions and open questions; drop small talk.
+Reply with the updated summary only, in at most 200 words."""
+
+class ConversationSummarizer:
+    """Folds evicted turns into each conversation's running summary.
+
+    Summaries are generated on background threads after the reply has been
+    shown, and each one only covers the turns evicted since the last summary.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = set()
+
+    def schedule(self, conversation_id: str, messages: List[Dict], end: int, previous: Optional[Dict], model: str, client: "OpenAI", results: Dict, cache: ConversationCache) -> bool:
+        """Summarize ``messages[covered:end]`` in the background.
+
+        The new summary is persisted through ``cache`` and stored in
+        ``results`` under the conversation id. Returns False if there is
+        nothing new to summarize or a summary of this conversation is already
+        being generated.
+        """
+        covered = previous.get("covered", 0) if previous else 0
+        if end <= covered:
+            return False
+        with self.lock:
+            if conversation_id in self.in_flight:
+                return False
+            self.in_flight.add(conversation_id)
+        threading.Thread(
+            target=self.run,
+            args=(conversation_id, messages[covered:end], end, previous, model, client, results, cache),
+            name="conversation-summary",
+            daemon=True
+        ).start()
+        return True
+
+    def chunk_transcript(self, messages: List[Dict], model: str, budget: int) -> Iterator[Tuple[int, str]]:
+        """Split messages into transcripts of at most ``budget`` tokens.
+
+        Yields how many of the messages each transcript covers; a single
+        message longer than the budget is cut to fit.
+        """
+        counter = get_token_counter()
+        lines = []
+        used = 0
+        for message in messages:
+            line = f"{message.get('role', '')}: {message.get('content', '')}"
+            cost = counter.count_text(line, model) + 1
+            if lines and used + cost > budget:
+                yield len(lines), "\n".join(lines)
+                lines, used = [], 0
+            if cost > budget:
+                line = counter.truncate_text(line, budget - 1, model)
+                cost = budget
+            lines.append(line)
+            used += cost
+        if lines:
+            yield len(lines), "\n".join(lines)
+
+    def run(self, conversation_id: str, new_messages: List[Dict], end: int, previous: Optional[Dict], model: str, client: "OpenAI", results: Dict, cache: ConversationCache):
+        """Generate and store the summary update, one budget-sized chunk of turns at a time"""
+        try:
+            previous_text = previous.get("text", "") if previous else ""
+            covered = end - len(new_messages)
+            # Room left beside the instructions, the framing and an existing summary of up to SUMMARY_MAX_TOKENS
+            budget = get_context_token_budget(model) - get_token_counter().count_text(SUMMARY_PROMPT, model) - SUMMARY_MAX_TOKENS - 32
+            for count, transcript in self.chunk_transcript(new_messages, model, max(budget, 256)):
+                response = create_chat_completion(
+                    client,
+                    model=model,
+                    messages=[
+                        {"role": "system", "content": SUMMARY_PROMPT},
+                        {"role": "user", "content": f"Existing summary:\n{previous_text or '(none)'}\n\nNew messages:\n{transcript}"}
+                    ],
+                    temperature=0.3,
+                    max_tokens=SUMMARY_MAX_TOKENS
+                )
+                text = (response.choices[0].message.content or "").strip()
+                if not text:
+                    break
+                # Store each chunk's progress so a later failure only retries what is left
+                previous_text = text
+                covered += count
+                summary = {"text": text, "covered": covered}
+                cache.set_summary(conversation_id, summary)
+                results[conversation_id] = summary
+        except Exception:
+            # Keep the summary so far; the remaining evicted turns are retried after the next reply
+            pass
+        finally:
+            with self.lock:
+                self.in_flight.discard(conversation_id)
+
+@st.cache_resource
+def get_conversation_summarizer() -> ConversationSummarizer:
+    """Return the process-wide conversation summarizer"""
+    return ConversationSummarizer()
+
+@timed("conversation_save")
 def save_current_conversation():
-    """Save current conversation to history"""
+    """Save current conversation to history.
+
+    Only the messages added since this session last loaded or saved the
+    conversation go to storage. If another session (e.g. a second tab) has
+    saved it meanwhile, this session's version is saved as a new
+    conversation instead, so neither transcript is lost or interleaved.
+    """
     if st.session_state.messages and len(st.session_state.messages) > 0:
+        cache = get_session_conversation_cache()
+        conversation_id = st.session_state.current_conversation_id or datetime.now().strftime("%Y%m%d_%H%M%S")
+        persisted_count = st.session_state.persisted_message_count if st.session_state.current_conversation_id else 0
+        # The shared cache keeps this list; the session goes on appending to its own
+        messages = list(st.session_state.messages)
+        timestamp = datetime.now().isoformat()
+        summary = st.session_state.conversation_summaries.get(conversation_id)
+        
+        previous = cache.get_header(conversation_id)
+        previous_metadata = previous["metadata"] if previous else None
         conversation = {
-            "id": st.session_state.current_conversation_id or datetime.now().strftime("%Y%m%d_%H%M%S"),
-            "timestamp": datetime.now().isoformat(),
-            "messages": st.session_state.messages.copy()
+            "id": conversation_id,
+            "timestamp": timestamp,
+            "messages": messages,
+            "metadata": update_conversation_metadata(previous_metadata, messages, persisted_count, timestamp)
         }
+        if summary:
+            conversation["summary"] = summary
         
-        # Check if conversation already exists and update it
-        existing_index = None
-        if st.session_state.current_conversation_id:
-            for i, conv in enumerate(st.session_state.conversations):
-                if conv.get("id") == st.session_state.current_conversation_id:
-                    existing_index = i
-                    break
+        if not cache.upsert(conversation, persisted_count):
+            # Diverged from the stored copy: fork this session's transcript under a new id
+            metadata = build_conversation_metadata(messages, timestamp)
+            forked = False
+            while not forked:
+                # Another random suffix if the id is somehow taken already
+                conversation_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(3)}"
+                forked = cache.upsert({"id": conversation_id, "timestamp": timestamp, "messages": messages, "metadata": metadata}, 0)
+            # The summary covers a prefix both copies share
+            if summary and summary.get("covered", 0) <= persisted_count:
+                cache.set_summary(conversation_id, summary)
+                st.session_state.conversation_summaries[conversation_id] = summary
+        st.session_state.current_conversation_id = conversation_id
+        st.session_state.persisted_message_count = len(messages)
+
+def load_conversation(conversation_id: str):
+    """Load a specific conversation from history"""
+    # Bodies come from the process-wide cache and are only read from storage on a miss
+    conv = fetch_conversation(conversation_id)
+    if conv is not None:
+        st.session_state.messages = list(conv.get("messages", []))
+        st.session_state.current_conversation_id = conversation_id
+        st.session_state.persisted_message_count = len(st.session_state.messages)
+        st.session_state.chat_window_offset = 0
+        if conv.get("summary"):
+            st.session_state.conversation_summaries[conversation_id] = conv["summary"]
+
+def submit_generation(prompt: str) -> bool:
+    """Add the user's message and start generating the reply in the background.
+
+    Returns False without doing anything while a reply is still being
+    generated, so a repeated submission never starts a second request.
+    """
+    job = st.session_state.generation
+    if job is not None and not job.done.is_set():
+        return False
+    
+    st.session_state.messages.append({"role": "user", "content": prompt})
+    st.session_state.chat_window_offset = 0
+    
+    # Use selected model from preferences (for testing: no env fallback)
+    model = st.session_state.preferences.get("model", "gpt-3.5-turbo")
+    personality = st.session_state.preferences.get("personality", "Pixel")
+    
+    # Trim older turns so the request stays within the token budget
+    summary = st.session_state.conversation_summaries.get(st.session_state.current_conversation_id) if ROLLING_SUMMARIES else None
+    with span("context_assembly", stage="window"):
+        request_messages, dropped_count = build_context_window(st.session_state.messages, model, personality, summary=summary)
+    
+    job = GenerationJob(
+        request_messages,
+        model,
+        st.session_state.preferences.get("temperature", 0.7),
+        st.session_state.client,
+        personality,
+        dropped_count,
+        summary
+    )
+    get_llm_executor().submit(job.run)
+    st.session_state.generation = job
+    return True
+
+def finish_generation(job: GenerationJob):
+    """Append a finished reply to the conversation and save it"""
+    st.session_state.generation = None
+    response = job.text
+    if job.cancelled and not response:
+        return
+    
+    st.session_state.messages.append({"role": "assistant", "content": response})
+    
+    # Save conversation
+    save_current_conversation()
+    
+    # Summarize newly evicted turns off the hot path
+    if ROLLING_SUMMARIES and job.dropped_count and not response.startswith("Error:"):
+        get_conversation_summarizer().schedule(
+            st.session_state.current_conversation_id,
+            list(st.session_state.messages),
+            job.dropped_count,
+            job.summary,
+            job.model,
+            job.client,
+            st.session_state.conversation_summaries,
+            get_session_conversation_cache()
+        )
+
+def cancel_generation():
+    """Abandon the reply being generated, e.g. when switching conversations"""
+    job = st.session_state.generation
+    if job is not None:
+        job.cancel()
+        st.session_state.generation = None
+
+def set_session_value(key: str, value):
+    """Button callback: set a session value before the (fragment) rerun that draws it"""
+    st.session_state[key] = value
+
+def render_chat_window(messages: List[Dict], is_generating: bool):
+    """Draw at most CHAT_WINDOW_SIZE messages, with controls to page through older ones"""
+    total = len(messages)
+    offset = min(st.session_state.chat_window_offset, max(0, total - 1))
+    end = total - offset
+    start = max(0, end - CHAT_WINDOW_SIZE)
+    
+    if total > CHAT_WINDOW_SIZE:
+        st.caption(f"Showing messages {start + 1}–{end} of {total}")
+    if start > 0:
+        st.button(
+            "Load earlier messages",
+            key="load_earlier_messages",
+            type="secondary",
+            disabled=is_generating,
+            on_click=set_session_value,
+            args=("chat_window_offset", offset + CHAT_WINDOW_SIZE)
+        )
+    
+    for message in messages[start:end]:
+        avatar = "✨" if message["role"] == "assistant" else None
+        with st.chat_message(message["role"], avatar=avatar):
+            # Render markdown properly - CSS will force dark text for assistant
+            st.markdown(message["content"])
+    
+    if offset > 0:
+        st.button(
+            "Show newer messages",
+            key="load_newer_messages",
+            type="secondary",
+            on_click=set_session_value,
+            args=("chat_window_offset", max(0, offset - CHAT_WINDOW_SIZE))
+        )
+
+@st.fragment(run_every=GENERATION_POLL_INTERVAL)
+def render_generation():
+    """Show the reply being generated; once it is done, store it and rerun.
+
+    Runs as a fragment that refreshes every GENERATION_POLL_INTERVAL seconds
+    while a reply is pending. Each refresh is a short run, so "Stop
+    generating" and other widgets are handled between refreshes.
+    """
+    job = st.session_state.generation
+    if job is None:
+        return
+    if job.done.is_set():
+        finish_generation(job)
+        # Rerun to update the chat, the conversation list and the chat input
+        st.rerun()
+    
+    with st.chat_message("assistant", avatar="✨"):
+        if st.button("Stop generating", key="stop_generation", type="secondary"):
+            # Keep what was generated so far without waiting for the worker to notice
+            job.cancel()
+            finish_generation(job)
+            st.rerun()
+        
+        # Enhanced loading state
+        personality_name = job.personality
+        spinner_emojis = {"Pixel": "💖", "Grimalkin": "🐱"}
+        spinner_emoji = spinner_emojis.get(personality_name, "💖")
         
-        if existing_index is not None:
-            st.session_state.conversations[existing_index] = conversation
+        text = job.text
+        if STREAM_RESPONSES and text and not text.startswith("Error:"):
+            st.markdown(text + " ▌")
         else:
-            st.session_state.conversations.append(conversation)
-            st.session_state.current_conversation_id = conversation["id"]
+            st.caption(f"{spinner_emoji} {personality_name} is thinking...")
         
-        save_conversations(st.session_state.conversations)
+        if job.dropped_count and job.summary:
+            st.caption(f"{job.dropped_count} earlier messages were sent as a summary to fit the context budget")
+        elif job.dropped_count:
+            st.caption(f"{job.dropped_count} earlier messages were left out to fit the context budget")
 
-def load_conversation(conversation_id: str):
-    """Load a specific conversation from history"""
-    for conv in st.session_state.conversations:
-        if conv.get("id") == conversation_id:
-            st.session_state.messages = conv.get("messages", []).copy()
-            st.session_state.current_conversation_id = conversation_id
-            break
+@st.fragment
+@timed("sidebar_render", section="settings")
+def render_settings():
+    """Personality, model and temperature settings.
+
+    Runs as a fragment: changing a setting reruns only this section and
+    saves only the preference it owns.
+    """
+    # Personality Selection
+    st.markdown("### Personality", unsafe_allow_html=True)
+    default_personality = st.session_state.preferences.get("personality", "Pixel")
+    
+    personality_options = ["Pixel", "Grimalkin"]
+    try:
+        default_personality_index = personality_options.index(default_personality) if default_personality in personality_options else 0
+    except ValueError:
+        default_personality_index = 0
+    
+    selected_personality = st.selectbox(
+        "Select personality",
+        options=personality_options,
+        index=default_personality_index,
+        label_visibility="collapsed",
+        disabled=False
+    )
+    personality_changed = selected_personality != st.session_state.preferences.get("personality", "Pixel")
+    update_preference("personality", selected_personality)
+    if personality_changed:
+        # The header, empty state and chat placeholder follow the personality
+        st.rerun()
+    
+    st.markdown("<br>", unsafe_allow_html=True)
+    
+    # Model Selection
+    st.markdown("### Model", unsafe_allow_html=True)
+    # For testing: don't use env model
+    # env_model = os.getenv("OPENAI_MODEL")  # Disabled for testing
+    env_model = None
+    default_model = env_model or st.session_state.preferences.get("model", "gpt-3.5-turbo")
+    
+    model_options = ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo-preview", "gpt-4o-mini", "gpt-4o"]
+    if env_model and env_model not in model_options:
+        model_options.append(env_model)
+    
+    try:
+        default_index = model_options.index(default_model) if default_model in model_options else 0
+    except ValueError:
+        default_index = 0
+    
+    selected_model = st.selectbox(
+        "Select model",
+        options=model_options,
+        index=default_index,
+        label_visibility="collapsed",
+        disabled=False
+    )
+    update_preference("model", selected_model)
+    
+    st.markdown("<br>", unsafe_allow_html=True)
+    
+    # Temperature Setting
+    st.markdown("### Temperature", unsafe_allow_html=True)
+    temperature = st.session_state.preferences.get("temperature", 0.7)
+    temperature = st.slider(
+        "Temperature",
+        min_value=0.0,
+        max_value=2.0,
+        value=temperature,
+        step=0.1,
+        label_visibility="collapsed",
+        help="Lower = focused, Higher = creative"
+    )
+    
+    temp_label = "Focused" if temperature < 0.5 else "Balanced" if temperature < 1.0 else "Creative"
+    st.markdown(f"""
+    <div style='display: flex; justify-content: space-between; font-size: 0.8rem; color: #94a3b8; margin-top: -0.5rem;'>
+        <span>{temp_label}</span>
+        <span>{temperature:.1f}</span>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    update_preference("temperature", temperature)
+    
+    st.markdown("<div style='margin: 2rem 0; border-top: 1px solid rgba(255, 158, 199, 0.2);'></div>", unsafe_allow_html=True)
+
+def format_conversation_label(metadata: Dict) -> str:
+    """Sidebar card text for a conversation, from its metadata rather than its messages"""
+    first_user_msg = metadata["title"]
+    # Truncate long titles
+    display_title = (first_user_msg if first_user_msg else 'Empty conversation')[:35]
+    if len(first_user_msg or '') > 35:
+        display_title += "..."
+    return f"{display_title} • {metadata['user_count']} msgs"
+
+@st.fragment
+@timed("sidebar_render", section="conversations")
+def render_conversation_list():
+    """New chat, search and the paged conversation list.
+
+    Runs as a fragment; searching and paging rerun only this section, while
+    opening, starting or deleting a conversation reruns the whole app.
+    """
+    # Conversations Section
+    st.markdown("### Conversations", unsafe_allow_html=True)
+    
+    # New Chat Button
+    if st.button("New Chat", use_container_width=True, type="primary"):
+        cancel_generation()
+        st.session_state.messages = []
+        st.session_state.current_conversation_id = None
+        st.session_state.chat_window_offset = 0
+        st.session_state.conversation_page_cursor = None
+        st.rerun()
+    
+    st.markdown("<br>", unsafe_allow_html=True)
+    
+    # Full-text search; results open like any other conversation
+    search_query = st.text_input("Search conversations", placeholder="Search messages...", label_visibility="collapsed")
+    if search_query.strip():
+        results = search_conversations(search_query)
+        if not results:
+            st.caption("No matching conversations")
+        for conv in results:
+            if st.button(
+                f"🔍 {format_conversation_label(conv['metadata'])}",
+                key=f"search_{conv['id']}",
+                use_container_width=True,
+                type="secondary"
+            ):
+                cancel_generation()
+                load_conversation(conv["id"])
+                st.rerun()
+        st.markdown("<br>", unsafe_allow_html=True)
+    
+    # Conversation History, one page at a time
+    page = list_conversation_page(st.session_state.conversation_page_cursor)
+    if page["total"]:
+        st.markdown("<div style='max-height: 450px; overflow-y: auto; padding-right: 0.5rem;'>", unsafe_allow_html=True)
+        
+        for conv in page["headers"]:
+            conv_id = conv.get("id", "")
+            
+            # Highlight if current conversation
+            is_current = conv_id == st.session_state.current_conversation_id
+            
+            button_text = format_conversation_label(conv["metadata"])
+            
+            # Drawn as a card by the conv_ rules in the theme stylesheet
+            if st.button(
+                button_text,
+                key=f"conv_{conv_id}",
+                use_container_width=True,
+                type="primary" if is_current else "secondary"
+            ):
+                cancel_generation()
+                load_conversation(conv_id)
+                st.rerun()
+        
+        st.markdown("</div>", unsafe_allow_html=True)
+        
+        # Older/newer navigation
+        if page["has_older"] or page["has_newer"]:
+            st.caption(f"{page['first']}–{page['last']} of {page['total']}")
+            newer_col, older_col = st.columns(2)
+            with newer_col:
+                st.button(
+                    "← Newer",
+                    use_container_width=True,
+                    disabled=not page["has_newer"],
+                    on_click=set_session_value,
+                    args=("conversation_page_cursor", page["newer"])
+                )
+            with older_col:
+                st.button(
+                    "Older →",
+                    use_container_width=True,
+                    disabled=not page["has_older"],
+                    on_click=set_session_value,
+                    args=("conversation_page_cursor", page["older"])
+                )
+        
+        # Delete current conversation (only show if there's an active conversation)
+        if st.session_state.current_conversation_id:
+            st.markdown("<br>", unsafe_allow_html=True)
+            if st.button("Delete Current", use_container_width=True, type="secondary"):
+                cancel_generation()
+                delete_conversation(st.session_state.current_conversation_id)
+                st.session_state.messages = []
+                st.session_state.current_conversation_id = None
+                st.session_state.chat_window_offset = 0
+                st.rerun()
+    else:
+        st.markdown("""
+        <div style='text-align: center; padding: 3rem 1rem;'>
+            <div style='font-size: 2.5rem; margin-bottom: 1rem; opacity: 0.7;'>💕</div>
+            <div style='font-size: 0.9rem; color: #e2e8f0;'>No conversations yet</div>
+            <div style='font-size: 0.8rem; margin-top: 0.5rem; opacity: 0.7; color: #94a3b8;'>Start chatting with Pixel! ✨</div>
+        </div>
+        """, unsafe_allow_html=True)
+
+@st.fragment
+def render_history_transfer():
+    """Export and import of the conversation history as NDJSON, one conversation per line.
+
+    Under serve.py the export is a signed link to its streaming route, so
+    the download never has to fit in memory; under plain ``streamlit run
+    app.py`` a download button builds the file first. Uploads are imported
+    line by line in batches.
+    """
+    with st.expander("Export / Import"):
+        if "history_import_result" in st.session_state:
+            st.success(st.session_state.pop("history_import_result"))
+        dates = st.date_input("Last updated between", value=(), help="Leave empty for the whole history")
+        since = dates[0].isoformat() if len(dates) > 0 else ""
+        until = dates[1].isoformat() if len(dates) > 1 else ""
+
+        if EXPORT_ROUTE:
+            token = sign_export_request({"directory": get_storage_directory(), "since": since, "until": until})
+            st.link_button("Download export", f"{EXPORT_ROUTE}?token={token}", use_container_width=True)
+        else:
+            cache = get_session_conversation_cache()
+            st.download_button(
+                "Download export",
+                data=lambda: b"".join(export_conversation_lines(cache, since=since, until=until)),
+                file_name="pixel-conversations.ndjson",
+                mime="application/x-ndjson",
+                on_click="ignore",
+                use_container_width=True
+            )
+            st.caption("For very large histories use `python history.py export`, or run the app with serve.py")
+
+        uploaded = st.file_uploader("Import conversations", type=["ndjson", "jsonl"], label_visibility="collapsed")
+        if uploaded is not None and st.button("Import", use_container_width=True, type="primary"):
+            progress = {"imported": 0, "skipped": 0}
+            try:
+                for progress in import_conversation_lines(get_session_conversation_cache(), uploaded, since=since, until=until):
+                    pass
+            except ValueError as e:
+                st.error(f"Error: {e}")
+                return
+            skipped = f", skipped {progress['skipped']} outside the dates" if progress["skipped"] else ""
+            st.session_state.history_import_result = f"Imported {progress['imported']} conversations{skipped}"
+            # The conversation list is another fragment
+            st.rerun()
+
+@st.fragment
+def render_chat_pane():
+    """The chat transcript and the reply being generated.
+
+    Runs as a fragment so paging through the transcript or stopping a reply
+    doesn't rerun the sidebar.
+    """
+    if not st.session_state.messages and st.session_state.generation is None:
+        # Enhanced empty state - personalized by personality
+        current_personality = st.session_state.preferences.get("personality", "Pixel")
+        empty_states = {
+            "Pixel": {
+                "icon": "💖",
+                "title": "Hi there! I'm Pixel! ✨",
+                "message": "I'm super excited to chat with you! Let's talk about anything - I love cute stuff, fun topics, or just having a friendly chat! 🌸"
+            },
+            "Grimalkin": {
+                "icon": "🐱",
+                "title": "Well, well, well... I'm Grimalkin 🐱",
+                "message": "You think you can trust me? How delightfully naive... or did I just plant that thought? 😼 Let's see how this conversation unfolds, shall we?"
+            }
+        }
+        empty_state = empty_states.get(current_personality, empty_states["Pixel"])
+        
+        st.markdown(f"""
+        <div class='empty-state'>
+            <div class='empty-state-icon'>{empty_state['icon']}</div>
+            <h2>{empty_state['title']}</h2>
+            <p>{empty_state['message']}</p>
+            <p style='color: #94a3b8; font-size: 0.95rem; margin-top: 1.5rem; max-width: 400px;'>
+                💝 <strong>Psst!</strong> Check the sidebar for settings and conversation history. All our chats are saved so we can continue later! 
+            </p>
+        </div>
+        """, unsafe_allow_html=True)
+    else:
+        render_chat_window(st.session_state.messages, st.session_state.generation is not None)
+
+class Prewarmer:
+    """Warms process-wide imports and caches once, on a background thread.
+
+    Started by the first session once its page is drawn, or by serve.py when
+    the server starts, so the first reply after a cold start doesn't wait for
+    the SDK import, the pooled client, the token encoding or the conversation
+    headers. The time each step took is kept for serve.py's readiness route.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.state = "pending"
+        self.timings = {}
+        self.errors = {}
+        # Warming runs outside any script run on purpose; don't warn about each Streamlit call it makes
+        logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(
+            lambda record: threading.current_thread() is not self.thread
+        )
+
+    def start(self) -> "Prewarmer":
+        """Start warming unless it has already started"""
+        with self.lock:
+            if self.thread is None:
+                self.state = "running"
+                self.thread = threading.Thread(target=self.run, name="prewarm", daemon=True)
+                self.thread.start()
+        return self
+
+    def run(self):
+        for name, step in (
+            ("sdk", self.import_sdk),
+            ("page_icon", self.load_page_icon),
+            ("client_pool", self.warm_client_pool),
+            ("token_encoding", self.load_token_encoding),
+            ("conversations", self.load_conversation_headers),
+            ("metrics", self.start_metrics)
+        ):
+            started = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                self.errors[name] = f"{type(e).__name__}: {e}"
+            self.timings[name] = round(time.perf_counter() - started, 4)
+        self.state = "done"
+
+    def shared_preferences(self) -> Dict:
+        """Preferences of the unsharded history; per-user ones are only known per session"""
+        return {} if STORAGE_SHARDING else get_preferences_store().load()
+
+    def import_sdk(self):
+        import httpx
+        import openai
+
+    def load_page_icon(self):
+        # st.set_page_config() checks emoji icons against a catalog that is slow to import
+        from streamlit.string_util import is_emoji
+        is_emoji("✨")
+
+    def warm_client_pool(self):
+        api_key = self.shared_preferences().get("api_key")
+        pool = get_client_pool()
+        if api_key:
+            pool.get(api_key, OPENAI_BASE_URL)
+
+    def load_token_encoding(self):
+        get_token_counter().encoding_for(self.shared_preferences().get("model", "gpt-3.5-turbo"))
+
+    def load_conversation_headers(self):
+        if STORAGE_SHARDING:
+            get_shard_map()
+        else:
+            get_conversation_cache().page(None, CONVERSATIONS_PAGE_SIZE)
+
+    def start_metrics(self):
+        if METRICS_ENABLED:
+            get_metrics()
+
+    def status(self) -> Dict:
+        """State, seconds per finished step and step errors"""
+        return {"state": self.state, "seconds": dict(self.timings), "errors": dict(self.errors)}
+
+@st.cache_resource
+def get_prewarmer() -> Prewarmer:
+    """Return the process-wide prewarmer"""
+    return Prewarmer()
+
+def load_theme():
+    """Add the theme stylesheet to the page once per session.
+
+    The loader links the static stylesheet into the document head, where it
+    stays when the loader element itself is gone on the next rerun; the
+    browser caches the file itself.
+    """
+    if st.session_state.get("theme_loaded"):
+        return
+    st.session_state.theme_loaded = True
+    st.html(f"""
+    <script>
+    if (!document.getElementById("pixel-theme")) {{
+        const link = document.createElement("link");
+        link.id = "pixel-theme";
+        link.rel = "stylesheet";
+        link.href = "{THEME_STYLESHEET}";
+        document.head.appendChild(link);
+    }}
+    </script>
+    """, unsafe_allow_javascript=True)
 
 def main():
-    initialize_session_state()
+    with span("session_init"):
+        initialize_session_state()
+    load_theme()
     
     # Sidebar for settings and preferences
     with st.sidebar:
@@ -338,8 +4024,7 @@ def main():
             
             # Allow user to change API key
             if api_key_input:
-                st.session_state.preferences["api_key"] = api_key_input
-                save_preferences(st.session_state.preferences)
+                update_preference("api_key", api_key_input)
                 new_client = get_openai_client(api_key_input, OPENAI_BASE_URL)
                 if new_client:
                     st.session_state.client = new_client
@@ -360,8 +4045,7 @@ def main():
             
             # Update API key if provided
             if api_key_input:
-                st.session_state.preferences["api_key"] = api_key_input
-                save_preferences(st.session_state.preferences)
+                update_preference("api_key", api_key_input)
                 new_client = get_openai_client(api_key_input, OPENAI_BASE_URL)
                 if new_client:
                     st.session_state.client = new_client
@@ -380,193 +4064,11 @@ def main():
         elif not stored_api_key:
             st.session_state.client = None
         
-        # Personality Selection
-        st.markdown("### Personality", unsafe_allow_html=True)
-        default_personality = st.session_state.preferences.get("personality", "Pixel")
-        
-        personality_options = ["Pixel", "Grimalkin"]
-        try:
-            default_personality_index = personality_options.index(default_personality) if default_personality in personality_options else 0
-        except ValueError:
-            default_personality_index = 0
-        
-        selected_personality = st.selectbox(
-            "Select personality",
-            options=personality_options,
-            index=default_personality_index,
-            label_visibility="collapsed",
-            disabled=False
-        )
-        st.session_state.preferences["personality"] = selected_personality
-        save_preferences(st.session_state.preferences)
-        
-        st.markdown("<br>", unsafe_allow_html=True)
-        
-        # Model Selection
-        st.markdown("### Model", unsafe_allow_html=True)
-        # For testing: don't use env model
-        # env_model = os.getenv("OPENAI_MODEL")  # Disabled for testing
-        env_model = None
-        default_model = env_model or st.session_state.preferences.get("model", "gpt-3.5-turbo")
-        
-        model_options = ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo-preview", "gpt-4o-mini", "gpt-4o"]
-        if env_model and env_model not in model_options:
-            model_options.append(env_model)
-        
-        try:
-            default_index = model_options.index(default_model) if default_model in model_options else 0
-        except ValueError:
-            default_index = 0
-        
-        selected_model = st.selectbox(
-            "Select model",
-            options=model_options,
-            index=default_index,
-            label_visibility="collapsed",
-            disabled=False
-        )
-        st.session_state.preferences["model"] = selected_model
-        save_preferences(st.session_state.preferences)
-        
-        st.markdown("<br>", unsafe_allow_html=True)
-        
-        # Temperature Setting
-        st.markdown("### Temperature", unsafe_allow_html=True)
-        temperature = st.session_state.preferences.get("temperature", 0.7)
-        temperature = st.slider(
-            "Temperature",
-            min_value=0.0,
-            max_value=2.0,
-            value=temperature,
-            step=0.1,
-            label_visibility="collapsed",
-            help="Lower = focused, Higher = creative"
-        )
+        render_settings()
         
-        temp_label = "Focused" if temperature < 0.5 else "Balanced" if temperature < 1.0 else "Creative"
-        st.markdown(f"""
-        <div style='display: flex; justify-content: space-between; font-size: 0.8rem; color: #94a3b8; margin-top: -0.5rem;'>
-            <span>{temp_label}</span>
-            <span>{temperature:.1f}</span>
-        </div>
-        """, unsafe_allow_html=True)
-        
-        st.session_state.preferences["temperature"] = temperature
-        save_preferences(st.session_state.preferences)
-        
-        st.markdown("<div style='margin: 2rem 0; border-top: 1px solid rgba(255, 158, 199, 0.2);'></div>", unsafe_allow_html=True)
-        
-        # Conversations Section
-        st.markdown("### Conversations", unsafe_allow_html=True)
-        
-        # New Chat Button
-        if st.button("New Chat", use_container_width=True, type="primary"):
-            st.session_state.messages = []
-            st.session_state.current_conversation_id = None
-            st.rerun()
-        
-        st.markdown("<br>", unsafe_allow_html=True)
+        render_conversation_list()
         
-        # Conversation History
-        if st.session_state.conversations:
-            st.markdown("<div style='max-height: 450px; overflow-y: auto; padding-right: 0.5rem;'>", unsafe_allow_html=True)
-            
-            for conv in reversed(st.session_state.conversations[-10:]):  # Show last 10 conversations
-                conv_id = conv.get("id", "")
-                
-                # Show first user message as conversation title
-                first_user_msg = ""
-                user_msg_count = len([m for m in conv.get("messages", []) if m.get("role") == "user"])
-                
-                for msg in conv.get("messages", []):
-                    if msg.get("role") == "user":
-                        first_user_msg = msg.get("content", "").strip()[:40]
-                        if len(msg.get("content", "").strip()) > 40:
-                            first_user_msg += "..."
-                        break
-                
-                # Highlight if current conversation
-                is_current = conv_id == st.session_state.current_conversation_id
-                
-                # Fun conversation card - properly clickable with visible content
-                bg_color = "#ff9ec7" if is_current else "#fff5f9"
-                border_color = "#e91e63" if is_current else "#ffe0e6"
-                text_color = "#ffffff" if is_current else "#1e293b"
-                count_color = "#ffffff" if is_current else "#64748b"
-                
-                # Create plain button text (truncate long titles)
-                display_title = (first_user_msg if first_user_msg else 'Empty conversation')[:35]
-                if len(first_user_msg or '') > 35:
-                    display_title += "..."
-                button_text = f"{display_title} • {user_msg_count} msgs"
-                
-                # Check if button is clicked
-                if st.button(
-                    button_text,
-                    key=f"conv_{conv_id}",
-                    use_container_width=True,
-                    type="primary" if is_current else "secondary"
-                ):
-                    load_conversation(conv_id)
-                    st.rerun()
-                
-                # Style the button to look like a card
-                st.markdown(f"""
-                <style>
-                    [data-testid="baseButton-{'primary' if is_current else 'secondary'}"][key*="conv_{conv_id}"] {{
-                        background: {bg_color} !important;
-                        border: 2px solid {border_color} !important;
-                        border-radius: 14px !important;
-                        padding: 1rem !important;
-                        margin-bottom: 0.75rem !important;
-                        height: auto !important;
-                        min-height: auto !important;
-                        transition: all 0.3s cubic-bezier(0.34, 1.56, 0.64, 1) !important;
-                        box-shadow: 0 2px 8px rgba(255, 158, 199, 0.2) !important;
-                        cursor: pointer !important;
-                        text-align: left !important;
-                        justify-content: flex-start !important;
-                    }}
-                    [data-testid="baseButton-{'primary' if is_current else 'secondary'}"][key*="conv_{conv_id}"]:hover {{
-                        transform: translateY(-2px) scale(1.02) !important;
-                        box-shadow: 0 4px 12px rgba(255, 158, 199, 0.3) !important;
-                    }}
-                    [data-testid="baseButton-{'primary' if is_current else 'secondary'}"][key*="conv_{conv_id}"] > div {{
-                        width: 100% !important;
-                        text-align: left !important;
-                        color: {text_color} !important;
-                        font-size: 0.9rem !important;
-                        font-weight: 600 !important;
-                        line-height: 1.4 !important;
-                        white-space: nowrap !important;
-                        overflow: hidden !important;
-                        text-overflow: ellipsis !important;
-                    }}
-                </style>
-                """, unsafe_allow_html=True)
-            
-            st.markdown("</div>", unsafe_allow_html=True)
-            
-            # Delete current conversation (only show if there's an active conversation)
-            if st.session_state.current_conversation_id:
-                st.markdown("<br>", unsafe_allow_html=True)
-                if st.button("Delete Current", use_container_width=True, type="secondary"):
-                    st.session_state.conversations = [
-                        conv for conv in st.session_state.conversations
-                        if conv.get("id") != st.session_state.current_conversation_id
-                    ]
-                    save_conversations(st.session_state.conversations)
-                    st.session_state.messages = []
-                    st.session_state.current_conversation_id = None
-                    st.rerun()
-        else:
-            st.markdown("""
-            <div style='text-align: center; padding: 3rem 1rem;'>
-                <div style='font-size: 2.5rem; margin-bottom: 1rem; opacity: 0.7;'>💕</div>
-                <div style='font-size: 0.9rem; color: #e2e8f0;'>No conversations yet</div>
-                <div style='font-size: 0.8rem; margin-top: 0.5rem; opacity: 0.7; color: #94a3b8;'>Start chatting with Pixel! ✨</div>
-            </div>
-            """, unsafe_allow_html=True)
+        render_history_transfer()
         
         # Version display at bottom of sidebar
         st.markdown("<div style='margin-top: 3rem; border-top: 1px solid rgba(255, 158, 199, 0.2); padding-top: 1.5rem;'></div>", unsafe_allow_html=True)
@@ -575,70 +4077,13 @@ def main():
             <div style='font-size: 0.75rem; color: #94a3b8; opacity: 0.7;'>Version {APP_VERSION}</div>
         </div>
         """, unsafe_allow_html=True)
-    
-    # Inject additional CSS to override Streamlit defaults
-    st.markdown("""
-    <style>
-    /* Force override Streamlit's default chat message styles */
-    div[data-testid="stChatMessageUser"] > div > div {
-        background: linear-gradient(135deg, #ff9ec7 0%, #e91e63 100%) !important;
-        border-radius: 20px 20px 6px 20px !important;
-    }
-    
-    div[data-testid="stChatMessageAssistant"] > div > div {
-        background: linear-gradient(135deg, #ffffff 0%, #fff5f9 100%) !important;
-        border: 2px solid #ffe0e6 !important;
-        border-radius: 20px 20px 20px 6px !important;
-    }
-    
-    /* Use JavaScript to apply styles after DOM loads */
-    </style>
-    <script>
-    function applyChatStyles() {
-        // Force style user messages
-        document.querySelectorAll('[data-testid="stChatMessageUser"]').forEach(msg => {
-            const contentDiv = msg.querySelector('div > div');
-            if (contentDiv) {
-                contentDiv.style.background = 'linear-gradient(135deg, #ff9ec7 0%, #e91e63 100%)';
-                contentDiv.style.borderRadius = '20px 20px 6px 20px';
-                contentDiv.style.padding = '1rem 1.25rem';
-                contentDiv.style.boxShadow = '0 4px 12px rgba(255, 158, 199, 0.35), 0 2px 4px rgba(233, 30, 99, 0.2)';
-                contentDiv.style.color = 'white';
-            }
-        });
-        
-        // Force style assistant messages
-        document.querySelectorAll('[data-testid="stChatMessageAssistant"]').forEach(msg => {
-            const contentDiv = msg.querySelector('div > div');
-            if (contentDiv) {
-                contentDiv.style.background = 'linear-gradient(135deg, #ffffff 0%, #fff5f9 100%)';
-                contentDiv.style.border = '2px solid #ffe0e6';
-                contentDiv.style.borderRadius = '20px 20px 20px 6px';
-                contentDiv.style.padding = '1rem 1.25rem';
-                contentDiv.style.boxShadow = '0 4px 12px rgba(0, 0, 0, 0.08), 0 2px 4px rgba(255, 158, 199, 0.1)';
-                contentDiv.style.color = '#1e293b';
-            }
-        });
         
-        // Style text in messages
-        document.querySelectorAll('[data-testid="stChatMessageUser"] .stMarkdown, [data-testid="stChatMessageUser"] p, [data-testid="stChatMessageUser"] span').forEach(el => {
-            el.style.color = 'white';
-        });
-        
-        document.querySelectorAll('[data-testid="stChatMessageAssistant"] .stMarkdown, [data-testid="stChatMessageAssistant"] .stMarkdown *').forEach(el => {
-            el.style.color = '#1e293b';
-        });
-    }
-    
-    // Apply immediately and watch for new messages
-    applyChatStyles();
-    setInterval(applyChatStyles, 500);
-    
-    // Also apply when DOM is updated
-    const observer = new MutationObserver(applyChatStyles);
-    observer.observe(document.body, { childList: true, subtree: true });
-    </script>
-    """, unsafe_allow_html=True)
+        if SHOW_MEMORY_USAGE:
+            cache_stats = get_session_conversation_cache().stats()
+            st.caption(
+                f"Session state ≈ {get_session_memory_usage() / 1024:.1f} KB · "
+                f"shared cache {cache_stats['body_bytes'] / 1024:.1f} KB in {cache_stats['bodies']} conversations"
+            )
     
     # Main chat interface
     # Get selected personality for header
@@ -655,39 +4100,11 @@ def main():
     # Display chat messages with better formatting
     chat_container = st.container(height=550)
     with chat_container:
-        if not st.session_state.messages:
-            # Enhanced empty state - personalized by personality
-            current_personality = st.session_state.preferences.get("personality", "Pixel")
-            empty_states = {
-                "Pixel": {
-                    "icon": "💖",
-                    "title": "Hi there! I'm Pixel! ✨",
-                    "message": "I'm super excited to chat with you! Let's talk about anything - I love cute stuff, fun topics, or just having a friendly chat! 🌸"
-                },
-                "Grimalkin": {
-                    "icon": "🐱",
-                    "title": "Well, well, well... I'm Grimalkin 🐱",
-                    "message": "You think you can trust me? How delightfully naive... or did I just plant that thought? 😼 Let's see how this conversation unfolds, shall we?"
-                }
-            }
-            empty_state = empty_states.get(current_personality, empty_states["Pixel"])
-            
-            st.markdown(f"""
-            <div class='empty-state'>
-                <div class='empty-state-icon'>{empty_state['icon']}</div>
-                <h2>{empty_state['title']}</h2>
-                <p>{empty_state['message']}</p>
-                <p style='color: #94a3b8; font-size: 0.95rem; margin-top: 1.5rem; max-width: 400px;'>
-                    💝 <strong>Psst!</strong> Check the sidebar for settings and conversation history. All our chats are saved so we can continue later! 
-                </p>
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            for message in st.session_state.messages:
-                avatar = "✨" if message["role"] == "assistant" else None
-                with st.chat_message(message["role"], avatar=avatar):
-                    # Render markdown properly - CSS will force dark text for assistant
-                    st.markdown(message["content"])
+        render_chat_pane()
+        
+        # Called only while a reply is pending, so its timed refreshes stop with it
+        if st.session_state.generation is not None:
+            render_generation()
     
     st.markdown("<br>", unsafe_allow_html=True)
     
@@ -699,49 +4116,23 @@ def main():
     }
     placeholder = placeholder_texts.get(current_personality, placeholder_texts["Pixel"]) if st.session_state.client else "⚠️ Please configure API key in settings..."
     
-    if prompt := st.chat_input(placeholder, disabled=not st.session_state.client):
-        # Add user message to chat
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.markdown(prompt)
-        
+    is_generating = st.session_state.generation is not None
+    if prompt := st.chat_input(placeholder, disabled=not st.session_state.client or is_generating):
         # Get AI response
         if not st.session_state.client:
+            st.session_state.messages.append({"role": "user", "content": prompt})
+            with st.chat_message("user"):
+                st.markdown(prompt)
             with st.chat_message("assistant"):
                 st.error("Please enter your OpenAI API key in the sidebar settings.")
-        else:
-            with st.chat_message("assistant", avatar="✨"):
-                # Enhanced loading state
-                personality_name = st.session_state.preferences.get("personality", "Pixel")
-                spinner_emojis = {"Pixel": "💖", "Grimalkin": "🐱"}
-                spinner_emoji = spinner_emojis.get(personality_name, "💖")
-                with st.spinner(f"{spinner_emoji} {personality_name} is thinking..."):
-                    # Use selected model from preferences (for testing: no env fallback)
-                    model = st.session_state.preferences.get("model", "gpt-3.5-turbo")
-                    
-                    response = get_openai_response(
-                        st.session_state.messages,
-                        model,
-                        st.session_state.preferences.get("temperature", 0.7),
-                        st.session_state.client,
-                        st.session_state.preferences.get("personality", "Pixel")
-                    )
-                    
-                    # Check if response is an error
-                    if response.startswith("Error:"):
-                        st.error(response)
-                    else:
-                        # Render markdown - CSS will force dark text
-                        st.markdown(response)
-            
-            st.session_state.messages.append({"role": "assistant", "content": response})
-            
-            # Save conversation
-            save_current_conversation()
-            
-            # Rerun to update the chat
+        elif submit_generation(prompt):
+            # Rerun so the chat pane picks up the new message and the pending reply
             st.rerun()
 
-if __name__ == "__main__":
+    # Import the SDK and warm the shared caches while the visitor reads the page
+    get_prewarmer().start()
+
+# serve.py runs this file with PREWARM_ONLY set to reach the process-wide caches without drawing a page
+if __name__ == "__main__" and not globals().get("PREWARM_ONLY"):
     main()
 
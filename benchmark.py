@@ -0,0 +1,502 @@
+"""Storage and rendering benchmarks over synthetic conversation histories.
+
+Generates histories of 100, 10k and 100k conversations of varying length
+(``--scales``) and times the paths that grow with history size:
+
+- ``save_conversations()`` and cold ``load_conversations()``
+- ``save_current_conversation()`` per chat turn in an existing conversation
+- ``load_conversation()`` lookups, first and repeated
+- the sidebar: first page of headers with card titles and counts, cold and warm
+- request assembly as a chat turn does it: ``build_context_window()``, then a
+  ``GenerationJob`` streaming the reply from a stubbed client
+
+Results are written as JSON (``--output``). With ``--baseline`` the medians are
+compared against an earlier report and the run fails if any got slower by more
+than ``--threshold``:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json --output current.json
+
+Data files are written to a temporary directory, one per backend and scale.
+``--format`` picks the JSON backend's storage format; the report records the
+bytes on disk after ``save_conversations()``.
+
+The ``startup`` suite (``--suites``) measures a cold start, each sample in a
+fresh Python process:
+
+- import time of streamlit, of app.py's module level, and of the openai SDK
+  that the first page no longer needs
+- time to first render: the first script run of a session, the whole cold
+  start from process launch, and a warm rerun for comparison
+- ``streamlit run serve.py`` until ``/healthz`` answers, the latency of
+  ``/healthz``, and until ``/readyz`` reports the caches warm
+
+    python benchmark.py --suites startup --startup-runs 10
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_DIR)
+# app.py runs in bare mode here, without a script run context, by design
+for logger_name in ("streamlit.runtime.scriptrunner_utils.script_run_context", "streamlit.runtime.state.session_state_proxy"):
+    logging.getLogger(logger_name).addFilter(lambda record: record.levelno >= logging.ERROR)
+import streamlit as st  # noqa: E402
+import app  # noqa: E402
+
+# Report format version, bumped when metric names or units change
+REPORT_VERSION = 1
+
+# Words the synthetic messages are made of
+WORDS = (
+    "pixel", "chat", "hello", "how", "do", "i", "make", "a", "cute", "website", "with", "pink",
+    "buttons", "and", "sparkles", "sure", "here", "is", "an", "idea", "you", "could", "try",
+    "python", "streamlit", "storage", "question", "answer", "thanks", "great", "more", "please"
+)
+
+# Mean user/assistant turns per conversation; lengths follow an exponential distribution
+MEAN_TURNS = 3
+MAX_TURNS = 200
+
+# Startup samples run in fresh processes; each prints its timings (seconds) as JSON
+IMPORT_SAMPLE = """
+import json, sys, time
+started = time.perf_counter()
+import streamlit
+streamlit_done = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app
+app_done = time.perf_counter()
+sdk_deferred = "openai" not in sys.modules
+import openai
+print(json.dumps({
+    "import_streamlit": streamlit_done - started,
+    "import_app": app_done - streamlit_done,
+    "import_sdk": time.perf_counter() - app_done,
+    "sdk_deferred": sdk_deferred
+}))
+"""
+RENDER_SAMPLE = """
+import json, sys, threading, time
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+started = time.perf_counter()
+at.run()
+first_done = time.perf_counter()
+launch_to_first_render = time.time() - float(sys.argv[2])
+# Let the background warm-up finish so the rerun is a warm one
+while any(thread.name == "prewarm" for thread in threading.enumerate()):
+    time.sleep(0.01)
+rerun_started = time.perf_counter()
+at.run()
+print(json.dumps({
+    "first_render": first_done - started,
+    "launch_to_first_render": launch_to_first_render,
+    "rerun": time.perf_counter() - rerun_started,
+    "exception": bool(at.exception)
+}))
+"""
+
+class StubCompletions:
+    """Answers every request instantly, streamed in a few chunks if asked to"""
+
+    def create(self, **kwargs):
+        if kwargs.get("stream"):
+            return iter([
+                types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=part))], usage=None)
+                for part in ("Stubbed ", "streamed ", "reply")
+            ])
+        message = types.SimpleNamespace(content="Stubbed reply", role="assistant")
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None)
+
+class StubClient:
+    """Stands in for an OpenAI client so only local work is timed"""
+
+    base_url = "http://benchmark.invalid/v1/"
+
+    def __init__(self):
+        self.chat = types.SimpleNamespace(completions=StubCompletions())
+
+def synthetic_text(rng: random.Random, low: int, high: int) -> str:
+    """A sentence of ``low`` to ``high`` words"""
+    return " ".join(rng.choices(WORDS, k=rng.randint(low, high))).capitalize()
+
+def synthetic_history(count: int, seed: int) -> List[Dict]:
+    """``count`` conversations of varying length, oldest first"""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    history = []
+    for i in range(count):
+        turns = min(MAX_TURNS, int(rng.expovariate(1 / MEAN_TURNS)) + 1)
+        messages = []
+        for _ in range(turns):
+            messages.append({"role": "user", "content": synthetic_text(rng, 3, 20)})
+            messages.append({"role": "assistant", "content": synthetic_text(rng, 8, 60)})
+        history.append({
+            "id": f"bench_{i:06d}",
+            "timestamp": (start + timedelta(minutes=5 * i)).isoformat(),
+            "messages": messages
+        })
+    return history
+
+def measure(operation: Callable, repeat: int, setup: Optional[Callable] = None) -> Dict:
+    """Run ``operation`` ``repeat`` times (after ``setup`` each time) and summarize in milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        operation()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+def summarize(samples: List[float]) -> Dict:
+    """Median, min, mean and max of samples (seconds) in milliseconds"""
+    return {
+        "runs": len(samples),
+        "median_ms": round(statistics.median(samples) * 1000, 3),
+        "min_ms": round(min(samples) * 1000, 3),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3)
+    }
+
+def reset_storage():
+    """Drop the process-wide store and cache so the next call reads from disk"""
+    app.get_conversation_cache.clear()
+
+def reset_session():
+    """Start a fresh session state"""
+    for key in list(st.session_state.keys()):
+        del st.session_state[key]
+    st.session_state.preferences = {}
+    st.session_state.client = None
+    app.initialize_session_state()
+
+def render_sidebar_page(cursor=None) -> List[str]:
+    """The sidebar's work for one page of conversations: headers, titles and counts"""
+    page = app.list_conversation_page(cursor)
+    labels = [app.format_conversation_label(header["metadata"]) for header in page["headers"]]
+    labels.append(f"{page['first']}–{page['last']} of {page['total']}")
+    return labels
+
+def disk_bytes(directory: str = ".") -> int:
+    """Total size of the files under directory"""
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def benchmark_scale(backend: str, scale: int, args: argparse.Namespace) -> Dict:
+    """Run every benchmark against one backend and history size"""
+    rng = random.Random(args.seed)
+    history = synthetic_history(scale, args.seed)
+    # Whole-history operations are slow at the largest scales; time them fewer times
+    heavy_repeat = args.repeat if scale <= 10000 else 1
+    results = {"history": {
+        "conversations": scale,
+        "messages": sum(len(conv["messages"]) for conv in history)
+    }}
+
+    app.STORAGE_BACKEND = backend
+    reset_storage()
+    results["save_conversations"] = measure(lambda: app.save_conversations(history), heavy_repeat)
+    results["history"]["disk_bytes"] = disk_bytes()
+
+    results["load_conversations"] = measure(app.load_conversations, heavy_repeat, setup=reset_storage)
+
+    results["sidebar_first_page_cold"] = measure(render_sidebar_page, heavy_repeat, setup=reset_storage)
+    results["sidebar_first_page_warm"] = measure(render_sidebar_page, args.repeat * 10)
+    middle = app.ConversationCache.order_key(history[scale // 2])
+    results["sidebar_middle_page_warm"] = measure(lambda: render_sidebar_page(middle), args.repeat * 10)
+
+    lookups = rng.sample([conv["id"] for conv in history], min(args.lookups, scale))
+    reset_session()
+    reset_storage()
+    app.list_conversation_page(None)
+    first, repeated = [], []
+    for samples in (first, repeated):
+        for conv_id in lookups:
+            started = time.perf_counter()
+            app.load_conversation(conv_id)
+            samples.append(time.perf_counter() - started)
+    results["load_conversation_first"] = summarize(first)
+    results["load_conversation_repeat"] = summarize(repeated)
+
+    # Chat turns appended to an existing conversation, each followed by a save
+    reset_session()
+    app.load_conversation(lookups[0])
+    turn_samples = []
+    for turn in range(args.turns):
+        st.session_state.messages.append({"role": "user", "content": synthetic_text(rng, 3, 20)})
+        st.session_state.messages.append({"role": "assistant", "content": synthetic_text(rng, 8, 60)})
+        started = time.perf_counter()
+        app.save_current_conversation()
+        turn_samples.append(time.perf_counter() - started)
+    results["save_current_conversation_turn"] = summarize(turn_samples)
+
+    # Request assembly for a typical and the longest conversation, the way submit_generation() does it
+    client = StubClient()
+    by_length = sorted(history, key=lambda conv: len(conv["messages"]))
+    for name, conv in (("median", by_length[len(by_length) // 2]), ("longest", by_length[-1])):
+        messages = conv["messages"]
+        results[f"context_window_{name}"] = dict(
+            measure(lambda: app.build_context_window(messages, "gpt-3.5-turbo"), args.repeat * 10),
+            messages=len(messages)
+        )
+        results[f"generation_{name}"] = dict(
+            measure(lambda: run_generation(messages, client), args.repeat * 10),
+            messages=len(messages)
+        )
+    return results
+
+def run_generation(messages: List[Dict], client: StubClient) -> str:
+    """Assemble the request for a turn and stream its reply on this thread"""
+    request_messages, dropped_count = app.build_context_window(messages, "gpt-3.5-turbo")
+    job = app.GenerationJob(request_messages, "gpt-3.5-turbo", 0.7, client, "Pixel", dropped_count, None)
+    job.run()
+    return job.text
+
+def run_sample(code: str, *args: str) -> Dict:
+    """Run a startup sample in a fresh interpreter and return its timings"""
+    result = subprocess.run([sys.executable, "-c", code, *args], capture_output=True, text=True, timeout=300)
+    if result.returncode != 0:
+        raise RuntimeError(f"startup sample failed: {result.stderr.strip()[-500:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def free_port() -> int:
+    """A TCP port nothing is listening on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def http_status(url: str) -> Optional[int]:
+    """Status of a GET request, or None if nothing answered"""
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+def wait_for(url: str, deadline: float, process: subprocess.Popen) -> float:
+    """Poll ``url`` until it returns 200; returns when that happened (perf_counter)"""
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with status {process.returncode}")
+        if http_status(url) == 200:
+            return time.perf_counter()
+        time.sleep(0.01)
+    raise TimeoutError(f"{url} did not answer in time")
+
+def server_sample(timeout: float) -> Dict:
+    """Start serve.py and time /healthz and /readyz"""
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", os.path.join(APP_DIR, "serve.py"), "--server.port", str(port),
+         "--server.address", "127.0.0.1", "--server.headless", "true", "--browser.gatherUsageStats", "false"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = started + timeout
+        healthy = wait_for(f"{base}/healthz", deadline, process)
+        probes = []
+        for _ in range(5):
+            probe_started = time.perf_counter()
+            http_status(f"{base}/healthz")
+            probes.append(time.perf_counter() - probe_started)
+        ready = wait_for(f"{base}/readyz", deadline, process)
+        return {
+            "server_to_healthy": healthy - started,
+            "healthz": statistics.median(probes),
+            "server_to_ready": ready - started
+        }
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def benchmark_startup(args: argparse.Namespace) -> Dict:
+    """Time cold starts, each sample in a fresh process"""
+    # Sessions find a stored key, so the lazy client path is what gets measured; no request is sent
+    with open("preferences.json", "w", encoding="utf-8") as f:
+        json.dump({"api_key": "sk-benchmark"}, f)
+    samples = {}
+    for run in range(args.startup_runs):
+        print(f"Startup sample {run + 1}/{args.startup_runs}...", file=sys.stderr)
+        timings = dict(run_sample(IMPORT_SAMPLE, APP_DIR))
+        timings.update(run_sample(RENDER_SAMPLE, os.path.join(APP_DIR, "app.py"), repr(time.time())))
+        if timings.pop("exception"):
+            raise RuntimeError("the first render raised an exception")
+        if not timings.pop("sdk_deferred"):
+            print("  note: importing app.py imported the openai SDK", file=sys.stderr)
+        timings.update(server_sample(args.timeout))
+        for name, seconds in timings.items():
+            samples.setdefault(name, []).append(seconds)
+    return {name: summarize(values) for name, values in samples.items()}
+
+def compare(current: Dict, baseline: Dict, threshold: float, noise_ms: float) -> Dict:
+    """Compare medians with a baseline report; slower by more than ``threshold`` is a regression"""
+    rows = []
+    for backend, scales in current["results"].items():
+        for scale, metrics in scales.items():
+            for metric, stats in metrics.items():
+                before = baseline.get("results", {}).get(backend, {}).get(scale, {}).get(metric)
+                if "median_ms" not in stats or not before or "median_ms" not in before:
+                    continue
+                ratio = stats["median_ms"] / before["median_ms"] if before["median_ms"] else None
+                delta = stats["median_ms"] - before["median_ms"]
+                status = "ok"
+                if ratio is not None and abs(delta) >= noise_ms:
+                    if ratio > 1 + threshold:
+                        status = "regression"
+                    elif ratio < 1 / (1 + threshold):
+                        status = "improvement"
+                rows.append({
+                    "backend": backend,
+                    "scale": scale,
+                    "metric": metric,
+                    "baseline_ms": before["median_ms"],
+                    "current_ms": stats["median_ms"],
+                    "ratio": round(ratio, 3) if ratio is not None else None,
+                    "status": status
+                })
+    return {
+        "threshold": threshold,
+        "noise_ms": noise_ms,
+        "regressions": sum(1 for row in rows if row["status"] == "regression"),
+        "improvements": sum(1 for row in rows if row["status"] == "improvement"),
+        "metrics": rows
+    }
+
+def print_report(report: Dict):
+    """Print medians, and the baseline comparison if there is one"""
+    for backend, scales in report["results"].items():
+        for scale, metrics in scales.items():
+            history = metrics.get("history")
+            if history:
+                print(f"{backend}, {history['conversations']} conversations ({history['messages']} messages, "
+                      f"{history['disk_bytes'] / 2**20:.1f} MB on disk)", file=sys.stderr)
+            else:
+                print(f"{backend}, {scale}", file=sys.stderr)
+            for metric, stats in metrics.items():
+                if "median_ms" in stats:
+                    print(f"  {metric:<32} {stats['median_ms']:>12.3f} ms  (min {stats['min_ms']:.3f}, {stats['runs']} runs)", file=sys.stderr)
+    comparison = report.get("comparison")
+    if comparison:
+        print(f"Against baseline: {comparison['regressions']} regressions, {comparison['improvements']} improvements "
+              f"(threshold {comparison['threshold']:.0%})", file=sys.stderr)
+        for row in comparison["metrics"]:
+            if row["status"] != "ok":
+                print(f"  {row['status']:<11} {row['backend']}/{row['scale']}/{row['metric']}: "
+                      f"{row['baseline_ms']} ms -> {row['current_ms']} ms (x{row['ratio']})", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark conversation storage and rendering paths")
+    parser.add_argument("--suites", default="storage,startup", help="comma-separated suites: storage, startup")
+    parser.add_argument("--scales", default="100,10000,100000", help="comma-separated history sizes")
+    parser.add_argument("--backends", default="json,sqlite", help="comma-separated storage engines")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement (default 3)")
+    parser.add_argument("--lookups", type=int, default=50, help="conversations opened per scale (default 50)")
+    parser.add_argument("--turns", type=int, default=20, help="chat turns saved per scale (default 20)")
+    parser.add_argument("--format", choices=app.STORAGE_FORMATS, default=app.STORAGE_FORMAT,
+                        help="JSON backend storage format (default PIXEL_STORAGE_FORMAT or compact)")
+    parser.add_argument("--seed", type=int, default=1234, help="seed for the synthetic histories")
+    parser.add_argument("--startup-runs", type=int, default=5, help="fresh processes per startup measurement (default 5)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds allowed for the server to get ready")
+    parser.add_argument("--output", metavar="PATH", help="write the JSON report here (default stdout)")
+    parser.add_argument("--baseline", metavar="PATH", help="compare against an earlier report")
+    parser.add_argument("--threshold", type=float, default=0.25, help="slowdown counted as a regression (default 0.25 = 25%%)")
+    parser.add_argument("--noise-ms", type=float, default=0.05, help="ignore differences smaller than this")
+    args = parser.parse_args()
+
+    report = {
+        "version": REPORT_VERSION,
+        "created": datetime.now().isoformat(),
+        "app_version": app.APP_VERSION,
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "streamlit": st.__version__
+        },
+        "config": {
+            "suites": args.suites.split(","),
+            "scales": [int(scale) for scale in args.scales.split(",")],
+            "backends": args.backends.split(","),
+            "repeat": args.repeat,
+            "lookups": args.lookups,
+            "turns": args.turns,
+            "format": args.format,
+            "seed": args.seed,
+            "startup_runs": args.startup_runs
+        },
+        "results": {}
+    }
+
+    app.STORAGE_FORMAT = args.format
+    previous_dir = os.getcwd()
+    try:
+        if "storage" in report["config"]["suites"]:
+            for backend in report["config"]["backends"]:
+                report["results"][backend] = {}
+                for scale in report["config"]["scales"]:
+                    workdir = tempfile.mkdtemp(prefix="pixel-bench-")
+                    os.chdir(workdir)
+                    try:
+                        print(f"Running {backend} with {scale} conversations...", file=sys.stderr)
+                        report["results"][backend][str(scale)] = benchmark_scale(backend, scale, args)
+                    finally:
+                        reset_storage()
+                        os.chdir(previous_dir)
+                        shutil.rmtree(workdir, ignore_errors=True)
+        if "startup" in report["config"]["suites"]:
+            # The samples' processes inherit this working directory
+            workdir = tempfile.mkdtemp(prefix="pixel-bench-")
+            os.chdir(workdir)
+            try:
+                report["results"]["startup"] = {"cold": benchmark_startup(args)}
+            finally:
+                os.chdir(previous_dir)
+                shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        os.chdir(previous_dir)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["comparison"] = compare(report, json.load(f), args.threshold, args.noise_ms)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    sys.exit(1 if report.get("comparison", {}).get("regressions") else 0)
+
+if __name__ == "__main__":
+    main()
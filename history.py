@@ -0,0 +1,201 @@
+"""Bulk export and import of the conversation history as NDJSON.
+
+One conversation per line, streamed one at a time in both directions, so
+memory stays flat however large the history is; multi-GB histories can be
+moved or backed up without loading them:
+
+    python history.py export -o backup.ndjson
+    python history.py export -o backup.ndjson --resume
+    python history.py import backup.ndjson
+    python history.py import backup.ndjson --offset 1048576
+
+Exports are ordered by last update, oldest first. ``--resume`` continues an
+interrupted export after the last complete line of the output file, which
+also picks up conversations updated since. ``--offset`` cuts an export file
+at that byte first, or starts an import at that byte. Imports are written
+in batches of ``--batch-size`` conversations, one storage write each; a
+conversation with an id that is already stored replaces it. Import progress
+is reported with the offset to resume from if the import is interrupted.
+
+``--id``, ``--since`` and ``--until`` select conversations in both
+directions; dates bound the last update and are inclusive. The history is
+the one in ``--dir`` (the working directory by default; an import creates
+it), or with per-user storage the one of ``--user`` (e.g.
+``account:alice@example.com``).
+Storage settings come from the same PIXEL_* variables as the app. Stop the
+app first when importing into the JSON backend from another process.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from typing import Dict, Optional, Tuple
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_DIR)
+# app.py runs in bare mode here, without a script run context, by design
+for logger_name in ("streamlit.runtime.scriptrunner_utils.script_run_context", "streamlit.runtime.state.session_state_proxy"):
+    logging.getLogger(logger_name).addFilter(lambda record: record.levelno >= logging.ERROR)
+import app  # noqa: E402
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 2.0
+
+def read_line_before(f, end: int) -> bytes:
+    """The complete line ending at byte ``end`` of a file, read backwards in chunks"""
+    start = end - 1
+    chunk_size = 64 * 1024
+    while start > 0:
+        read_from = max(0, start - chunk_size)
+        f.seek(read_from)
+        newline = f.read(start - read_from).rfind(b"\n")
+        if newline != -1:
+            start = read_from + newline + 1
+            break
+        start = read_from
+    f.seek(start)
+    return f.read(end - start)
+
+def prepare_export_file(path: str, offset: Optional[int], resume: bool) -> Tuple[int, Optional[Tuple[str, str]]]:
+    """Cut an export file for resuming: the offset to append at and the order key of its last line"""
+    if not offset and not (resume and os.path.exists(path)):
+        return 0, None
+    with open(path, 'r+b') as f:
+        size = f.seek(0, os.SEEK_END)
+        if resume:
+            # Drop a line torn by the interruption
+            offset = size
+            if size:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    offset -= len(read_line_before(f, size))
+        if offset > size:
+            raise ValueError(f"offset {offset} is past the end of {path} ({size} bytes)")
+        if offset:
+            f.seek(offset - 1)
+            if f.read(1) != b"\n":
+                raise ValueError(f"offset {offset} is not at the end of a line in {path}")
+        f.truncate(offset)
+        if not offset:
+            return 0, None
+        last = json.loads(read_line_before(f, offset))
+        return offset, app.ConversationCache.order_key(last)
+
+def get_directory(args: argparse.Namespace, create: bool = False) -> str:
+    """Directory of the history the command works on, created first for an import"""
+    if args.user and not app.STORAGE_SHARDING:
+        raise ValueError("--user needs PIXEL_STORAGE_SHARDING=user")
+    directory = app.get_shard_map().directory(args.user) if args.user else args.dir
+    if create:
+        os.makedirs(directory, exist_ok=True)
+    elif not os.path.isdir(directory):
+        raise ValueError(f"no such directory: {directory}")
+    return directory
+
+def export_history(args: argparse.Namespace) -> Dict:
+    """Write the selected conversations to the output file (or stdout)"""
+    to_stdout = args.output == "-"
+    if to_stdout and (args.resume or args.offset):
+        raise ValueError("--resume and --offset need an output file")
+    offset, after = (0, None) if to_stdout else prepare_export_file(args.output, args.offset, args.resume)
+    cache = app.get_conversation_cache(get_directory(args))
+    exported = 0
+    reported = time.monotonic()
+    out = sys.stdout.buffer if to_stdout else open(args.output, 'ab' if offset else 'wb')
+    try:
+        for line in app.export_conversation_lines(cache, after, args.id, args.since, args.until):
+            out.write(line)
+            exported += 1
+            offset += len(line)
+            if not to_stdout and time.monotonic() - reported >= PROGRESS_INTERVAL:
+                reported = time.monotonic()
+                print(f"exported {exported} conversations, {offset} bytes", file=sys.stderr)
+        out.flush()
+        if not to_stdout:
+            os.fsync(out.fileno())
+    finally:
+        if not to_stdout:
+            out.close()
+    return {"exported": exported, "offset": offset}
+
+def import_history(args: argparse.Namespace) -> Dict:
+    """Store the selected conversations of the input file (or stdin)"""
+    if args.batch_size < 1:
+        raise ValueError("--batch-size must be at least 1")
+    from_stdin = args.input == "-"
+    if from_stdin and args.offset:
+        raise ValueError("--offset needs an input file")
+    # Straight to the store: nothing here lists conversations, so their headers needn't be cached
+    store = app.get_conversation_store(get_directory(args, create=True))
+    progress = {"imported": 0, "skipped": 0, "offset": args.offset or 0}
+    reported = time.monotonic()
+    f = sys.stdin.buffer if from_stdin else open(args.input, 'rb')
+    try:
+        if not from_stdin:
+            f.seek(progress["offset"])
+        try:
+            for progress in app.import_conversation_lines(store, f, progress["offset"], args.id, args.since,
+                                                          args.until, args.batch_size):
+                if time.monotonic() - reported >= PROGRESS_INTERVAL:
+                    reported = time.monotonic()
+                    print(f"imported {progress['imported']} conversations, at byte {progress['offset']}", file=sys.stderr)
+        except (KeyboardInterrupt, ValueError):
+            print(f"import stopped; resume with --offset {progress['offset']}", file=sys.stderr)
+            raise
+    finally:
+        if not from_stdin:
+            f.close()
+        finish_writes(store)
+    return progress
+
+def finish_writes(store: "app.ConversationStore"):
+    """Let a background compaction finish, then fold the rest of the journal into the snapshot.
+
+    Compaction runs on a daemon thread, which would be cut short when this
+    process exits; what is imported is folded in now rather than on the
+    app's next write.
+    """
+    if isinstance(store, app.JsonConversationStore):
+        while store.compacting:
+            time.sleep(0.1)
+        store.compact()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import Pixel Chat conversations as NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write conversations to an NDJSON file")
+    export_parser.add_argument("-o", "--output", default="-", help="output file ('-' for stdout, the default)")
+    export_parser.add_argument("--resume", action="store_true", help="continue after the last complete line of the output file")
+    import_parser = commands.add_parser("import", help="store the conversations of an NDJSON file")
+    import_parser.add_argument("input", help="input file ('-' for stdin)")
+    import_parser.add_argument("--batch-size", type=int, default=app.IMPORT_BATCH_SIZE,
+                               help=f"conversations per storage write (default {app.IMPORT_BATCH_SIZE})")
+    for command in (export_parser, import_parser):
+        command.add_argument("--offset", type=int, help="byte offset in the file to resume at")
+        command.add_argument("--id", action="append", help="only this conversation id (repeatable)")
+        command.add_argument("--since", default="", help="only conversations last updated on or after this ISO date/time")
+        command.add_argument("--until", default="", help="only conversations last updated on or before this ISO date/time")
+        command.add_argument("--dir", default=".", help="directory holding the history (default: current directory)")
+        command.add_argument("--user", help="with PIXEL_STORAGE_SHARDING=user, the user key whose history to use")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "export":
+            result = export_history(args)
+            print(f"exported {result['exported']} conversations ({result['offset']} bytes)", file=sys.stderr)
+        else:
+            result = import_history(args)
+            skipped = f", skipped {result['skipped']}" if result["skipped"] else ""
+            print(f"imported {result['imported']} conversations{skipped} ({result['offset']} bytes read)", file=sys.stderr)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""Load driver: simulates concurrent chat sessions against a mock OpenAI server.
+
+Each simulated session is a headless Streamlit session (``streamlit.testing``)
+running app.py in this process, so the process-wide caches, worker pool and
+client pool are shared exactly as they are by browser sessions on a real
+server. The testing harness keeps global state while a script runs, so
+script runs are serialized; replies are still generated concurrently on the
+app's worker pool, as they would be in production. Replies come from
+mock_openai.py, started in-process unless ``--base-url`` points at one that
+is already running:
+
+    python loadtest.py --sessions 20 --turns 5 --latency 0.3 --tokens-per-second 40
+
+The report covers turn throughput, reply and rerun latency percentiles, and
+process memory per session (which includes the harness's own copy of each
+session's element tree). Data files are written to a temporary directory.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import mock_openai
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# AppTest swaps a global runtime in and out around each run, so runs can't overlap
+SCRIPT_RUN_LOCK = threading.Lock()
+
+def rss_bytes() -> int:
+    """Resident memory of this process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def percentile(samples: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile of samples"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+def summarize(samples: List[float]) -> Dict:
+    """Latency summary in milliseconds"""
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 1),
+        "p50_ms": round(percentile(samples, 50) * 1000, 1),
+        "p90_ms": round(percentile(samples, 90) * 1000, 1),
+        "p99_ms": round(percentile(samples, 99) * 1000, 1),
+        "max_ms": round(max(samples) * 1000, 1)
+    }
+
+class SessionResults:
+    """Measurements collected by all simulated sessions"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turn_latencies = []
+        self.rerun_latencies = []
+        self.completed = 0
+        self.failed = 0
+        self.exceptions = []
+
+    def add_turn(self, latency: float, ok: bool):
+        with self.lock:
+            self.turn_latencies.append(latency)
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def add_reruns(self, latencies: List[float]):
+        with self.lock:
+            self.rerun_latencies.extend(latencies)
+
+class MemorySampler:
+    """Samples process RSS on a background thread and keeps the peak"""
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak = rss_bytes()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="rss-sampler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+    def stop(self) -> int:
+        self.stopped.set()
+        self.thread.join()
+        return max(self.peak, rss_bytes())
+
+def run_session(index: int, args: argparse.Namespace, start: threading.Barrier,
+                results: SessionResults, sessions: List):
+    """Drive one chat session through ``args.turns`` turns"""
+    from streamlit.testing.v1 import AppTest
+
+    reruns = []
+
+    def rerun(at):
+        with SCRIPT_RUN_LOCK:
+            started = time.perf_counter()
+            at.run()
+            reruns.append(time.perf_counter() - started)
+
+    try:
+        at = AppTest.from_file(APP_FILE, default_timeout=args.timeout)
+        sessions[index] = at
+        start.wait()
+        rerun(at)
+        for turn in range(args.turns):
+            started = time.perf_counter()
+            at.chat_input[0].set_value(f"Load test message {turn} from session {index}")
+            rerun(at)
+            # AppTest doesn't fire run_every fragments, so poll like the browser would
+            while at.session_state["generation"] is not None:
+                if time.perf_counter() - started > args.timeout:
+                    raise TimeoutError(f"turn {turn} did not finish within {args.timeout}s")
+                time.sleep(args.poll_interval)
+                rerun(at)
+            messages = at.session_state["messages"]
+            ok = not at.exception and bool(messages) and messages[-1]["role"] == "assistant" \
+                and not messages[-1]["content"].startswith("Error")
+            results.add_turn(time.perf_counter() - started, ok)
+            if args.think_time:
+                time.sleep(args.think_time)
+    except Exception as e:
+        with results.lock:
+            results.exceptions.append(f"session {index}: {type(e).__name__}: {e}")
+    finally:
+        results.add_reruns(reruns)
+
+def run_load_test(args: argparse.Namespace) -> Dict:
+    """Run the simulated sessions and return the report"""
+    server = None
+    url = args.base_url
+    if not url:
+        server = mock_openai.serve(settings=mock_openai.settings_from_arguments(args))
+        url = mock_openai.base_url(server)
+    os.environ["PIXEL_OPENAI_BASE_URL"] = url
+    os.environ["PIXEL_STORAGE_BACKEND"] = args.backend
+
+    workdir = tempfile.mkdtemp(prefix="pixel-loadtest-")
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with open("preferences.json", "w", encoding="utf-8") as f:
+            json.dump({"api_key": args.api_key}, f)
+
+        # Warm up: the first run imports the app and builds the process-wide singletons
+        from streamlit.testing.v1 import AppTest
+        # Session and worker threads outside a script run are expected here; don't warn about each one
+        logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(
+            lambda record: "missing ScriptRunContext" not in record.getMessage()
+        )
+        AppTest.from_file(APP_FILE, default_timeout=args.timeout).run()
+
+        rss_before = rss_bytes()
+        sampler = MemorySampler()
+        results = SessionResults()
+        sessions = [None] * args.sessions
+        start = threading.Barrier(args.sessions + 1)
+        threads = [
+            threading.Thread(target=run_session, args=(i, args, start, results, sessions), name=f"session-{i}")
+            for i in range(args.sessions)
+        ]
+        for thread in threads:
+            thread.start()
+        start.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        # Sessions are still referenced here, so their state counts towards RSS
+        rss_after = rss_bytes()
+        rss_peak = sampler.stop()
+        live_sessions = sum(1 for at in sessions if at is not None)
+    finally:
+        os.chdir(previous_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+        if server is not None:
+            server.shutdown()
+
+    turns = results.completed + results.failed
+    return {
+        "sessions": args.sessions,
+        "turns_per_session": args.turns,
+        "backend": args.backend,
+        "base_url": url,
+        "elapsed_s": round(elapsed, 2),
+        "turns": turns,
+        "completed": results.completed,
+        "failed": results.failed,
+        "throughput_turns_per_s": round(turns / elapsed, 2) if elapsed else None,
+        "reply_latency": summarize(results.turn_latencies),
+        "rerun_latency": summarize(results.rerun_latencies),
+        "memory": {
+            "rss_before_mb": round(rss_before / 2**20, 1),
+            "rss_after_mb": round(rss_after / 2**20, 1),
+            "rss_peak_mb": round(rss_peak / 2**20, 1),
+            "per_session_kb": round((rss_after - rss_before) / max(1, live_sessions) / 1024, 1)
+        },
+        "mock_server": {"requests": server.settings.requests, "errors": server.settings.errors} if server else None,
+        "exceptions": results.exceptions
+    }
+
+def print_report(report: Dict):
+    """Print the report as a short table"""
+    print(f"{report['sessions']} sessions x {report['turns_per_session']} turns "
+          f"({report['backend']} storage) in {report['elapsed_s']} s")
+    print(f"  turns: {report['completed']} completed, {report['failed']} failed, "
+          f"{report['throughput_turns_per_s']} turns/s")
+    for name in ("reply_latency", "rerun_latency"):
+        stats = report[name]
+        if stats["count"]:
+            print(f"  {name.replace('_', ' ')}: p50 {stats['p50_ms']} ms, p90 {stats['p90_ms']} ms, "
+                  f"p99 {stats['p99_ms']} ms, max {stats['max_ms']} ms ({stats['count']} samples)")
+    memory = report["memory"]
+    print(f"  memory: {memory['rss_before_mb']} MB -> {memory['rss_after_mb']} MB "
+          f"(peak {memory['rss_peak_mb']} MB), ~{memory['per_session_kb']} KB per session")
+    if report["mock_server"]:
+        print(f"  mock server: {report['mock_server']['requests']} requests, {report['mock_server']['errors']} injected errors")
+    for line in report["exceptions"]:
+        print(f"  ! {line}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent Pixel Chat sessions against a mock OpenAI server")
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent sessions (default 10)")
+    parser.add_argument("--turns", type=int, default=3, help="chat turns per session (default 3)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds a session waits between turns")
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="seconds between reruns while a reply is pending")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds allowed per rerun and per turn")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json", help="conversation storage engine")
+    parser.add_argument("--base-url", help="use an already running server instead of starting mock_openai in-process")
+    parser.add_argument("--api-key", default="sk-mock", help="API key stored for the simulated sessions")
+    parser.add_argument("--json", metavar="PATH", help="also write the report as JSON ('-' for stdout)")
+    mock_openai.add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    report = run_load_test(args)
+    if args.json == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+    sys.exit(1 if report["exceptions"] else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Local stand-in for the OpenAI chat.completions API, for load tests.
+
+Run it and point the app at it instead of the real endpoint:
+
+    python mock_openai.py --port 8765 --latency 0.3 --tokens-per-second 50
+    PIXEL_OPENAI_BASE_URL=http://127.0.0.1:8765/v1/ streamlit run app.py
+
+Replies are made-up text of ``--reply-tokens`` words. ``--latency`` is the
+delay before the first token and ``--tokens-per-second`` the rate at which the
+rest arrive, for streamed and non-streamed requests alike. ``--error-rate``
+fails that fraction of requests with ``--error-status`` (429 responses carry a
+Retry-After header, like the real API).
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional
+
+# Words the fake replies are made of
+REPLY_WORDS = (
+    "sure", "here", "is", "a", "pixel", "sized", "answer", "about", "that",
+    "with", "some", "sparkle", "and", "a", "few", "more", "words", "to", "read"
+)
+
+class MockSettings:
+    """Latency, token rate and error injection for the mock server"""
+
+    def __init__(self, latency: float = 0.2, jitter: float = 0.0, tokens_per_second: float = 50.0,
+                 reply_tokens: int = 60, error_rate: float = 0.0, error_status: int = 500):
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def first_token_delay(self) -> float:
+        """Seconds to wait before the first token"""
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def token_delay(self) -> float:
+        """Seconds between tokens"""
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def count_request(self) -> bool:
+        """Record a request; return True if it should fail"""
+        failed = random.random() < self.error_rate
+        with self.lock:
+            self.requests += 1
+            if failed:
+                self.errors += 1
+        return failed
+
+def estimate_tokens(messages: List[Dict]) -> int:
+    """Rough prompt token count, about four characters per token"""
+    return sum(len(str(m.get("content", ""))) for m in messages) // 4 + 3 * len(messages)
+
+def reply_tokens(messages: List[Dict], count: int) -> List[str]:
+    """Made-up reply tokens, seeded by the last message so replies are repeatable"""
+    last = str(messages[-1].get("content", "")) if messages else ""
+    rng = random.Random(last)
+    return [("" if i == 0 else " ") + rng.choice(REPLY_WORDS) for i in range(count)]
+
+def usage_block(prompt_tokens: int, completion_tokens: int) -> Dict:
+    """The usage object returned with a completion"""
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """Serves /v1/chat/completions and /v1/models"""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "MockOpenAI/1.0"
+
+    @property
+    def settings(self) -> MockSettings:
+        return self.server.settings
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status: int, body: Dict, headers: Optional[Dict] = None):
+        """Write a complete JSON response"""
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status: int, message: str):
+        """Write an error in the API's error format"""
+        headers = {"Retry-After": "1"} if status == 429 else None
+        error_type = "rate_limit_error" if status == 429 else "server_error"
+        self.send_json(status, {"error": {"message": message, "type": error_type, "code": None}}, headers)
+
+    def write_chunk(self, data: bytes):
+        """Write one chunk of a chunked response"""
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [
+                {"id": model, "object": "model", "created": 0, "owned_by": "mock"}
+                for model in ("gpt-3.5-turbo", "gpt-4", "gpt-4o-mini", "gpt-4o")
+            ]})
+        elif self.path.rstrip("/") in ("", "/health"):
+            self.send_json(200, {"status": "ok", "requests": self.settings.requests, "errors": self.settings.errors})
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_error_json(400, "Request body is not valid JSON")
+            return
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error_json(404, f"Unknown path {self.path}")
+            return
+        if self.settings.count_request():
+            time.sleep(self.settings.first_token_delay())
+            self.send_error_json(self.settings.error_status, "Injected failure from the mock server")
+            return
+
+        messages = request.get("messages") or []
+        count = self.settings.reply_tokens
+        if request.get("max_tokens"):
+            count = min(count, int(request["max_tokens"]))
+        tokens = reply_tokens(messages, count)
+        usage = usage_block(estimate_tokens(messages), len(tokens))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        model = request.get("model", "gpt-3.5-turbo")
+
+        time.sleep(self.settings.first_token_delay())
+        if request.get("stream"):
+            include_usage = bool((request.get("stream_options") or {}).get("include_usage"))
+            self.stream_completion(completion_id, model, tokens, usage if include_usage else None)
+        else:
+            time.sleep(self.settings.token_delay() * max(0, len(tokens) - 1))
+            self.send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            })
+
+    def stream_completion(self, completion_id: str, model: str, tokens: List[str], usage: Optional[Dict]):
+        """Send the reply as server-sent events, one token per event"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for event in stream_events(completion_id, model, tokens, usage, self.settings.token_delay()):
+                self.write_chunk(event)
+            self.write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading (e.g. "Stop generating")
+            self.close_connection = True
+
+def stream_events(completion_id: str, model: str, tokens: List[str], usage: Optional[Dict],
+                  delay: float) -> Iterator[bytes]:
+    """Yield SSE events for a streamed completion, sleeping ``delay`` between tokens"""
+    created = int(time.time())
+
+    def event(delta: Dict, finish_reason: Optional[str] = None, with_usage: bool = False) -> bytes:
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if not with_usage else [],
+        }
+        if with_usage:
+            chunk["usage"] = usage
+        return b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n"
+
+    yield event({"role": "assistant", "content": ""})
+    for i, token in enumerate(tokens):
+        if i and delay:
+            time.sleep(delay)
+        yield event({"content": token})
+    yield event({}, "stop")
+    if usage is not None:
+        yield event({}, with_usage=True)
+    yield b"data: [DONE]\n\n"
+
+def serve(host: str = "127.0.0.1", port: int = 0, settings: Optional[MockSettings] = None,
+          verbose: bool = False) -> ThreadingHTTPServer:
+    """Start the mock server on a background thread and return it; port 0 picks a free port"""
+    server = ThreadingHTTPServer((host, port), MockOpenAIHandler)
+    server.daemon_threads = True
+    server.settings = settings or MockSettings()
+    server.verbose = verbose
+    threading.Thread(target=server.serve_forever, name="mock-openai", daemon=True).start()
+    return server
+
+def base_url(server: ThreadingHTTPServer) -> str:
+    """The value to use for PIXEL_OPENAI_BASE_URL"""
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/v1/"
+
+def add_settings_arguments(parser: argparse.ArgumentParser):
+    """Add the MockSettings options to a command-line parser"""
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token (default 0.2)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds added to the latency")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="token rate after the first (0 = instant)")
+    parser.add_argument("--reply-tokens", type=int, default=60, help="words per reply (default 60)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail (0-1)")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status of injected failures")
+
+def settings_from_arguments(args: argparse.Namespace) -> MockSettings:
+    """Build MockSettings from parsed add_settings_arguments options"""
+    return MockSettings(args.latency, args.jitter, args.tokens_per_second, args.reply_tokens,
+                        args.error_rate, args.error_status)
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, settings_from_arguments(args), args.verbose)
+    print(f"Mock OpenAI server listening; set PIXEL_OPENAI_BASE_URL={base_url(server)}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Server entry point with health and readiness routes that don't run app.py.
+
+Serves the app exactly like ``streamlit run app.py`` and adds two routes
+that answer without starting a session or drawing a page:
+
+    streamlit run serve.py --server.port=8080 --server.address=0.0.0.0
+
+- ``/healthz`` returns 200 as soon as the server is up, for platform health
+  checks (see fly.toml)
+- ``/readyz`` returns 200 once the process-wide imports and caches are warm
+  and 503 until then; the body lists how long each warm-up step took
+
+It also serves ``/export``, the sidebar's download link: the conversation
+history streamed as NDJSON one conversation at a time, so an export of any
+size never has to fit in memory. Links are signed by the session that made
+them and expire after a few minutes.
+
+Warming starts with the server and runs in the background: app.py's
+definitions are loaded the way Streamlit loads the script, so its
+``st.cache_resource`` factories fill the same caches the sessions use, and
+its Prewarmer imports the SDK, builds the pooled client and loads the
+conversation headers.
+"""
+
+import logging
+import os
+import threading
+import types
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from streamlit.starlette import App
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# Tells app.py's sessions to link their exports to the route below
+EXPORT_ROUTE = "/export"
+os.environ["PIXEL_EXPORT_ROUTE"] = EXPORT_ROUTE
+
+def load_app_definitions() -> types.ModuleType:
+    """Run app.py's module level without main(), as the module Streamlit runs it in.
+
+    Functions get the same module name (``__main__``) and source as in a
+    script run, which is what st.cache_resource keys its caches by.
+    """
+    module = types.ModuleType("__main__")
+    module.__file__ = APP_FILE
+    module.PREWARM_ONLY = True
+    with open(APP_FILE, encoding="utf-8") as f:
+        code = compile(f.read(), APP_FILE, "exec")
+    exec(code, module.__dict__)
+    return module
+
+class Warmup:
+    """Loads app.py's definitions once, in the background, and starts its Prewarmer"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.module = None
+        self.prewarmer = None
+        self.error = None
+        # app.py's module level runs outside a script run here on purpose; don't warn about it
+        logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(
+            lambda record: threading.current_thread() is not self.thread
+        )
+
+    def start(self):
+        """Start warming unless it has already started"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="warmup", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        try:
+            self.module = load_app_definitions()
+            self.prewarmer = self.module.get_prewarmer().start()
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+
+    def status(self) -> Dict:
+        """The Prewarmer's status, or where loading app.py got to"""
+        if self.error:
+            return {"state": "failed", "error": self.error}
+        if self.prewarmer is None:
+            return {"state": "loading" if self.thread else "pending"}
+        return self.prewarmer.status()
+
+WARMUP = Warmup()
+
+async def healthz(request) -> JSONResponse:
+    """Liveness: the server is up"""
+    WARMUP.start()
+    return JSONResponse({"status": "ok"})
+
+async def readyz(request) -> JSONResponse:
+    """Readiness: the process-wide caches are warm"""
+    WARMUP.start()
+    status = WARMUP.status()
+    return JSONResponse(status, status_code=200 if status["state"] == "done" else 503)
+
+async def export(request) -> StreamingResponse:
+    """The history named by a signed export link, streamed as NDJSON"""
+    WARMUP.start()
+    module = WARMUP.module
+    if module is None:
+        return JSONResponse({"error": "Starting up, try again in a moment"}, status_code=503)
+    export_request = module.verify_export_request(request.query_params.get("token", ""))
+    if export_request is None:
+        return JSONResponse({"error": "This export link is invalid or has expired"}, status_code=403)
+    cache = module.get_conversation_cache(export_request["directory"])
+    lines = module.export_conversation_lines(cache, since=export_request["since"], until=export_request["until"])
+    # A sync iterator: Starlette pulls each line on a worker thread
+    return StreamingResponse(lines, media_type="application/x-ndjson", headers={
+        "Content-Disposition": 'attachment; filename="pixel-conversations.ndjson"'
+    })
+
+@asynccontextmanager
+async def lifespan(app: App):
+    WARMUP.start()
+    yield
+
+app = App("app.py", lifespan=lifespan, routes=[
+    Route("/healthz", healthz, methods=["GET", "HEAD"]),
+    Route("/readyz", readyz, methods=["GET", "HEAD"]),
+    Route(EXPORT_ROUTE, export)
+])
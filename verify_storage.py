@@ -0,0 +1,243 @@
+"""Crash-recovery and round-trip checks for the conversation storage backends.
+
+Each check writes a small history to a temporary directory, reopens it the
+way a restarted app would, and compares what comes back with what was saved:
+
+- ``torn-journal``: the JSON backend replays a journal whose last record was
+  torn by a crash, and keeps the records appended after it
+- ``compaction``: the JSON backend reloads after the journal was folded into
+  the snapshot, with updates, summaries and deletes on both sides of it
+- ``archive``: the JSON backend moves old conversations into the archive
+  tier and back into the snapshot once one of them changes again
+- ``sqlite``: the SQLite backend reopens after writes, and migrates a JSON
+  history whose journal ends in a torn record
+
+The JSON checks run for every storage format in ``--formats``. The exit
+status is 1 if any check fails:
+
+    python verify_storage.py
+    python verify_storage.py --formats compact,zstd --checks torn-journal,archive
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_DIR)
+# app.py runs in bare mode here, without a script run context, by design
+for logger_name in ("streamlit.runtime.scriptrunner_utils.script_run_context", "streamlit.runtime.state.session_state_proxy"):
+    logging.getLogger(logger_name).addFilter(lambda record: record.levelno >= logging.ERROR)
+import app  # noqa: E402
+
+# Start of a journal record cut off by a crash mid-append
+TORN_RECORD = b'{"op": "upsert", "id": "torn", "timestamp": "2024-01-01T00:00:00", "start": 0, "messages": [{"role": "us'
+
+# Conversations last updated this long ago are archived by the archive check
+ARCHIVE_AFTER_DAYS = 30
+
+def expect(condition: bool, message: str):
+    """Fail the current check with ``message`` unless ``condition`` holds"""
+    if not condition:
+        raise AssertionError(message)
+
+def open_json_store(directory: str, storage_format: str, archive_after_days: float = 0) -> app.JsonConversationStore:
+    """Open the JSON history in ``directory`` as a restarted app would"""
+    store = app.JsonConversationStore(
+        os.path.join(directory, app.CONVERSATIONS_FILE),
+        os.path.join(directory, app.CONVERSATIONS_INDEX_FILE),
+        os.path.join(directory, app.CONVERSATIONS_JOURNAL_FILE),
+        # Compactions are run explicitly by the checks, never in the background
+        sys.maxsize,
+        storage_format,
+        os.path.join(directory, app.CONVERSATIONS_ARCHIVE_DIR),
+        archive_after_days
+    )
+    store.next_archive_check = float("inf")
+    return store
+
+def open_sqlite_store(directory: str) -> app.SqliteConversationStore:
+    """Open the SQLite history in ``directory``"""
+    return app.SqliteConversationStore(os.path.join(directory, app.CONVERSATIONS_DB_FILE))
+
+def save_turns(store: app.ConversationStore, expected: Dict[str, List[Dict]], conversation_id: str, timestamp: str, turns: int):
+    """Save ``turns`` more user/assistant turns of a conversation, as a chat does, and note them in ``expected``"""
+    for _ in range(turns):
+        start = len(expected.get(conversation_id, []))
+        messages = [
+            {"role": "user", "content": f"question {start // 2} in {conversation_id}"},
+            {"role": "assistant", "content": f"answer {start // 2} in {conversation_id} ✨"}
+        ]
+        store.upsert_messages(conversation_id, timestamp, start, messages)
+        expected[conversation_id] = expected.get(conversation_id, []) + messages
+
+def expect_history(store: app.ConversationStore, expected: Dict[str, List[Dict]], when: str):
+    """Fail unless ``store`` lists, loads and opens exactly the ``expected`` conversations"""
+    listed = [header["id"] for header in store.list_headers()]
+    expect(sorted(listed) == sorted(expected), f"{when}: listed {sorted(listed)}, expected {sorted(expected)}")
+    loaded = {conv["id"]: conv["messages"] for conv in store.load_all()}
+    expect(loaded == expected, f"{when}: load_all() returned different messages")
+    for conv_id, messages in expected.items():
+        conv = store.get(conv_id)
+        expect(conv is not None and conv["messages"] == messages, f"{when}: get({conv_id!r}) returned different messages")
+        expect(conv["metadata"]["message_count"] == len(messages), f"{when}: stale message count for {conv_id!r}")
+
+def tear_journal(path: str):
+    """Leave a half-written record at the end of a journal, as a crash mid-append would"""
+    with open(path, 'ab') as f:
+        f.write(TORN_RECORD)
+
+def check_torn_journal(directory: str, storage_format: str):
+    """Replay a journal ending in a torn record, then append past it"""
+    now = datetime.now().isoformat()
+    expected = {}
+    store = open_json_store(directory, storage_format)
+    save_turns(store, expected, "a", now, 2)
+    save_turns(store, expected, "b", now, 1)
+    tear_journal(store.journal_file)
+
+    store = open_json_store(directory, storage_format)
+    expect_history(store, expected, "after replaying a torn journal")
+    save_turns(store, expected, "a", now, 1)
+    save_turns(store, expected, "c", now, 1)
+    expect_history(open_json_store(directory, storage_format), expected, "after appending past a torn record")
+
+    # The same with a snapshot underneath
+    store.compact()
+    save_turns(store, expected, "b", now, 1)
+    tear_journal(store.journal_file)
+    store = open_json_store(directory, storage_format)
+    expect_history(store, expected, "after compacting and replaying a torn journal")
+    save_turns(store, expected, "b", now, 1)
+    expect_history(open_json_store(directory, storage_format), expected, "after compacting and appending past a torn record")
+
+def check_compaction(directory: str, storage_format: str):
+    """Reload after compactions with saves, summaries and deletes on both sides of them"""
+    now = datetime.now().isoformat()
+    summary = {"text": "The user asked about storage.", "covered": 2}
+    expected = {}
+    store = open_json_store(directory, storage_format)
+    for conv_id in ("a", "b", "c"):
+        save_turns(store, expected, conv_id, now, 2)
+    store.compact()
+    expect(not os.path.exists(store.journal_file), "the journal is left after compacting")
+    expect_history(open_json_store(directory, storage_format), expected, "after a compaction")
+
+    save_turns(store, expected, "a", now, 1)
+    store.set_summary("c", summary)
+    store.delete("b")
+    del expected["b"]
+    save_turns(store, expected, "d", now, 1)
+    store.compact()
+    expect(not os.path.exists(store.rotated_journal_file), "the rotated journal is left after compacting")
+    expect_history(store, expected, "in the compacting process")
+
+    # Records appended after the compaction replay on top of the new snapshot
+    save_turns(store, expected, "c", now, 1)
+    store = open_json_store(directory, storage_format)
+    expect_history(store, expected, "after a second compaction")
+    expect(store.get("c").get("summary") == summary, "the summary is lost after compacting")
+
+def check_archive(directory: str, storage_format: str):
+    """Archive old conversations, then bring one back into the snapshot by changing it"""
+    now = datetime.now().isoformat()
+    old = (datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS * 3)).isoformat()
+    expected = {}
+    store = open_json_store(directory, storage_format, ARCHIVE_AFTER_DAYS)
+    save_turns(store, expected, "old-a", old, 2)
+    save_turns(store, expected, "old-b", old, 1)
+    save_turns(store, expected, "new", now, 1)
+    store.compact()
+    archived = sorted(store.read_catalog())
+    expect(archived == ["old-a", "old-b"], f"archived {archived}, expected ['old-a', 'old-b']")
+    expect_history(open_json_store(directory, storage_format, ARCHIVE_AFTER_DAYS), expected, "after archiving")
+
+    save_turns(store, expected, "old-a", now, 1)
+    expect_history(open_json_store(directory, storage_format, ARCHIVE_AFTER_DAYS), expected, "after changing an archived conversation")
+    store.compact()
+    archived = sorted(store.read_catalog())
+    expect(archived == ["old-b"], f"archived {archived} after unarchiving, expected ['old-b']")
+    store = open_json_store(directory, storage_format, ARCHIVE_AFTER_DAYS)
+    expect_history(store, expected, "after unarchiving")
+
+    store.delete("old-b")
+    del expected["old-b"]
+    store.compact()
+    expect(store.read_catalog() == {}, "a deleted conversation is left in the archive")
+    expect_history(open_json_store(directory, storage_format, ARCHIVE_AFTER_DAYS), expected, "after deleting an archived conversation")
+
+def check_sqlite(directory: str, storage_format: str):
+    """Reopen the SQLite backend after writes, and migrate a JSON history with a torn journal"""
+    now = datetime.now().isoformat()
+    summary = {"text": "The user asked about storage.", "covered": 2}
+    expected = {}
+    json_store = open_json_store(directory, storage_format)
+    save_turns(json_store, expected, "a", now, 2)
+    save_turns(json_store, expected, "b", now, 1)
+    tear_journal(json_store.journal_file)
+
+    store = open_sqlite_store(directory)
+    try:
+        store.migrate_from_json(open_json_store(directory, storage_format))
+        expect_history(store, expected, "after migrating a JSON history")
+        save_turns(store, expected, "a", now, 1)
+        save_turns(store, expected, "c", now, 2)
+        store.set_summary("a", summary)
+        store.delete("b")
+        del expected["b"]
+    finally:
+        store.close()
+
+    store = open_sqlite_store(directory)
+    try:
+        expect_history(store, expected, "after reopening the database")
+        expect(store.get("a").get("summary") == summary, "the summary is lost after reopening")
+        # The migration runs once; a second one must not bring deleted conversations back
+        store.migrate_from_json(open_json_store(directory, storage_format))
+        expect_history(store, expected, "after migrating again")
+    finally:
+        store.close()
+
+# Check name -> check, run in a fresh directory per storage format
+CHECKS: Dict[str, Callable[[str, str], None]] = {
+    "torn-journal": check_torn_journal,
+    "compaction": check_compaction,
+    "archive": check_archive,
+    "sqlite": check_sqlite
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that stored conversations survive crashes, compaction and archiving")
+    parser.add_argument("--checks", default=",".join(CHECKS), help=f"comma-separated checks (default: all of {', '.join(CHECKS)})")
+    parser.add_argument("--formats", default=",".join(app.STORAGE_FORMATS), help="comma-separated JSON storage formats (default: all)")
+    args = parser.parse_args()
+
+    checks = [name.strip() for name in args.checks.split(",") if name.strip()]
+    formats = [name.strip() for name in args.formats.split(",") if name.strip()]
+    unknown = [name for name in checks if name not in CHECKS] + [name for name in formats if name not in app.STORAGE_FORMATS]
+    if unknown:
+        parser.error(f"unknown check or format: {', '.join(unknown)}")
+
+    failures = 0
+    for name in checks:
+        for storage_format in formats:
+            directory = tempfile.mkdtemp(prefix="pixel-verify-")
+            try:
+                CHECKS[name](directory, storage_format)
+                print(f"ok    {name} ({storage_format})")
+            except Exception as e:
+                failures += 1
+                print(f"FAIL  {name} ({storage_format}): {e}")
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"{failures} of {len(checks) * len(formats)} checks failed" if failures else "All checks passed")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()